@@ -0,0 +1,273 @@
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from contextlib import nullcontext
+
+import pandas as pd
+
+from data_utils import (
+    FILE_SCHEMAS,
+    calculate_routing,
+    calculate_sediment_routing,
+    calculate_water_routing,
+    load_dat_file
+)
+from instrumentation import profiling, sidecar_path
+from result_writer import write_result
+from routing_engine import compile_topology
+
+logger = logging.getLogger('basinflow')
+
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_USAGE = 2
+
+# chave do manifesto / argumento -> arquivo do schema
+INPUT_FILES = {
+    'reservoir': 'reservoir.dat',
+    'routing': 'routing.dat',
+    'runoff': 'runoff.dat',
+    'sedyield': 'sedyield.dat',
+    'sed_param': 'sed_param.dat'
+}
+
+
+def load_inputs(basin, use_cache):
+
+    if use_cache:
+        from dat_cache import load_dat_file_cached as carregar
+    else:
+        carregar = load_dat_file
+
+    dataframes = {}
+    for chave, nome in INPUT_FILES.items():
+        caminho = basin.get(chave)
+        if caminho:
+            dataframes[nome] = carregar(caminho, FILE_SCHEMAS[nome])
+    return dataframes
+
+
+def load_topology(basin, dataframes, use_cache):
+
+    # com cache, a topologia compilada fica ao lado do routing.dat
+    if use_cache:
+        from dat_cache import load_topology_cached
+        return load_topology_cached(basin['routing'])
+    return compile_topology(dataframes['routing.dat'])
+
+
+def sediment_options(basin, dataframes):
+
+    # (df_sedyield, radio_mode, df_sed_param, density, efficiency) como nos
+    # argumentos de calculate_routing
+    df_sedyield = dataframes.get('sedyield.dat')
+    df_sed_param = dataframes.get('sed_param.dat')
+    density = basin.get('density')
+    efficiency = basin.get('efficiency')
+
+    if df_sedyield is not None:
+        if df_sed_param is not None:
+            radio_mode = 1
+        elif density is not None or efficiency is not None:
+            radio_mode = 2
+            # eficiência em %, como no campo da interface
+            efficiency = float(efficiency) / 100 if efficiency is not None else None
+            density = float(density) if density is not None else None
+        else:
+            raise ValueError("Informe sed_param ou density/efficiency para simular sedimentos.")
+    else:
+        radio_mode = None
+
+    return df_sedyield, radio_mode, df_sed_param, density, efficiency
+
+
+def run_basin(basin, engine='array', use_cache=True, processes=None, output_format='dat'):
+
+    tempos = {}
+    inicio = time.perf_counter()
+
+    for chave in ('reservoir', 'routing', 'runoff', 'output'):
+        if not basin.get(chave):
+            raise ValueError(f"Parâmetro obrigatório ausente: {chave}")
+
+    dataframes = load_inputs(basin, use_cache)
+    topology = None
+    if engine == 'array' or basin.get('targets'):
+        topology = load_topology(basin, dataframes, use_cache)
+    tempos['load'] = time.perf_counter() - inicio
+
+    df_sedyield, radio_mode, df_sed_param, density, efficiency = sediment_options(basin, dataframes)
+
+    t = time.perf_counter()
+    if basin.get('targets'):
+        if df_sedyield is not None:
+            raise ValueError("Consultas por subbacia (--target) propagam apenas água.")
+        # só o fecho de montante dos alvos (água apenas)
+        from query import BasinQuery
+        consulta = BasinQuery(
+            topology,
+            dataframes['reservoir.dat'],
+            dataframes['runoff.dat']
+        )
+        result = consulta.route(basin['targets'])
+        ruptura_dict = dict(zip(result['subasin_id'].tolist(), result['rompeu'].tolist()))
+    elif engine == 'array':
+        result, _, ruptura_dict, _, _ = calculate_routing(
+            dataframes['reservoir.dat'],
+            dataframes['routing.dat'],
+            dataframes['runoff.dat'],
+            df_sedyield,
+            radio_mode,
+            df_sed_param,
+            density,
+            efficiency,
+            topology=topology,
+            processes=processes
+        )
+    else:
+        result, G, ruptura_dict, sequencia, df_merged = calculate_water_routing(
+            dataframes['reservoir.dat'],
+            dataframes['routing.dat'],
+            dataframes['runoff.dat'],
+            engine=engine
+        )
+        if df_sedyield is not None:
+            result = calculate_sediment_routing(
+                result, G, ruptura_dict, sequencia, df_sedyield, df_merged,
+                radio_mode, df_sed_param, density, efficiency
+            )
+    tempos['routing'] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    write_result(result, basin['output'], basin.get('format', output_format))
+    tempos['write'] = time.perf_counter() - t
+    tempos['total'] = time.perf_counter() - inicio
+
+    return {
+        'nodes': len(ruptura_dict),
+        'failures': int(sum(ruptura_dict.values())),
+        'timings': tempos
+    }
+
+
+def read_manifest(path):
+
+    # JSON: lista de objetos; CSV: uma bacia por linha com as mesmas chaves
+    if path.lower().endswith('.json'):
+        with open(path, encoding='utf-8') as f:
+            basins = json.load(f)
+    else:
+        basins = pd.read_csv(path).to_dict(orient='records')
+
+    base = os.path.dirname(os.path.abspath(path))
+    normalizadas = []
+    for i, basin in enumerate(basins):
+        basin = {k: v for k, v in basin.items() if not (isinstance(v, float) and v != v)}
+        for chave in list(INPUT_FILES) + ['output']:
+            if basin.get(chave) and not os.path.isabs(basin[chave]):
+                basin[chave] = os.path.join(base, basin[chave])
+        basin.setdefault('name', f'basin_{i}')
+        normalizadas.append(basin)
+    return normalizadas
+
+
+def build_parser():
+
+    parser = argparse.ArgumentParser(
+        prog='basinflow',
+        description='Propagação de cheias e sedimentos em cascatas de açudes, sem interface gráfica.'
+    )
+    parser.add_argument('--reservoir', help='caminho do reservoir.dat')
+    parser.add_argument('--routing', help='caminho do routing.dat')
+    parser.add_argument('--runoff', help='caminho do runoff.dat')
+    parser.add_argument('--sedyield', help='caminho do sedyield.dat (ativa sedimentos)')
+    parser.add_argument('--sed-param', dest='sed_param', help='caminho do sed_param.dat (modo arquivo)')
+    parser.add_argument('--density', type=float, help='densidade aparente seca (g/cm³), modo manual')
+    parser.add_argument('--efficiency', type=float, help='eficiência de retenção (%%), modo manual')
+    parser.add_argument('-o', '--output', help='arquivo de saída (.dat)')
+    parser.add_argument('--format', dest='output_format', choices=['dat', 'wasa', 'columnar'], default='dat',
+                        help='dat: layout atual; wasa: cabeçalho WASA e vírgula decimal; columnar: zip binário por coluna')
+    parser.add_argument('--manifest', help='JSON ou CSV com várias bacias')
+    parser.add_argument('--engine', choices=['array', 'networkx'], default='array')
+    parser.add_argument('--target', dest='targets', type=int, action='append',
+                        help='subbacia de interesse (repetível); propaga só o que drena para ela')
+    parser.add_argument('--processes', type=int,
+                        help='propaga sub-bacias independentes em paralelo (engine array)')
+    parser.add_argument('--no-cache', dest='use_cache', action='store_false',
+                        help='não usar o cache binário dos .dat')
+    parser.add_argument('--timing-json', dest='timing_json',
+                        help='grava o relatório de tempos em JSON neste arquivo')
+    parser.add_argument('--profile', action='store_true',
+                        help='mede tempo, CPU e memória por etapa e grava <saída>.profile.json')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    return parser
+
+
+def main(argv=None):
+
+    parser = build_parser()
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        stream=sys.stderr,
+        level=logging.INFO if args.verbose else logging.WARNING,
+        format='%(asctime)s - %(levelname)s: %(message)s'
+    )
+
+    if args.manifest:
+        try:
+            basins = read_manifest(args.manifest)
+        except (OSError, ValueError) as e:
+            print(f"basinflow: erro ao ler o manifesto: {e}", file=sys.stderr)
+            return EXIT_USAGE
+    elif args.reservoir and args.routing and args.runoff and args.output:
+        basins = [{
+            'name': os.path.splitext(os.path.basename(args.output))[0],
+            'reservoir': args.reservoir,
+            'routing': args.routing,
+            'runoff': args.runoff,
+            'sedyield': args.sedyield,
+            'sed_param': args.sed_param,
+            'density': args.density,
+            'efficiency': args.efficiency,
+            'targets': args.targets,
+            'output': args.output
+        }]
+    else:
+        parser.print_usage(sys.stderr)
+        print("basinflow: informe --manifest ou --reservoir/--routing/--runoff/--output", file=sys.stderr)
+        return EXIT_USAGE
+
+    relatorio = []
+    codigo = EXIT_OK
+
+    for basin in basins:
+        registro = {'name': basin.get('name'), 'output': basin.get('output')}
+        try:
+            with profiling(track_memory=True) if args.profile else nullcontext() as perfil:
+                registro.update(run_basin(basin, args.engine, args.use_cache, args.processes, args.output_format))
+            registro['status'] = 'ok'
+            if perfil is not None:
+                registro['profile'] = sidecar_path(basin['output'])
+                perfil.write_json(registro['profile'])
+        except Exception as e:
+            logger.exception('Erro na bacia %s', basin.get('name'))
+            registro['status'] = 'error'
+            registro['error'] = str(e)
+            codigo = EXIT_FAILED
+
+        relatorio.append(registro)
+        print(json.dumps(registro, ensure_ascii=False), flush=True)
+
+    if args.timing_json:
+        with open(args.timing_json, 'w', encoding='utf-8') as f:
+            json.dump(relatorio, f, ensure_ascii=False, indent=2)
+
+    return codigo
+
+
+if __name__ == '__main__':
+    sys.exit(main())
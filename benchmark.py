@@ -0,0 +1,300 @@
+import argparse
+import hashlib
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from data_utils import (
+    FILE_SCHEMAS,
+    calculate_routing,
+    calculate_sediment_routing,
+    calculate_water_routing,
+    load_dat_file
+)
+from instrumentation import profiling
+from result_writer import format_chunk, write_result
+from synthetic import generate_basin, write_wasa_basin
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks', 'baseline.json')
+BASELINE_VERSION = 1
+
+DEFAULT_SIZES = (1000, 10000, 100000)
+DEFAULT_SHAPES = ('chain', 'bushy', 'forest')
+
+# acima destes limites a engine networkx fica de fora (minutos por caso)
+NETWORKX_MAX_NODES = 100000
+
+# tolerâncias para acusar regressão; diferenças de tempo abaixo de
+# MIN_TIME_DELTA são ruído de medição
+TIME_TOLERANCE = 0.3
+MEMORY_TOLERANCE = 0.10
+MIN_TIME_DELTA = 0.02
+
+
+def shape_params(shape, n_nodes):
+
+    # formatos de rede do generate_basin
+    if shape == 'chain':
+        # cadeias profundas: até 1000 níveis de largura constante
+        return {'branching': 1.0, 'n_outlets': max(1, n_nodes // 1000)}
+    if shape == 'bushy':
+        # uma única árvore larga e rasa
+        return {'branching': 4.0, 'n_outlets': 1}
+    if shape == 'forest':
+        # muitas bacias pequenas, cada uma com seu exutório
+        return {'branching': 2.0, 'n_outlets': max(1, n_nodes // 50)}
+    raise ValueError(f"Formato de rede desconhecido: {shape}")
+
+
+def _measure(etapa, funcao, repeat):
+
+    # melhor tempo entre repeat execuções sem tracemalloc, e uma execução à
+    # parte com tracemalloc para o pico de memória
+    melhor = None
+    for _ in range(repeat):
+        with profiling() as perfil:
+            with perfil.stage(etapa):
+                resultado = funcao()
+        if melhor is None or perfil.stages[etapa]['wall_s'] < melhor.stages[etapa]['wall_s']:
+            melhor = perfil
+
+    with profiling(track_memory=True) as memoria:
+        with memoria.stage(etapa):
+            funcao()
+
+    registro = {
+        'wall_s': melhor.stages[etapa]['wall_s'],
+        'cpu_s': melhor.stages[etapa]['cpu_s'],
+        'peak_traced_bytes': memoria.stages[etapa]['peak_traced_bytes'],
+        'stages': {
+            nome: round(r['wall_s'], 6) for nome, r in melhor.stages.items() if nome != etapa
+        }
+    }
+    return registro, resultado, melhor.counters
+
+
+def result_digest(df):
+    # impressão digital do resultado no layout do .dat
+    return hashlib.sha256(format_chunk(df)).hexdigest()
+
+
+def run_case(shape, n_nodes, workdir, failure_rate=0.1, seed=0, repeat=5, engines=('array',)):
+
+    caso = {'shape': shape, 'n_nodes': n_nodes, 'failure_rate': failure_rate, 'seed': seed}
+    setup = {}
+
+    t = time.perf_counter()
+    dataframes = generate_basin(n_nodes, failure_rate=failure_rate, seed=seed, **shape_params(shape, n_nodes))
+    setup['generate_s'] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    caminhos = write_wasa_basin(workdir, dataframes)
+    setup['write_inputs_s'] = time.perf_counter() - t
+    del dataframes
+    caso['setup'] = setup
+
+    etapas = {}
+    contadores = {}
+
+    def carregar():
+        return {
+            chave: load_dat_file(caminho, FILE_SCHEMAS[os.path.basename(caminho)])
+            for chave, caminho in caminhos.items()
+        }
+
+    etapas['load'], tabelas, _ = _measure('load', carregar, repeat)
+    res, rt, run = tabelas['reservoir'], tabelas['routing'], tabelas['runoff']
+    sed, sed_param = tabelas['sedyield'], tabelas['sed_param']
+
+    for engine in engines:
+        if engine == 'networkx' and n_nodes > NETWORKX_MAX_NODES:
+            continue
+        sufixo = '' if engine == 'array' else f'_{engine}'
+
+        etapas['water' + sufixo], agua, c = _measure(
+            'water' + sufixo, lambda: calculate_water_routing(res, rt, run, engine=engine), repeat
+        )
+        contadores.update(c)
+        result, G, ruptura_dict, sequencia, df_merged = agua
+        etapas['sediment' + sufixo], _, _ = _measure(
+            'sediment' + sufixo,
+            lambda: calculate_sediment_routing(result, G, ruptura_dict, sequencia, sed, df_merged, 1, sed_param),
+            repeat
+        )
+
+    etapas['fused'], fundido, c = _measure(
+        'fused', lambda: calculate_routing(res, rt, run, sed, 1, sed_param), repeat
+    )
+    contadores.update(c)
+    result = fundido[0]
+
+    saida = os.path.join(workdir, 'result.dat')
+    etapas['write'], _, _ = _measure('write', lambda: write_result(result, saida), repeat)
+
+    caso['steps'] = etapas
+    caso['counters'] = contadores
+    caso['failures'] = int(result['rompeu'].sum())
+    caso['result_digest'] = result_digest(result)
+    return caso
+
+
+def case_key(shape, n_nodes):
+    return f'{shape}-{n_nodes}'
+
+
+def machine_info():
+    return {
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'cpu_count': os.cpu_count()
+    }
+
+
+def run_suite(sizes=DEFAULT_SIZES, shapes=DEFAULT_SHAPES, failure_rate=0.1, seed=0, repeat=5,
+              engines=('array',), workdir=None, progress=None):
+
+    casos = {}
+    for n_nodes in sizes:
+        for shape in shapes:
+            with tempfile.TemporaryDirectory(dir=workdir) as diretorio:
+                caso = run_case(shape, n_nodes, diretorio, failure_rate, seed, repeat, engines)
+            casos[case_key(shape, n_nodes)] = caso
+            if progress is not None:
+                progress(case_key(shape, n_nodes), caso)
+    return {'version': BASELINE_VERSION, 'machine': machine_info(), 'cases': casos}
+
+
+def compare_to_baseline(atual, baseline, time_tolerance=TIME_TOLERANCE,
+                        memory_tolerance=MEMORY_TOLERANCE, min_time_delta=MIN_TIME_DELTA):
+
+    # uma linha por etapa que piorou além da tolerância, ou por resultado que
+    # mudou para a mesma entrada sintética
+    regressoes = []
+    for chave, caso in atual['cases'].items():
+        referencia = baseline.get('cases', {}).get(chave)
+        if referencia is None:
+            continue
+        mesma_entrada = all(
+            caso[campo] == referencia.get(campo) for campo in ('failure_rate', 'seed')
+        )
+        if mesma_entrada and caso['result_digest'] != referencia.get('result_digest'):
+            regressoes.append({
+                'case': chave, 'step': 'fused', 'metric': 'result_digest',
+                'baseline': referencia.get('result_digest'), 'current': caso['result_digest']
+            })
+
+        for etapa, medida in caso['steps'].items():
+            anterior = referencia.get('steps', {}).get(etapa)
+            if anterior is None:
+                continue
+            tempo, tempo_ref = medida['wall_s'], anterior['wall_s']
+            if tempo > tempo_ref * (1 + time_tolerance) and tempo - tempo_ref > min_time_delta:
+                regressoes.append({
+                    'case': chave, 'step': etapa, 'metric': 'wall_s',
+                    'baseline': tempo_ref, 'current': tempo, 'ratio': tempo / tempo_ref
+                })
+            pico, pico_ref = medida['peak_traced_bytes'], anterior['peak_traced_bytes']
+            if pico_ref and pico > pico_ref * (1 + memory_tolerance):
+                regressoes.append({
+                    'case': chave, 'step': etapa, 'metric': 'peak_traced_bytes',
+                    'baseline': pico_ref, 'current': pico, 'ratio': pico / pico_ref
+                })
+    return regressoes
+
+
+def load_baseline(path=BASELINE_PATH):
+    with open(path, encoding='utf-8') as f:
+        baseline = json.load(f)
+    if baseline.get('version') != BASELINE_VERSION:
+        raise ValueError(f"Versão de baseline incompatível em {path}")
+    return baseline
+
+
+def save_baseline(resultado, path=BASELINE_PATH, merge=True):
+
+    # casos novos entram na baseline existente; os medidos agora substituem os antigos
+    if merge and os.path.exists(path):
+        anterior = load_baseline(path)
+        resultado = {**resultado, 'cases': {**anterior['cases'], **resultado['cases']}}
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(resultado, f, ensure_ascii=False, indent=2, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def _format_case(chave, caso):
+    etapas = '  '.join(
+        f"{nome} {m['wall_s'] * 1000:.1f} ms/{m['peak_traced_bytes'] / 2 ** 20:.1f} MiB"
+        for nome, m in caso['steps'].items()
+    )
+    return f"{chave}: {caso['failures']} rupturas  {etapas}"
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(
+        prog='benchmark',
+        description='Benchmarks do pipeline em bacias sintéticas, com comparação contra a baseline.'
+    )
+    parser.add_argument('--sizes', nargs='+', type=float, default=list(DEFAULT_SIZES),
+                        help='números de açudes (aceita 1e6, 1e7)')
+    parser.add_argument('--shapes', nargs='+', choices=list(DEFAULT_SHAPES), default=list(DEFAULT_SHAPES))
+    parser.add_argument('--failure-rate', dest='failure_rate', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--networkx', action='store_true',
+                        help=f'mede também a engine networkx (até {NETWORKX_MAX_NODES} açudes)')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--update-baseline', dest='update_baseline', action='store_true',
+                        help='grava as medidas como nova baseline em vez de comparar')
+    parser.add_argument('--time-tolerance', dest='time_tolerance', type=float, default=TIME_TOLERANCE)
+    parser.add_argument('--memory-tolerance', dest='memory_tolerance', type=float, default=MEMORY_TOLERANCE)
+    parser.add_argument('--workdir', help='diretório para os arquivos sintéticos (padrão: temporário)')
+    parser.add_argument('--json', dest='json_path', help='grava o relatório completo em JSON')
+    args = parser.parse_args(argv)
+
+    engines = ('array', 'networkx') if args.networkx else ('array',)
+    resultado = run_suite(
+        [int(n) for n in args.sizes], args.shapes, args.failure_rate, args.seed, args.repeat,
+        engines, args.workdir, progress=lambda chave, caso: print(_format_case(chave, caso), flush=True)
+    )
+
+    if args.json_path:
+        with open(args.json_path, 'w', encoding='utf-8') as f:
+            json.dump(resultado, f, ensure_ascii=False, indent=2)
+
+    if args.update_baseline:
+        save_baseline(resultado, args.baseline)
+        print(f"Baseline gravada em {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"Sem baseline em {args.baseline}; use --update-baseline para criar.", file=sys.stderr)
+        return 0
+
+    baseline = load_baseline(args.baseline)
+    if baseline.get('machine', {}).get('platform') != resultado['machine']['platform']:
+        print("Aviso: baseline medida em outra máquina; tempos podem não ser comparáveis.", file=sys.stderr)
+
+    regressoes = compare_to_baseline(resultado, baseline, args.time_tolerance, args.memory_tolerance)
+    for r in regressoes:
+        if r['metric'] == 'result_digest':
+            print(f"REGRESSÃO {r['case']}: resultado diferente da baseline", file=sys.stderr)
+        else:
+            print(
+                f"REGRESSÃO {r['case']} {r['step']} {r['metric']}: "
+                f"{r['baseline']:.4g} -> {r['current']:.4g} ({r['ratio']:.2f}x)",
+                file=sys.stderr
+            )
+    return 1 if regressoes else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,243 @@
+import numpy as np
+import pandas as pd
+
+from data_utils import map_node_values, water_input_arrays, detect_integer_fields
+from routing_engine import DEFAULT_PARAMS, compile_topology, route_arrays
+
+# acima disso o índice por bitsets (N²/8 bytes) fica grande demais
+MAX_BITSET_NODES = 40000
+
+
+class ReachabilityIndex:
+
+    # responde "a está a montante de b?" em O(1). Quando cada nó tem no máximo
+    # um jusante a rede é uma floresta e bastam rótulos de intervalo (pré-ordem
+    # da árvore invertida); caso contrário usa bitsets de ancestrais.
+
+    def __init__(self, topology):
+        self.topology = topology
+        n = topology.n_nodes
+        saidas = np.bincount(topology.edge_src, minlength=n)
+
+        if n == 0 or saidas.max(initial=0) <= 1:
+            self.kind = 'interval'
+            self._build_intervals()
+        else:
+            if n > MAX_BITSET_NODES:
+                raise ValueError(
+                    f"Rede com {n} nós e confluências múltiplas: índice por bitsets exigiria "
+                    f"{n * n // 8 / 1024 ** 3:.1f} GiB."
+                )
+            self.kind = 'bitset'
+            self._build_bitsets()
+
+    def _build_intervals(self):
+
+        t = self.topology
+        n = t.n_nodes
+        src, dst = t.edge_src, t.edge_dst
+
+        # tamanho da sub-árvore de montante, por níveis crescentes
+        tamanho = np.ones(n, dtype=np.int64)
+        for nivel, _, _ in t.levels():
+            s, d = t.level_edges(nivel)
+            if len(s):
+                np.add.at(tamanho, d, tamanho[s])
+
+        # deslocamento de cada montante entre os irmãos (ordem do routing.dat)
+        ordem = np.argsort(dst, kind='stable')
+        tam = tamanho[src[ordem]]
+        acumulado = np.cumsum(tam) - tam
+        inicio_grupo = np.r_[True, dst[ordem][1:] != dst[ordem][:-1]] if len(ordem) else np.zeros(0, bool)
+        base = acumulado[np.flatnonzero(inicio_grupo)]
+        grupo = np.cumsum(inicio_grupo) - 1
+        deslocamento = np.zeros(n, dtype=np.int64)
+        deslocamento[src[ordem]] = acumulado - base[grupo]
+
+        jusante = np.full(n, -1, dtype=np.int64)
+        jusante[src] = dst
+
+        # exutórios em sequência, depois cada nível de jusante para montante
+        tin = np.zeros(n, dtype=np.int64)
+        raizes = np.flatnonzero(jusante < 0)
+        tin[raizes] = np.cumsum(tamanho[raizes]) - tamanho[raizes]
+        for nivel in range(t.n_levels - 1, -1, -1):
+            s, d = t.level_edges(nivel)
+            if len(s):
+                tin[s] = tin[d] + 1 + deslocamento[s]
+
+        self._tin = tin
+        self._size = tamanho
+        self._downstream = jusante
+        self._by_tin = np.argsort(tin)
+
+    def _build_bitsets(self):
+
+        t = self.topology
+        n = t.n_nodes
+        bits = np.zeros((n, (n + 7) // 8), dtype=np.uint8)
+        pos = np.arange(n)
+        bits[pos, pos >> 3] = np.uint8(128) >> (pos & 7).astype(np.uint8)
+
+        # ancestrais (incluindo o próprio nó) acumulados por níveis
+        for nivel, _, _ in t.levels():
+            s, d = t.level_edges(nivel)
+            if len(s):
+                np.bitwise_or.at(bits, d, bits[s])
+
+        self._bits = bits
+
+    def _ancestor_row(self, p):
+        return np.unpackbits(self._bits[p], count=self.topology.n_nodes).astype(bool)
+
+    def upstream(self, p, include_self=False):
+        if self.kind == 'interval':
+            a = self._tin[p] + (0 if include_self else 1)
+            return np.sort(self._by_tin[a:self._tin[p] + self._size[p]])
+        linha = self._ancestor_row(p)
+        linha[p] = include_self
+        return np.flatnonzero(linha)
+
+    def downstream(self, p, include_self=False):
+        if self.kind == 'interval':
+            caminho = [p] if include_self else []
+            q = self._downstream[p]
+            while q >= 0:
+                caminho.append(q)
+                q = self._downstream[q]
+            return np.sort(np.asarray(caminho, dtype=np.int64))
+        byte, bit = p >> 3, np.uint8(128) >> np.uint8(p & 7)
+        coluna = (self._bits[:, byte] & bit) != 0
+        coluna[p] = include_self
+        return np.flatnonzero(coluna)
+
+    def is_upstream(self, a, b):
+        # a estritamente a montante de b (vetorizado)
+        a = np.asarray(a)
+        b = np.asarray(b)
+        if self.kind == 'interval':
+            ta, tb = self._tin[a], self._tin[b]
+            return (ta > tb) & (ta < tb + self._size[b])
+        byte, bit = a >> 3, np.uint8(128) >> (a & 7).astype(np.uint8)
+        return ((self._bits[b, byte] & bit) != 0) & (a != b)
+
+    def count_upstream(self, mask, chunk=4096):
+        # quantos nós marcados existem estritamente a montante de cada nó
+        mask = np.asarray(mask, dtype=bool)
+        if self.kind == 'interval':
+            prefixo = np.r_[0, np.cumsum(mask[self._by_tin])]
+            return prefixo[self._tin + self._size] - prefixo[self._tin + 1]
+        n = len(mask)
+        marcados = np.packbits(mask)
+        contagem = np.empty(n, dtype=np.int64)
+        for i in range(0, n, chunk):
+            contagem[i:i + chunk] = np.bitwise_count(self._bits[i:i + chunk] & marcados).sum(axis=1, dtype=np.int64)
+        return contagem - mask
+
+    def sum_downstream(self, valores, chunk=4096):
+        # soma dos valores estritamente a jusante de cada nó
+        valores = np.asarray(valores, dtype=np.float64)
+        t = self.topology
+        if self.kind == 'interval':
+            acumulado = np.zeros(t.n_nodes)
+            for nivel in range(t.n_levels - 1, -1, -1):
+                s, d = t.level_edges(nivel)
+                if len(s):
+                    acumulado[s] = acumulado[d] + valores[d]
+            return acumulado
+        n = t.n_nodes
+        acumulado = np.zeros(n)
+        for i in range(0, n, chunk):
+            linhas = np.unpackbits(self._bits[i:i + chunk], axis=1, count=n)
+            acumulado += linhas.T.astype(np.float64) @ valores[i:i + chunk]
+        return acumulado - valores
+
+
+class CascadeAnalysis:
+
+    def __init__(self, topology, saida, storage_capacity, runoff_peak, spillway, params=None):
+
+        params = params or DEFAULT_PARAMS
+        self.topology = topology
+        self.index = ReachabilityIndex(topology)
+        self.rompeu = np.asarray(saida['rompeu'], dtype=bool)
+
+        # pico que cada nó receberia sem nenhuma ruptura a montante
+        sem_ruptura = route_arrays(
+            topology, np.zeros(topology.n_nodes), runoff_peak,
+            storage_capacity, np.full(topology.n_nodes, np.inf), params=params
+        )
+        self.rompe_isolado = params.coef_fenda * sem_ruptura['peak_in'] > spillway
+        self.induzida = self.rompeu & ~self.rompe_isolado
+
+        # volume liberado pela ruptura: v_out = v_in + capacidade
+        self.liberado = np.where(self.rompeu, storage_capacity, 0.0)
+
+        self.rupturas_montante = self.index.count_upstream(self.rompeu)
+        self.rupturas_desencadeadas = np.where(
+            self.rompeu, self.index.sum_downstream(self.induzida).astype(np.int64), 0
+        )
+        self.volume_adicional = np.where(
+            self.rompeu,
+            self.liberado + self.index.sum_downstream(np.where(self.induzida, self.liberado, 0.0)),
+            0.0
+        )
+
+    def causes(self, subasin_id, direct=False):
+
+        # rupturas a montante de uma ruptura induzida; direct=True fica só com as
+        # mais próximas (sem outra ruptura entre elas e o nó)
+        t = self.topology
+        p = int(t.index_of([subasin_id])[0])
+        if p < 0:
+            raise KeyError(f"Subbacia {subasin_id} não está na rede de drenagem.")
+        if not self.induzida[p]:
+            return t.node_ids[:0]
+
+        falhas = self.index.upstream(p)
+        falhas = falhas[self.rompeu[falhas]]
+        if direct and len(falhas):
+            cobertas = np.zeros(t.n_nodes, dtype=bool)
+            for w in falhas:
+                cobertas[self.index.upstream(w)] = True
+            falhas = falhas[~cobertas[falhas]]
+        return t.node_ids[falhas]
+
+    def triggered(self, subasin_id):
+        # rupturas induzidas a jusante de uma ruptura
+        t = self.topology
+        p = int(t.index_of([subasin_id])[0])
+        if p < 0:
+            raise KeyError(f"Subbacia {subasin_id} não está na rede de drenagem.")
+        if not self.rompeu[p]:
+            return t.node_ids[:0]
+        abaixo = self.index.downstream(p)
+        return t.node_ids[abaixo[self.induzida[abaixo]]]
+
+    def summary(self, subasin_ids):
+        ids = pd.Series(subasin_ids)
+        node_ids = self.topology.node_ids
+        return pd.DataFrame({
+            "subasin_id": ids,
+            "rompeu": map_node_values(ids, node_ids, self.rompeu),
+            "ruptura_induzida": map_node_values(ids, node_ids, self.induzida),
+            "rupturas_montante": map_node_values(ids, node_ids, self.rupturas_montante),
+            "rupturas_desencadeadas": map_node_values(ids, node_ids, self.rupturas_desencadeadas),
+            "volume_adicional_exutorio": map_node_values(ids, node_ids, self.volume_adicional)
+        })
+
+
+def cascade_attribution(df_reservoir, df_routing, df_runoff, topology=None, params=None):
+
+    if topology is None:
+        topology = compile_topology(df_routing)
+    df_merged = df_reservoir.merge(df_runoff, on='subasin_id', how='left')
+    runoff_volume, runoff_peak, storage_capacity, spillway = water_input_arrays(topology, df_merged)
+
+    saida = route_arrays(
+        topology, runoff_volume, runoff_peak, storage_capacity, spillway, params=params,
+        integer_fields=detect_integer_fields(df_merged)
+    )
+    analise = CascadeAnalysis(topology, saida, storage_capacity, runoff_peak, spillway, params)
+
+    return analise.summary(df_runoff["subasin_id"]), analise
@@ -0,0 +1,466 @@
+import argparse
+import json
+import sys
+import time
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+from data_utils import (
+    build_basin_model,
+    calculate_routing,
+    calculate_sediment_routing,
+    calculate_water_routing
+)
+from routing_engine import DEFAULT_PARAMS, compile_topology, node_array, upstream_sum, water_step
+from synthetic import generate_basin
+
+# engine de referência: o laço original sobre o grafo do networkx
+REFERENCE_ENGINE = 'networkx'
+
+# nome -> função(case, params) que devolve o result_discharge completo
+ENGINES = {}
+
+# até quantos nós de montante entram no relatório de divergência
+MAX_UPSTREAM_PATH = 50
+
+
+def register_engine(nome):
+
+    # decorador: a engine entra no harness com o nome dado
+    def decorador(funcao):
+        ENGINES[nome] = funcao
+        return funcao
+    return decorador
+
+
+def _sediment_args(case):
+    return (
+        case.get('sedyield.dat'), case.get('radio_mode', 1), case.get('sed_param.dat'),
+        case.get('density'), case.get('efficiency')
+    )
+
+
+def _two_pass(case, params, engine):
+    df_sedyield, radio_mode, df_sed_param, density, efficiency = _sediment_args(case)
+    result, G, ruptura_dict, sequencia, df_merged = calculate_water_routing(
+        case['reservoir.dat'], case['routing.dat'], case['runoff.dat'], engine=engine, params=params
+    )
+    if df_sedyield is None:
+        return result
+    return calculate_sediment_routing(
+        result, G, ruptura_dict, sequencia, df_sedyield, df_merged,
+        radio_mode, df_sed_param, density, efficiency, params=params
+    )
+
+
+@register_engine('networkx')
+def _engine_networkx(case, params):
+    return _two_pass(case, params, 'networkx')
+
+
+@register_engine('array')
+def _engine_array(case, params):
+    return _two_pass(case, params, 'array')
+
+
+@register_engine('fused')
+def _engine_fused(case, params):
+    return calculate_routing(
+        case['reservoir.dat'], case['routing.dat'], case['runoff.dat'], *_sediment_args(case), params=params
+    )[0]
+
+
+@register_engine('model')
+def _engine_model(case, params):
+    model = build_basin_model(case['reservoir.dat'], case['routing.dat'], case['runoff.dat'], *_sediment_args(case))
+    return calculate_routing(model, None, case['runoff.dat'], params=params)[0]
+
+
+@register_engine('parallel')
+def _engine_parallel(case, params):
+    return calculate_routing(
+        case['reservoir.dat'], case['routing.dat'], case['runoff.dat'], *_sediment_args(case),
+        params=params, processes=2
+    )[0]
+
+
+# ---------------------------------------------------------------------------
+# bacias de teste
+
+def _case(nome, dataframes, radio_mode=1, density=None, efficiency=None, sediment=True):
+    case = {'name': nome, 'radio_mode': radio_mode, 'density': density, 'efficiency': efficiency}
+    for arquivo in ('reservoir.dat', 'routing.dat', 'runoff.dat'):
+        case[arquivo] = dataframes[arquivo]
+    if sediment:
+        case['sedyield.dat'] = dataframes['sedyield.dat']
+        if radio_mode == 1:
+            case['sed_param.dat'] = dataframes['sed_param.dat']
+    return case
+
+
+def random_cases(n_cases, seed=0, min_nodes=50, max_nodes=2000):
+
+    # bacias sintéticas de formato, tamanho, taxa de ruptura e modo de
+    # sedimentos sorteados
+    rng = np.random.default_rng(seed)
+    casos = []
+    for k in range(n_cases):
+        n = int(rng.integers(min_nodes, max_nodes + 1))
+        branching = float(rng.choice([1.0, 1.5, 2.0, 4.0]))
+        n_outlets = int(rng.integers(1, max(2, n // 20)))
+        dataframes = generate_basin(
+            n, branching=branching, n_outlets=n_outlets,
+            failure_rate=float(rng.uniform(0.0, 0.6)), seed=int(rng.integers(2 ** 31))
+        )
+        modo = k % 3
+        casos.append(_case(
+            f'random-{k}', dataframes,
+            radio_mode=1 if modo == 0 else 2,
+            density=float(rng.uniform(1.2, 1.8)) if modo == 2 else None,
+            efficiency=float(rng.uniform(0.3, 0.9)) if modo == 2 else None,
+            sediment=modo != 1
+        ))
+    return casos
+
+
+def _boundary_spillways(dataframes, rng, params):
+
+    # vertedouro exatamente em coef_fenda * pico de entrada (não rompe, a
+    # comparação é estrita) ou um ulp abaixo/acima, nível a nível com as
+    # mesmas operações da propagação
+    reservatorios = dataframes['reservoir.dat']
+    runoff = dataframes['runoff.dat']
+    topology = compile_topology(dataframes['routing.dat'])
+
+    volume = node_array(topology, runoff['subasin_id'], runoff['runoff_volume'])
+    pico = node_array(topology, runoff['subasin_id'], runoff['runoff_peak_discharge'])
+    capacidade = node_array(topology, reservatorios['subasin_id'], reservatorios['water_storage_capacity'])
+
+    # volumes e capacidades do gerador são inteiros, como ints na referência
+    n = topology.n_nodes
+    lado = rng.integers(-1, 2, n)
+    vertedouro = np.empty(n)
+    volume_out = np.empty(n)
+    peak_out = np.empty(n)
+    volume_inteiro = np.empty(n, dtype=bool)
+    for nivel, a, b in topology.levels():
+        v_up, v_up_inteiro = upstream_sum(topology, nivel, volume_out, (b - a,), volume_inteiro)
+        v_in = volume[a:b] + v_up
+        p_in = pico[a:b] + upstream_sum(topology, nivel, peak_out, (b - a,))[0]
+        limite = params.coef_fenda * p_in
+        vertedouro[a:b] = np.where(
+            lado[a:b] < 0, np.nextafter(limite, -np.inf),
+            np.where(lado[a:b] > 0, np.nextafter(limite, np.inf), limite)
+        )
+        volume_out[a:b], peak_out[a:b], _ = water_step(v_in, p_in, capacidade[a:b], vertedouro[a:b], params)
+        volume_inteiro[a:b] = v_up_inteiro
+
+    posicoes = topology.index_of(reservatorios['subasin_id'])
+    return reservatorios.assign(spillway_discharge=vertedouro[posicoes])
+
+
+def adversarial_cases(seed=0, n_nodes=500, params=None):
+
+    params = params or DEFAULT_PARAMS
+    rng = np.random.default_rng(seed)
+
+    def base(**kwargs):
+        return generate_basin(n_nodes, seed=int(rng.integers(2 ** 31)), **kwargs)
+
+    casos = []
+
+    # limiar de ruptura no limite exato, em cadeia e em árvore larga
+    for forma, kwargs in (('chain', {'branching': 1.0}), ('bushy', {'branching': 3.0})):
+        dataframes = base(**kwargs)
+        dataframes['reservoir.dat'] = _boundary_spillways(dataframes, rng, params)
+        casos.append(_case(f'boundary-{forma}', dataframes))
+
+    # pico NaN: não rompe e contamina a jusante
+    dataframes = base(n_outlets=5)
+    runoff = dataframes['runoff.dat'].copy()
+    runoff.loc[rng.choice(len(runoff), 10, replace=False), 'runoff_peak_discharge'] = np.nan
+    dataframes['runoff.dat'] = runoff
+    casos.append(_case('nan-peak', dataframes))
+
+    # volume NaN: a truncagem para inteiro falha
+    dataframes = base(n_outlets=5)
+    runoff = dataframes['runoff.dat'].copy()
+    runoff.loc[rng.choice(len(runoff), 3, replace=False), 'runoff_volume'] = np.nan
+    dataframes['runoff.dat'] = runoff
+    casos.append(_case('nan-volume', dataframes))
+
+    # açudes isolados: linha no routing.dat só com -999 e nenhum afluente. A
+    # referência monta o grafo só com as arestas e não vê esses nós; eles ficam
+    # fora do runoff.dat (o resultado sai por ele) para que ela também rode
+    dataframes = base(n_outlets=3)
+    novos = np.arange(n_nodes, n_nodes + 5)
+    dataframes['reservoir.dat'] = pd.concat([dataframes['reservoir.dat'], pd.DataFrame({
+        'subasin_id': novos, 'water_storage_capacity': 1000, 'dam_height': 5.0, 'spillway_discharge': 1.0
+    })], ignore_index=True)
+    dataframes['sedyield.dat'] = pd.concat([dataframes['sedyield.dat'], pd.DataFrame({
+        'subasin_id': novos, 'sed_enter_volume': 10.0
+    })], ignore_index=True)
+    dataframes['sed_param.dat'] = pd.concat([dataframes['sed_param.dat'], pd.DataFrame({
+        'subasin_id': novos, 'sediment_density': 1.5, 'sediment_retention_efficiency': 0.5
+    })], ignore_index=True)
+    routing = dataframes['routing.dat']
+    dataframes['routing.dat'] = pd.concat([routing, pd.DataFrame({
+        'subasin_id': np.arange(len(routing) + 1, len(routing) + 6), 'upstream': novos, 'downstream': -999
+    })], ignore_index=True)
+    casos.append(_case('isolated', dataframes))
+
+    # açude fora do routing.dat
+    dataframes = base(n_outlets=3)
+    routing = dataframes['routing.dat']
+    fontes = np.setdiff1d(routing['upstream'], routing['downstream'])
+    dataframes['routing.dat'] = routing[routing['upstream'] != fontes[0]].reset_index(drop=True)
+    casos.append(_case('unrouted', dataframes))
+
+    # confluências com vários exutórios por nó e arestas repetidas
+    dataframes = base(branching=2.0, n_outlets=4)
+    routing = dataframes['routing.dat']
+    topology = compile_topology(routing)
+    nivel = np.repeat(np.arange(topology.n_levels), np.diff(topology.level_bounds))
+    extras = []
+    # níveis crescem para jusante: a aresta extra desce pelo menos um nível
+    for p in rng.choice(np.flatnonzero(nivel < topology.n_levels - 1), 30, replace=False):
+        q = rng.integers(topology.level_bounds[nivel[p] + 1], topology.n_nodes)
+        extras.append((topology.node_ids[p], topology.node_ids[q]))
+    repetidas = routing[routing['downstream'] != -999].sample(10, random_state=int(rng.integers(2 ** 31)))
+    dataframes['routing.dat'] = pd.concat([
+        routing,
+        pd.DataFrame(extras, columns=['upstream', 'downstream']),
+        repetidas[['upstream', 'downstream']]
+    ], ignore_index=True).assign(subasin_id=lambda df: np.arange(1, len(df) + 1))
+    casos.append(_case('dag', dataframes))
+
+    # truncagem e arredondamento: volumes quase inteiros, picos em x.xx5
+    dataframes = base(n_outlets=5)
+    runoff = dataframes['runoff.dat'].copy()
+    runoff['runoff_volume'] = runoff['runoff_volume'] + rng.choice([0.0, 0.999999, 1e-9, 0.5], len(runoff))
+    runoff['runoff_peak_discharge'] = np.floor(runoff['runoff_peak_discharge'] * 100) / 100 + 0.005
+    dataframes['runoff.dat'] = runoff
+    casos.append(_case('fractional', dataframes, radio_mode=2, density=1.5, efficiency=0.5))
+
+    # tudo zero: 0 > 0 não rompe; capacidade zero em quem rompe
+    dataframes = base(n_outlets=5)
+    dataframes['runoff.dat'] = dataframes['runoff.dat'].assign(runoff_volume=0, runoff_peak_discharge=0.0)
+    dataframes['reservoir.dat'] = dataframes['reservoir.dat'].assign(water_storage_capacity=0, spillway_discharge=0.0)
+    casos.append(_case('zeros', dataframes, sediment=False))
+
+    return casos
+
+
+# ---------------------------------------------------------------------------
+# comparação
+
+def _equal(a, b):
+    a = pd.Series(a)
+    b = pd.Series(b)
+    iguais = ((a == b) | (a.isna() & b.isna())).to_numpy(dtype=bool)
+    if a.dtype.kind == 'f' and b.dtype.kind == 'f':
+        # -0.0 e 0.0 saem diferentes no .dat
+        iguais = iguais & (np.signbit(a.to_numpy()) == np.signbit(b.to_numpy()))
+    return iguais
+
+
+def upstream_path(topology, subasin_id, limit=MAX_UPSTREAM_PATH):
+    # nós de montante em largura, do mais próximo ao mais distante
+    caminho = []
+    vistos = {subasin_id}
+    fila = deque([subasin_id])
+    while fila and len(caminho) < limit:
+        for up in topology.predecessors(fila.popleft()):
+            up = int(up)
+            if up not in vistos:
+                vistos.add(up)
+                caminho.append(up)
+                fila.append(up)
+    return caminho[:limit]
+
+
+def _value(v):
+    if pd.isna(v):
+        return None
+    return v.item() if hasattr(v, 'item') else v
+
+
+def first_divergence(reference, candidate, topology):
+
+    # primeiro nó divergente na ordem topológica: os de montante conferem, a
+    # causa está na conta local dele
+    if list(reference.columns) != list(candidate.columns):
+        return {'kind': 'columns', 'reference': list(reference.columns), 'candidate': list(candidate.columns)}
+    ids_ref = reference['subasin_id'].to_numpy()
+    ids_cand = candidate['subasin_id'].to_numpy()
+    if len(ids_ref) != len(ids_cand) or not np.array_equal(ids_ref, ids_cand):
+        return {'kind': 'rows', 'reference': len(ids_ref), 'candidate': len(ids_cand)}
+
+    diferentes = {
+        c: ~_equal(reference[c].to_numpy(), candidate[c].to_numpy())
+        for c in reference.columns if c != 'subasin_id'
+    }
+    linhas = np.flatnonzero(np.logical_or.reduce(list(diferentes.values()))) if diferentes else []
+    if len(linhas) == 0:
+        for c in reference.columns:
+            if reference[c].dtype != candidate[c].dtype:
+                return {
+                    'kind': 'dtype', 'column': c,
+                    'reference': str(reference[c].dtype), 'candidate': str(candidate[c].dtype)
+                }
+        return None
+
+    posicoes = topology.index_of(ids_ref[linhas]).astype(np.float64)
+    posicoes[posicoes < 0] = np.inf
+    linha = linhas[np.argmin(posicoes)]
+    no = int(ids_ref[linha])
+    colunas = [c for c, mascara in diferentes.items() if mascara[linha]]
+
+    esperado = {c: _value(reference[c].iloc[linha]) for c in colunas}
+    obtido = {c: _value(candidate[c].iloc[linha]) for c in colunas}
+
+    return {
+        'kind': 'values',
+        'subasin_id': no,
+        'columns': colunas,
+        'reference': esperado,
+        'candidate': obtido,
+        # diferença de uma unidade na última casa costuma ser empate de
+        # arredondamento; ruptura trocada com montante igual, limiar no limite
+        'abs_diff': {
+            c: abs(obtido[c] - esperado[c]) for c in colunas
+            if isinstance(esperado[c], (int, float)) and not isinstance(esperado[c], bool)
+            and isinstance(obtido[c], (int, float)) and not isinstance(obtido[c], bool)
+        },
+        'n_divergent_nodes': int(len(linhas)),
+        'upstream_path': upstream_path(topology, no) if topology.index_of([no])[0] >= 0 else []
+    }
+
+
+def _timed(funcao, repeat):
+    # melhor tempo entre repeat execuções; a exceção da primeira é devolvida
+    melhor = np.inf
+    resultado = None
+    for _ in range(repeat):
+        inicio = time.perf_counter()
+        try:
+            resultado = funcao()
+        except Exception as e:
+            return None, e, np.nan
+        melhor = min(melhor, time.perf_counter() - inicio)
+    return resultado, None, melhor
+
+
+def check_case(case, engines=None, reference=REFERENCE_ENGINE, repeat=3, params=None):
+
+    # roda a referência e cada engine no mesmo caso; uma linha por engine
+    params = params or DEFAULT_PARAMS
+    engines = list(engines or ENGINES)
+    n_nodes = len(case['reservoir.dat'])
+    topology = compile_topology(case['routing.dat'])
+
+    esperado, erro_ref, tempo_ref = _timed(lambda: ENGINES[reference](case, params), repeat)
+    linhas = []
+    for nome in engines:
+        if nome == reference:
+            obtido, erro, tempo = esperado, erro_ref, tempo_ref
+        else:
+            obtido, erro, tempo = _timed(lambda: ENGINES[nome](case, params), repeat)
+
+        divergencia = None
+        if erro_ref is not None and erro is not None:
+            status = 'both-error'
+        elif erro_ref is not None:
+            status = 'reference-error'
+        elif erro is not None:
+            status = 'error'
+        else:
+            divergencia = first_divergence(esperado, obtido, topology)
+            status = 'ok' if divergencia is None else 'mismatch'
+
+        linhas.append({
+            'case': case['name'],
+            'engine': nome,
+            'status': status,
+            'n_nodes': n_nodes,
+            'seconds': tempo,
+            'nodes_per_s': n_nodes / tempo if tempo and np.isfinite(tempo) else np.nan,
+            'error': None if erro is None else f'{type(erro).__name__}: {erro}',
+            'reference_error': None if erro_ref is None else f'{type(erro_ref).__name__}: {erro_ref}',
+            'divergence': divergencia
+        })
+    return linhas
+
+
+def run_conformance(engines=None, cases=None, n_random=20, seed=0, repeat=3, params=None,
+                    reference=REFERENCE_ENGINE):
+
+    if cases is None:
+        cases = adversarial_cases(seed, params=params) + random_cases(n_random, seed)
+    linhas = []
+    for case in cases:
+        linhas.extend(check_case(case, engines, reference, repeat, params))
+    return pd.DataFrame(linhas)
+
+
+# um caso em que só a referência falha não foi comparado: também é falha
+FAILING_STATUS = ('mismatch', 'error', 'reference-error')
+
+
+def throughput_table(report):
+    # nós por segundo, um caso por linha e uma engine por coluna
+    return report.pivot(index='case', columns='engine', values='nodes_per_s').reindex(report['case'].unique())
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(
+        prog='conformance',
+        description='Confere engines de propagação contra a implementação de referência.'
+    )
+    parser.add_argument('--engines', nargs='+', choices=sorted(ENGINES), default=sorted(ENGINES))
+    parser.add_argument('--reference', choices=sorted(ENGINES), default=REFERENCE_ENGINE,
+                        help='engine tomada como verdade (padrão: o laço original do networkx)')
+    parser.add_argument('--random', dest='n_random', type=int, default=20, help='bacias aleatórias')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--json', dest='json_path', help='grava o relatório completo em JSON')
+    args = parser.parse_args(argv)
+
+    engines = [args.reference] + [e for e in args.engines if e != args.reference]
+    report = run_conformance(
+        engines, n_random=args.n_random, seed=args.seed, repeat=args.repeat, reference=args.reference
+    )
+
+    with pd.option_context('display.width', 200, 'display.max_rows', None, 'display.float_format', '{:,.0f}'.format):
+        print(throughput_table(report))
+
+    problemas = report[report['status'].isin(FAILING_STATUS)]
+    # both-error conta como conformidade: as duas rejeitam a entrada
+    for _, linha in report[~report['status'].isin(['ok', 'both-error'])].iterrows():
+        print(f"\n{linha['case']} / {linha['engine']}: {linha['status']}")
+        if isinstance(linha['reference_error'], str):
+            print(f"  referência: {linha['reference_error']}")
+        if isinstance(linha['error'], str) and linha['engine'] != args.reference:
+            print(f"  engine: {linha['error']}")
+        if isinstance(linha['divergence'], dict):
+            print('  ' + json.dumps(linha['divergence'], ensure_ascii=False, default=str))
+
+    if args.json_path:
+        report.to_json(args.json_path, orient='records', force_ascii=False, indent=2)
+
+    print(f"\n{len(problemas)} falha(s) em {len(report)} execuções", file=sys.stderr)
+    if len(problemas):
+        engines_com_falha = sorted(set(problemas['engine']) - {args.reference})
+        print(
+            f"Engines com falha: {', '.join(engines_com_falha) or args.reference}. "
+            "Uma série com engines falhando não pode ser publicada.",
+            file=sys.stderr
+        )
+    return 1 if len(problemas) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,231 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from data_utils import FILE_SCHEMAS, clean_dataframe_columns, load_dat_file
+from instrumentation import count, stage
+from routing_engine import BasinTopology, compile_topology
+
+logger = logging.getLogger(__name__)
+
+CACHE_VERSION = 1
+DEFAULT_MAX_BYTES = 1024 ** 3
+
+
+def default_cache_dir():
+    return os.environ.get(
+        'BASINFLOW_CACHE_DIR',
+        os.path.join(os.path.expanduser('~'), '.cache', 'basinflow')
+    )
+
+
+def file_content_hash(file_path):
+    h = hashlib.blake2b(digest_size=20)
+    with open(file_path, 'rb') as f:
+        for bloco in iter(lambda: f.read(1 << 20), b''):
+            h.update(bloco)
+    return h.hexdigest()
+
+
+def _function_name(funcao):
+    return f'{getattr(funcao, "__module__", "")}.{getattr(funcao, "__qualname__", repr(funcao))}'
+
+
+def _entry_key(file_path, schema_config, clean_function=clean_dataframe_columns):
+    # a função de limpeza muda o DataFrame gravado, então entra na chave
+    chave = json.dumps([
+        CACHE_VERSION, os.path.abspath(file_path), schema_config["names"], schema_config.get("decimal", "."),
+        _function_name(clean_function)
+    ])
+    return hashlib.blake2b(chave.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def _read_meta(entry_dir):
+    try:
+        with open(os.path.join(entry_dir, 'meta.json'), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_meta(entry_dir, meta):
+    tmp = os.path.join(entry_dir, 'meta.json.tmp')
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+    os.replace(tmp, os.path.join(entry_dir, 'meta.json'))
+
+
+def _load_entry(entry_dir, meta, mmap=True):
+    colunas = {}
+    for i, nome in enumerate(meta["columns"]):
+        colunas[nome] = np.asarray(np.load(
+            os.path.join(entry_dir, f'{i}.npy'),
+            mmap_mode='c' if mmap else None
+        ))
+    # copy=False mantém as colunas como memmap, sem copiar para a memória;
+    # o mapeamento copy-on-write deixa o DataFrame gravável como o lido do
+    # .dat, e as páginas alteradas ficam só neste processo, sem tocar o cache
+    return pd.DataFrame(colunas, copy=False)
+
+
+def _store_entry(cache_dir, entry_dir, df, meta):
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix='.tmp-', dir=cache_dir)
+    try:
+        for i, nome in enumerate(df.columns):
+            np.save(os.path.join(tmp_dir, f'{i}.npy'), df[nome].to_numpy())
+        _write_meta(tmp_dir, meta)
+        if os.path.isdir(entry_dir):
+            shutil.rmtree(entry_dir, ignore_errors=True)
+        os.replace(tmp_dir, entry_dir)
+    except OSError:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+
+def _entry_bytes(entry_dir):
+    total = 0
+    for nome in os.listdir(entry_dir):
+        try:
+            total += os.path.getsize(os.path.join(entry_dir, nome))
+        except OSError:
+            pass
+    return total
+
+
+def _entries(cache_dir):
+    if not os.path.isdir(cache_dir):
+        return []
+    entradas = []
+    for nome in os.listdir(cache_dir):
+        entry_dir = os.path.join(cache_dir, nome)
+        if nome.startswith('.') or not os.path.isdir(entry_dir):
+            continue
+        try:
+            acesso = os.path.getmtime(os.path.join(entry_dir, 'meta.json'))
+        except OSError:
+            acesso = 0.0
+        entradas.append((acesso, entry_dir, _entry_bytes(entry_dir)))
+    return entradas
+
+
+def cache_size(cache_dir=None):
+    cache_dir = cache_dir or default_cache_dir()
+    return sum(tamanho for _, _, tamanho in _entries(cache_dir))
+
+
+def evict_cache(cache_dir=None, max_bytes=DEFAULT_MAX_BYTES):
+    cache_dir = cache_dir or default_cache_dir()
+
+    # remove as entradas usadas há mais tempo até caber no limite
+    entradas = sorted(_entries(cache_dir))
+    total = sum(tamanho for _, _, tamanho in entradas)
+    removidas = 0
+    for _, entry_dir, tamanho in entradas:
+        if total <= max_bytes:
+            break
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        total -= tamanho
+        removidas += 1
+    return removidas
+
+
+def purge_cache(cache_dir=None):
+    cache_dir = cache_dir or default_cache_dir()
+    if os.path.isdir(cache_dir):
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+def load_dat_file_cached(
+    file_path,
+    schema_config,
+    clean_function=clean_dataframe_columns,
+    cache_dir=None,
+    max_bytes=DEFAULT_MAX_BYTES,
+    mmap=True):
+
+    cache_dir = cache_dir or default_cache_dir()
+    entry_dir = os.path.join(cache_dir, _entry_key(file_path, schema_config, clean_function))
+
+    stat = os.stat(file_path)
+    meta = _read_meta(entry_dir)
+
+    if meta is not None and meta["size"] == stat.st_size:
+        if meta["mtime_ns"] == stat.st_mtime_ns:
+            valido = True
+        else:
+            # arquivo tocado mas talvez com o mesmo conteúdo
+            valido = meta["hash"] == file_content_hash(file_path)
+            if valido:
+                meta["mtime_ns"] = stat.st_mtime_ns
+        if valido:
+            try:
+                with stage('cache_load'):
+                    df = _load_entry(entry_dir, meta, mmap)
+                _write_meta(entry_dir, meta)  # marca o último acesso
+                count('rows_read', len(df))
+                count('cache_hits')
+                logger.info('Arquivo %s carregado do cache', file_path)
+                return df
+            except (OSError, ValueError):
+                logger.warning('Entrada de cache corrompida para %s', file_path)
+
+    conteudo = file_content_hash(file_path)
+    df = load_dat_file(file_path, schema_config, clean_function)
+
+    if any(df[col].dtype == object for col in df.columns):
+        return df
+
+    meta = {
+        "version": CACHE_VERSION,
+        "source": os.path.abspath(file_path),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "hash": conteudo,
+        "columns": list(df.columns)
+    }
+    try:
+        _store_entry(cache_dir, entry_dir, df, meta)
+        evict_cache(cache_dir, max_bytes)
+    except OSError:
+        logger.warning('Não foi possível gravar o cache de %s', file_path)
+
+    return df
+
+
+def topology_sidecar_path(routing_path):
+    return routing_path + '.topology.npz'
+
+
+def load_topology_cached(routing_path, clean_function=clean_dataframe_columns):
+
+    # a topologia compilada fica ao lado do routing.dat e só vale para o
+    # conteúdo exato do arquivo que a gerou
+    sidecar = topology_sidecar_path(routing_path)
+    conteudo = file_content_hash(routing_path)
+
+    if os.path.exists(sidecar):
+        try:
+            topology = BasinTopology.load(sidecar, source_hash=conteudo)
+            logger.info('Topologia de %s carregada de %s', routing_path, sidecar)
+            return topology
+        except (OSError, ValueError, KeyError) as e:
+            logger.info('Recompilando topologia de %s: %s', routing_path, e)
+
+    df_routing = load_dat_file(routing_path, FILE_SCHEMAS["routing.dat"], clean_function)
+    topology = compile_topology(df_routing)
+
+    try:
+        tmp = sidecar + '.tmp'
+        topology.save(tmp, source_hash=conteudo)
+        os.replace(tmp, sidecar)
+    except OSError:
+        logger.warning('Não foi possível gravar a topologia em %s', sidecar)
+
+    return topology
@@ -2,6 +2,18 @@ import pandas as pd
 import numpy as np
 import networkx as nx
 
+from instrumentation import count, set_counter, stage, staged
+from routing_engine import (
+    DEFAULT_PARAMS,
+    BasinModel,
+    BasinTopology,
+    compile_topology,
+    eroded_volume,
+    node_array,
+    route_arrays,
+    route_sediment_arrays
+)
+
 def clean_dataframe_columns(df, exclude_cols=None):
     if exclude_cols is None:
         exclude_cols = []
@@ -33,7 +45,7 @@ FILE_SCHEMAS = {
     },
     "runoff.dat": {
         "names": ['subasin_id', 'runoff_volume', 'runoff_peak_discharge'],
-        "decimal": "."
+        "decimal": ","
     },
     "sedyield.dat": {
         "names": ['subasin_id', 'sed_enter_volume'],
@@ -42,22 +54,46 @@ FILE_SCHEMAS = {
     "sed_param.dat": {
         "names": ['subasin_id','sediment_density', 'sediment_retention_efficiency'],
         "decimal": "."
+    },
+    # formato longo: uma linha por (subbacia, evento), eventos em sequência
+    "runoff_events.dat": {
+        "names": ['subasin_id', 'event', 'runoff_volume', 'runoff_peak_discharge'],
+        "decimal": ","
     }
 }
 
-def load_dat_file(file_path, schema_config, clean_function):
-
-    qtd_colunas_esperadas = len(schema_config["names"])
-
-    df = pd.read_table(
+def _read_dat_csv(file_path, schema_config, **kwargs):
+    # leitor em C: pula as duas linhas de cabeçalho do WASA, tira as aspas e
+    # converte "8,22" direto com o decimal declarado no schema
+    return pd.read_csv(
         file_path,
         encoding='latin1',
-        skiprows=1,
+        skiprows=2,
+        header=None,
         sep='\t',
         quotechar='"',
-        engine='python'
+        decimal=schema_config.get("decimal", "."),
+        float_precision='round_trip',
+        engine='c',
+        **kwargs
     )
 
+def load_dat_file(file_path, schema_config, clean_function=clean_dataframe_columns):
+    with stage('file_parse'):
+        df = _read_dat_csv(file_path, schema_config)
+    count('rows_read', len(df))
+    return _finish_dat_frame(df, schema_config, clean_function)
+
+def iter_dat_chunks(file_path, schema_config, chunksize=100000, clean_function=clean_dataframe_columns):
+    # mesmo tratamento de load_dat_file, em blocos de linhas
+    with _read_dat_csv(file_path, schema_config, chunksize=chunksize) as leitor:
+        for bloco in leitor:
+            yield _finish_dat_frame(bloco, schema_config, clean_function)
+
+def _finish_dat_frame(df, schema_config, clean_function):
+
+    qtd_colunas_esperadas = len(schema_config["names"])
+
     if df.shape[1] != qtd_colunas_esperadas:
         raise ValueError(
             f"O arquivo tem {df.shape[1]} colunas, "
@@ -66,68 +102,95 @@ def load_dat_file(file_path, schema_config, clean_function):
 
     df.columns = schema_config["names"]
 
-    df = clean_function(df, exclude_cols=['subasin_id'])
+    # colunas que não viraram número (decimal diferente do schema, lixo no
+    # arquivo) passam pela limpeza antiga
+    colunas_texto = [
+        col for col in df.columns
+        if col != 'subasin_id' and not pd.api.types.is_numeric_dtype(df[col])
+    ]
+    if colunas_texto:
+        with stage('column_cleaning'):
+            df = clean_function(
+                df,
+                exclude_cols=[col for col in df.columns if col not in colunas_texto]
+            )
 
     return df
 
-def calculate_water_routing(df_reservoir, df_routing, df_runoff):
+def calculate_water_routing(df_reservoir, df_routing, df_runoff, engine='networkx', topology=None, params=None):
+
+    params = params or DEFAULT_PARAMS
+
+    # um BasinModel no lugar do df_reservoir já traz vetores e topologia
+    if isinstance(df_reservoir, BasinModel):
+        return _calculate_water_routing_model(df_reservoir, df_runoff, params)
+
+    # uma topologia já compilada dispensa o routing.dat e usa a engine de arrays
+    if engine == 'array' or topology is not None:
+        return _calculate_water_routing_array(df_reservoir, df_routing, df_runoff, topology, params)
+    if engine != 'networkx':
+        raise ValueError(f"Engine de roteamento desconhecida: {engine}")
 
     df_routing = df_routing.copy()
     df_routing['downstream'] = df_routing['downstream'].replace(-999, np.nan)
 
-    df_merged = df_reservoir.merge(df_runoff, on='subasin_id', how='left')
-    node_attrs = df_merged.set_index('subasin_id').to_dict(orient='index')
+    with stage('merge'):
+        df_merged = df_reservoir.merge(df_runoff, on='subasin_id', how='left')
+        node_attrs = df_merged.set_index('subasin_id').to_dict(orient='index')
 
-    df_edges = df_routing.dropna(subset=['downstream']).copy()
-    df_edges['upstream'] = df_edges['upstream'].astype(int)
-    df_edges['downstream'] = df_edges['downstream'].astype(int)
+    with stage('graph_build'):
+        df_edges = df_routing.dropna(subset=['downstream']).copy()
+        df_edges['upstream'] = df_edges['upstream'].astype(int)
+        df_edges['downstream'] = df_edges['downstream'].astype(int)
 
-    G = nx.from_pandas_edgelist(
-        df_edges,
-        source='upstream',
-        target='downstream',
-        create_using=nx.DiGraph()
-    )
+        G = nx.from_pandas_edgelist(
+            df_edges,
+            source='upstream',
+            target='downstream',
+            create_using=nx.DiGraph()
+        )
 
-    nx.set_node_attributes(G, node_attrs)
+        nx.set_node_attributes(G, node_attrs)
 
-    sequencia = list(nx.topological_sort(G))
+    with stage('topological_sort'):
+        sequencia = list(nx.topological_sort(G))
 
-    peak_in = {}
-    peak_out = {}
-    volume_in = {}
-    volume_out = {}
-    ruptura_dict = {}
+    with stage('water_routing'):
+        peak_in = {}
+        peak_out = {}
+        volume_in = {}
+        volume_out = {}
+        ruptura_dict = {}
 
-    for i in sequencia:
+        for i in sequencia:
 
-        upstreams = list(G.predecessors(i))
+            upstreams = list(G.predecessors(i))
 
-        if upstreams:
-            volume_in[i] = (
-                G.nodes[i]['runoff_volume'] +
-                sum(volume_out[up] for up in upstreams)
-            )
-            peak_in[i] = (
-                G.nodes[i]['runoff_peak_discharge'] +
-                sum(peak_out[up] for up in upstreams)
-            )
-        else:
-            volume_in[i] = G.nodes[i]['runoff_volume']
-            peak_in[i] = G.nodes[i]['runoff_peak_discharge']
+            if upstreams:
+                volume_in[i] = (
+                    G.nodes[i]['runoff_volume'] +
+                    sum(volume_out[up] for up in upstreams)
+                )
+                peak_in[i] = (
+                    G.nodes[i]['runoff_peak_discharge'] +
+                    sum(peak_out[up] for up in upstreams)
+                )
+            else:
+                volume_in[i] = G.nodes[i]['runoff_volume']
+                peak_in[i] = G.nodes[i]['runoff_peak_discharge']
 
-        spillway = G.nodes[i]['spillway_discharge']
-        storage_capacity = G.nodes[i]['water_storage_capacity']
+            spillway = G.nodes[i]['spillway_discharge']
+            storage_capacity = G.nodes[i]['water_storage_capacity']
 
-        rompeu = (0.707121014402343 * peak_in[i] > spillway)
-        ruptura_dict[i] = rompeu
+            rompeu = (params.coef_fenda * peak_in[i] > spillway)
+            ruptura_dict[i] = rompeu
 
-        if rompeu:
-            volume_out[i] = volume_in[i] + storage_capacity
-            peak_out[i] = 0.0344 * (volume_out[i] ** 0.6527)
-        else:
-            volume_out[i] = volume_in[i]
-            peak_out[i] = 0.707121014402343 * peak_in[i]
+            if rompeu:
+                volume_out[i] = volume_in[i] + storage_capacity
+                peak_out[i] = params.coef_pico_ruptura * (volume_out[i] ** params.exp_pico_ruptura)
+            else:
+                volume_out[i] = volume_in[i]
+                peak_out[i] = params.coef_fenda * peak_in[i]
 
     result = pd.DataFrame({
         "subasin_id": df_runoff["subasin_id"],
@@ -138,8 +201,193 @@ def calculate_water_routing(df_reservoir, df_routing, df_runoff):
         "rompeu": df_runoff["subasin_id"].map(ruptura_dict)
     })
 
+    set_counter('nodes', G.number_of_nodes())
+    set_counter('edges', G.number_of_edges())
+    set_counter('failures', int(sum(ruptura_dict.values())))
+
     return result, G, ruptura_dict, sequencia, df_merged
 
+def _calculate_water_routing_array(df_reservoir, df_routing, df_runoff, topology=None, params=None):
+
+    with stage('merge'):
+        df_merged = df_reservoir.merge(df_runoff, on='subasin_id', how='left')
+
+    if topology is None:
+        topology = compile_topology(df_routing)
+    with stage('water_routing'):
+        saida = route_arrays(
+            topology, *water_input_arrays(topology, df_merged), params=params,
+            integer_fields=detect_integer_fields(df_merged)
+        )
+    set_counter('failures', int(saida['rompeu'].sum()))
+
+    result = build_water_result(df_runoff, topology.node_ids, saida)
+
+    ruptura_dict = dict(zip(topology.node_ids.tolist(), saida['rompeu'].tolist()))
+
+    return result, topology, ruptura_dict, topology.sequence(), df_merged
+
+def _calculate_water_routing_model(model, df_runoff=None, params=None):
+
+    # o modelo ocupa as posições de G e df_merged para calculate_sediment_routing
+    with stage('water_routing'):
+        saida = model.route(params, sediment=False)
+    set_counter('failures', int(saida['rompeu'].sum()))
+    result = build_water_result(_model_rows(model, df_runoff), model.node_ids, saida)
+    ruptura_dict = dict(zip(model.node_ids.tolist(), saida['rompeu'].tolist()))
+
+    return result, model, ruptura_dict, model.topology.sequence(), model
+
+def _model_rows(model, df_runoff=None):
+    if df_runoff is not None:
+        return df_runoff
+    return pd.DataFrame({"subasin_id": model.row_ids})
+
+def water_input_arrays(topology, df_merged):
+
+    ids = df_merged['subasin_id']
+
+    return (
+        node_array(topology, ids, df_merged['runoff_volume']),
+        node_array(topology, ids, df_merged['runoff_peak_discharge']),
+        node_array(topology, ids, df_merged['water_storage_capacity']),
+        node_array(topology, ids, df_merged['spillway_discharge'])
+    )
+
+def detect_integer_fields(df_merged, runoff_volume=None):
+
+    # colunas inteiras do .dat viram int do Python na engine do networkx
+    colunas = {
+        'runoff_volume': df_merged['runoff_volume'] if runoff_volume is None else runoff_volume,
+        'storage_capacity': df_merged['water_storage_capacity']
+    }
+    return tuple(nome for nome, coluna in colunas.items() if pd.api.types.is_integer_dtype(coluna))
+
+def map_node_values(ids, node_ids, valores):
+    return ids.map(pd.Series(valores, index=node_ids))
+
+def build_water_result(df_runoff, node_ids, saida):
+
+    ids = df_runoff["subasin_id"]
+
+    return pd.DataFrame({
+        "subasin_id": ids,
+        "volume_entrada": map_node_values(ids, node_ids, saida['volume_in']).astype(int),
+        "volume_total": map_node_values(ids, node_ids, saida['volume_out']).astype(int),
+        "vazão_de_entrada": map_node_values(ids, node_ids, saida['peak_in']).round(2),
+        "vazão_de_saida": map_node_values(ids, node_ids, saida['peak_out']).round(2),
+        "rompeu": map_node_values(ids, node_ids, saida['rompeu'])
+    })
+
+def load_runoff_ensemble(file_paths, subasin_ids=None):
+
+    frames = [
+        load_dat_file(path, FILE_SCHEMAS["runoff.dat"], clean_dataframe_columns)
+        for path in file_paths
+    ]
+
+    if subasin_ids is None:
+        subasin_ids = frames[0]['subasin_id']
+    ids = pd.Index(subasin_ids)
+
+    def coluna(df, nome):
+        serie = df.drop_duplicates('subasin_id', keep='last').set_index('subasin_id')[nome]
+        return serie.reindex(ids).to_numpy(dtype=np.float64)
+
+    runoff_volume = np.column_stack([coluna(df, 'runoff_volume') for df in frames])
+    runoff_peak = np.column_stack([coluna(df, 'runoff_peak_discharge') for df in frames])
+
+    # volumes inteiros em todos os arquivos seguem inteiros, como no .dat
+    if all(pd.api.types.is_integer_dtype(df['runoff_volume']) for df in frames) and not np.isnan(runoff_volume).any():
+        runoff_volume = runoff_volume.astype(np.int64)
+
+    return ids.to_numpy(), runoff_volume, runoff_peak
+
+def calculate_ensemble_routing(
+    df_reservoir,
+    df_routing,
+    runoff_volume=None,
+    runoff_peak_discharge=None,
+    subasin_ids=None,
+    runoff_files=None,
+    topology=None,
+    params=None,
+    processes=None,
+    buffers=None):
+
+    # cada coluna das matrizes de escoamento (N x S) é um cenário; a linha k
+    # corresponde a subasin_ids[k] (por padrão, a ordem do reservoir.dat).
+    # Com processes > 1, sub-bacias e blocos de cenários vão para workers que
+    # anexam as matrizes em memória compartilhada (buffers: SharedArrays do
+    # chamador, que controla a vida dos segmentos)
+    if runoff_files is not None:
+        subasin_ids, runoff_volume, runoff_peak_discharge = load_runoff_ensemble(runoff_files, subasin_ids)
+    elif subasin_ids is None:
+        subasin_ids = df_reservoir['subasin_id'].to_numpy()
+
+    inteiros = detect_integer_fields(df_reservoir, np.asarray(runoff_volume))
+    runoff_volume = np.asarray(runoff_volume, dtype=np.float64)
+    runoff_peak_discharge = np.asarray(runoff_peak_discharge, dtype=np.float64)
+    if runoff_volume.ndim == 1:
+        runoff_volume = runoff_volume[:, None]
+    if runoff_peak_discharge.ndim == 1:
+        runoff_peak_discharge = runoff_peak_discharge[:, None]
+
+    if runoff_volume.shape != runoff_peak_discharge.shape or runoff_volume.shape[0] != len(subasin_ids):
+        raise ValueError(
+            f"Matrizes de escoamento {runoff_volume.shape} e {runoff_peak_discharge.shape} "
+            f"incompatíveis com {len(subasin_ids)} subbacias."
+        )
+
+    if topology is None:
+        topology = compile_topology(df_routing)
+    ids_reservatorio = df_reservoir['subasin_id']
+
+    entradas = {
+        'runoff_volume': node_array(topology, subasin_ids, runoff_volume),
+        'runoff_peak': node_array(topology, subasin_ids, runoff_peak_discharge),
+        'storage_capacity': node_array(topology, ids_reservatorio, df_reservoir['water_storage_capacity']),
+        'spillway': node_array(topology, ids_reservatorio, df_reservoir['spillway_discharge'])
+    }
+    if processes is not None and processes > 1:
+        from parallel import route_arrays_parallel
+        saida = route_arrays_parallel(
+            topology, processes, params=params, buffers=buffers, integer_fields=inteiros, **entradas
+        )
+    else:
+        saida = route_arrays(topology, **entradas, params=params, integer_fields=inteiros)
+
+    pos = topology.index_of(subasin_ids)
+    faltando = pos < 0
+
+    def por_linha(valores, fill=np.nan):
+        linhas = valores[np.where(faltando, 0, pos)]
+        if faltando.any():
+            linhas = linhas.astype(np.float64) if fill is np.nan else linhas
+            linhas[faltando] = fill
+        return linhas
+
+    cenarios = {
+        "subasin_id": np.asarray(subasin_ids),
+        "volume_entrada": por_linha(saida['volume_in']),
+        "volume_total": por_linha(saida['volume_out']),
+        "vazão_de_entrada": por_linha(saida['peak_in']),
+        "vazão_de_saida": por_linha(saida['peak_out']),
+        "rompeu": por_linha(saida['rompeu'], fill=False)
+    }
+
+    resumo = pd.DataFrame({
+        "subasin_id": cenarios["subasin_id"],
+        "probabilidade_ruptura": cenarios["rompeu"].mean(axis=1),
+        "volume_total_medio": cenarios["volume_total"].mean(axis=1),
+        "volume_total_max": cenarios["volume_total"].max(axis=1),
+        "vazão_de_saida_media": cenarios["vazão_de_saida"].mean(axis=1),
+        "vazão_de_saida_max": cenarios["vazão_de_saida"].max(axis=1)
+    })
+
+    return resumo, cenarios, topology
+
+@staged('sediment_routing')
 def calculate_sediment_routing(
     result_discharge,
     G,
@@ -150,15 +398,35 @@ def calculate_sediment_routing(
     radio_mode,
     df_sed_param=None,
     density_manual=None,
-    efficiency_manual=None):
+    efficiency_manual=None,
+    params=None):
+
+    params = params or DEFAULT_PARAMS
+
+    if isinstance(G, BasinModel):
+        return _calculate_sediment_routing_model(result_discharge, G, ruptura_dict, params)
+
+    if isinstance(G, BasinTopology):
+        return _calculate_sediment_routing_array(
+            result_discharge,
+            G,
+            ruptura_dict,
+            df_sedyield,
+            df_merged,
+            radio_mode,
+            df_sed_param,
+            density_manual,
+            efficiency_manual,
+            params
+        )
 
     # adiciona atributos de sedimento no grafo
     sed_attrs = df_sedyield.set_index('subasin_id').to_dict(orient='index')
     nx.set_node_attributes(G, sed_attrs)
 
-    pm_fenda = 0.842584358697712
-    m = 0.0261
-    n = 0.769
+    pm_fenda = params.pm_fenda
+    m = params.m_erosao
+    n = params.n_erosao
 
     default_density = density_manual if density_manual else 1.5
     default_efficiency = efficiency_manual if efficiency_manual else 0.50
@@ -177,13 +445,15 @@ def calculate_sediment_routing(
         density_map = {}
         efficiency_map = {}
 
-    sedimentos_discharge = pd.DataFrame()
-    sedimentos_discharge["subasin_id"] = result_discharge["subasin_id"]
+    sedimentos_discharge = _eroded_sediment_frame(result_discharge, df_merged, pm_fenda, m, n)
 
-    sedimentos_discharge['volume_sedimento_erodido'] = (
-        result_discharge['rompeu'] * m *
-        (result_discharge['volume_total'] * pm_fenda * df_merged['dam_height']) ** n
-    ).round(2)
+    # primeiro volume erodido de cada subbacia, sem varrer o DataFrame a cada nó
+    erodido_map = (
+        sedimentos_discharge
+        .drop_duplicates('subasin_id')
+        .set_index('subasin_id')['volume_sedimento_erodido']
+        .to_dict()
+    )
 
     sed_in = {}
     sed_out = {}
@@ -207,10 +477,7 @@ def calculate_sediment_routing(
             sed_in[i] = sed_local
 
         if ruptura_dict[i]:
-            vol_erodido = sedimentos_discharge.loc[
-                sedimentos_discharge['subasin_id'] == i,
-                'volume_sedimento_erodido'
-            ].values[0]
+            vol_erodido = erodido_map[i]
 
             massa_erodida = vol_erodido * current_density
             sed_out[i] = sed_in[i] + massa_erodida
@@ -230,4 +497,271 @@ def calculate_sediment_routing(
         on='subasin_id'
     )
 
+def _eroded_sediment_frame(result_discharge, df_merged, pm_fenda, m, n):
+
+    sedimentos_discharge = pd.DataFrame()
+    sedimentos_discharge["subasin_id"] = result_discharge["subasin_id"]
+
+    sedimentos_discharge['volume_sedimento_erodido'] = (
+        result_discharge['rompeu'] * m *
+        (result_discharge['volume_total'] * pm_fenda * df_merged['dam_height']) ** n
+    ).round(2)
+
+    return sedimentos_discharge
+
+def sediment_parameter_arrays(topology, radio_mode, df_sed_param, density_manual, efficiency_manual):
+
+    default_density = density_manual if density_manual else 1.5
+    default_efficiency = efficiency_manual if efficiency_manual else 0.50
+
+    if radio_mode == 1:
+        ids = df_sed_param['subasin_id']
+        density = node_array(topology, ids, df_sed_param['sediment_density'], fill=default_density)
+        efficiency = node_array(topology, ids, df_sed_param['sediment_retention_efficiency'], fill=default_efficiency)
+    else:
+        density = np.full(topology.n_nodes, default_density, dtype=np.float64)
+        efficiency = np.full(topology.n_nodes, default_efficiency, dtype=np.float64)
+
+    return density, efficiency
+
+def _add_sediment_columns(result_discharge, sedimentos_discharge, node_ids, sed_in, sed_out):
+
+    ids = sedimentos_discharge['subasin_id']
+
+    sedimentos_discharge['sedimento_afluente'] = map_node_values(ids, node_ids, sed_in).round(2)
+    sedimentos_discharge['sedimento_efluente'] = map_node_values(ids, node_ids, sed_out).round(2)
+
+    return result_discharge.merge(
+        sedimentos_discharge,
+        on='subasin_id'
+    )
+
+def _calculate_sediment_routing_array(
+    result_discharge,
+    topology,
+    ruptura_dict,
+    df_sedyield,
+    df_merged,
+    radio_mode,
+    df_sed_param,
+    density_manual,
+    efficiency_manual,
+    params):
+
+    sedimentos_discharge = _eroded_sediment_frame(
+        result_discharge, df_merged, params.pm_fenda, params.m_erosao, params.n_erosao
+    )
+
+    rompeu = node_array(
+        topology,
+        np.fromiter(ruptura_dict.keys(), dtype=np.int64, count=len(ruptura_dict)),
+        np.fromiter(ruptura_dict.values(), dtype=bool, count=len(ruptura_dict)),
+        fill=0
+    ).astype(bool)
+
+    density, efficiency = sediment_parameter_arrays(
+        topology, radio_mode, df_sed_param, density_manual, efficiency_manual
+    )
+
+    sed_in, sed_out = route_sediment_arrays(
+        topology,
+        node_array(topology, df_sedyield['subasin_id'], df_sedyield['sed_enter_volume']),
+        rompeu,
+        node_array(
+            topology,
+            sedimentos_discharge['subasin_id'],
+            sedimentos_discharge['volume_sedimento_erodido'],
+            keep='first'
+        ),
+        density,
+        efficiency
+    )
+
+    return _add_sediment_columns(result_discharge, sedimentos_discharge, topology.node_ids, sed_in, sed_out)
+
+def _calculate_sediment_routing_model(result_discharge, model, ruptura_dict, params):
+
+    if not model.has_sediment:
+        raise ValueError("O modelo da bacia foi montado sem os dados de sedimentos.")
+
+    topology = model.topology
+    rompeu = node_array(
+        topology,
+        np.fromiter(ruptura_dict.keys(), dtype=np.int64, count=len(ruptura_dict)),
+        np.fromiter(ruptura_dict.values(), dtype=bool, count=len(ruptura_dict)),
+        fill=0
+    ).astype(bool)
+
+    # volume total do resultado (inteiro), primeira linha de cada subbacia
+    volume_total = node_array(
+        topology, result_discharge['subasin_id'], result_discharge['volume_total'], keep='first'
+    )
+    erodido = eroded_volume(rompeu, volume_total, model['dam_height'], params)
+
+    sed_in, sed_out = route_sediment_arrays(
+        topology, model['sed_local'], rompeu, erodido, model['density'], model['efficiency']
+    )
+
+    return _add_sediment_columns(
+        result_discharge,
+        _model_eroded_frame(result_discharge, topology.node_ids, erodido),
+        topology.node_ids,
+        sed_in,
+        sed_out
+    )
+
+def _model_eroded_frame(result_discharge, node_ids, erodido):
+    sedimentos_discharge = pd.DataFrame()
+    sedimentos_discharge["subasin_id"] = result_discharge["subasin_id"]
+    sedimentos_discharge['volume_sedimento_erodido'] = map_node_values(
+        sedimentos_discharge["subasin_id"], node_ids, erodido
+    )
+    return sedimentos_discharge
+
+def build_basin_model(
+    df_reservoir,
+    df_routing,
+    df_runoff,
+    df_sedyield=None,
+    radio_mode=1,
+    df_sed_param=None,
+    density_manual=None,
+    efficiency_manual=None,
+    topology=None,
+    dtype=np.float64):
+
+    # converte os DataFrames uma única vez para vetores por posição da topologia
+    df_merged = df_reservoir.merge(df_runoff, on='subasin_id', how='left')
+    if topology is None:
+        topology = compile_topology(df_routing)
+
+    entradas = routing_input_arrays(
+        topology, df_merged, df_runoff, df_sedyield,
+        radio_mode, df_sed_param, density_manual, efficiency_manual
+    )
+    return BasinModel(
+        topology, entradas, row_ids=df_runoff['subasin_id'].to_numpy(), dtype=dtype,
+        integer_fields=detect_integer_fields(df_merged)
+    )
+
+def calculate_routing(
+    df_reservoir,
+    df_routing,
+    df_runoff,
+    df_sedyield=None,
+    radio_mode=1,
+    df_sed_param=None,
+    density_manual=None,
+    efficiency_manual=None,
+    topology=None,
+    params=None,
+    processes=None,
+    progress=None):
+
+    # água e sedimentos numa única passada pelos níveis da rede; progress vai
+    # para route_arrays (só no caminho serial)
+    if isinstance(df_reservoir, BasinModel):
+        return _calculate_routing_model(df_reservoir, df_runoff, params, processes, progress)
+
+    with stage('merge'):
+        df_merged = df_reservoir.merge(df_runoff, on='subasin_id', how='left')
+    if topology is None:
+        topology = compile_topology(df_routing)
+
+    entradas = routing_input_arrays(
+        topology, df_merged, df_runoff, df_sedyield,
+        radio_mode, df_sed_param, density_manual, efficiency_manual
+    )
+    inteiros = detect_integer_fields(df_merged)
+    with stage('water_sediment_routing' if df_sedyield is not None else 'water_routing'):
+        if processes is not None and processes > 1:
+            # sub-bacias independentes em paralelo; resultado idêntico ao serial
+            from parallel import route_arrays_parallel
+            saida = route_arrays_parallel(topology, processes, params=params, integer_fields=inteiros, **entradas)
+        else:
+            saida = route_arrays(topology, **entradas, params=params, integer_fields=inteiros, progress=progress)
+    set_counter('failures', int(saida['rompeu'].sum()))
+
+    result = build_routing_result(df_runoff, df_merged, topology.node_ids, saida, params)
+    ruptura_dict = dict(zip(topology.node_ids.tolist(), saida['rompeu'].tolist()))
+
+    return result, topology, ruptura_dict, topology.sequence(), df_merged
+
+def _calculate_routing_model(model, df_runoff=None, params=None, processes=None, progress=None):
+
+    topology = model.topology
+    with stage('water_sediment_routing' if model.has_sediment else 'water_routing'):
+        if processes is not None and processes > 1:
+            from parallel import route_arrays_parallel
+            saida = route_arrays_parallel(
+                topology, processes, params=params, integer_fields=model.integer_fields, **model.inputs()
+            )
+        else:
+            saida = model.route(params, progress=progress)
+    set_counter('failures', int(saida['rompeu'].sum()))
+
+    result = build_model_result(_model_rows(model, df_runoff), topology.node_ids, saida)
+    ruptura_dict = dict(zip(topology.node_ids.tolist(), saida['rompeu'].tolist()))
+
+    return result, model, ruptura_dict, topology.sequence(), model
+
+def build_model_result(df_rows, node_ids, saida):
+
+    result = build_water_result(df_rows, node_ids, saida)
+    if 'sed_out' in saida:
+        result = _add_sediment_columns(
+            result,
+            _model_eroded_frame(result, node_ids, saida['eroded_volume']),
+            node_ids,
+            saida['sed_in'],
+            saida['sed_out']
+        )
+    return result
+
+def routing_input_arrays(
+    topology,
+    df_merged,
+    df_runoff,
+    df_sedyield=None,
+    radio_mode=1,
+    df_sed_param=None,
+    density_manual=None,
+    efficiency_manual=None):
+
+    runoff_volume, runoff_peak, storage_capacity, spillway = water_input_arrays(topology, df_merged)
+    entradas = {
+        'runoff_volume': runoff_volume,
+        'runoff_peak': runoff_peak,
+        'storage_capacity': storage_capacity,
+        'spillway': spillway
+    }
+
+    if df_sedyield is not None:
+        # altura da barragem alinhada à primeira linha de cada subbacia no resultado
+        altura = df_merged['dam_height'].reindex(df_runoff.index)
+        density, efficiency = sediment_parameter_arrays(
+            topology, radio_mode, df_sed_param, density_manual, efficiency_manual
+        )
+        entradas.update(
+            sed_local=node_array(topology, df_sedyield['subasin_id'], df_sedyield['sed_enter_volume']),
+            dam_height=node_array(topology, df_runoff['subasin_id'], altura, keep='first'),
+            density=density,
+            efficiency=efficiency
+        )
+
+    return entradas
+
+def build_routing_result(df_runoff, df_merged, node_ids, saida, params=None):
+
+    params = params or DEFAULT_PARAMS
+    result = build_water_result(df_runoff, node_ids, saida)
+
+    if 'sed_out' in saida:
+        sedimentos_discharge = _eroded_sediment_frame(
+            result, df_merged, params.pm_fenda, params.m_erosao, params.n_erosao
+        )
+        result = _add_sediment_columns(
+            result, sedimentos_discharge, node_ids, saida['sed_in'], saida['sed_out']
+        )
 
+    return result
@@ -0,0 +1,184 @@
+import heapq
+
+import numpy as np
+
+from data_utils import build_routing_result, routing_input_arrays, detect_integer_fields
+from routing_engine import (
+    DEFAULT_PARAMS,
+    compile_topology,
+    eroded_volume,
+    integer_volumes,
+    route_arrays,
+    sediment_step,
+    water_step
+)
+
+# colunas editáveis -> vetor de entrada da sessão
+EDITABLE_FIELDS = {
+    'runoff_volume': 'runoff_volume',
+    'runoff_peak_discharge': 'runoff_peak',
+    'water_storage_capacity': 'storage_capacity',
+    'spillway_discharge': 'spillway',
+    'dam_height': 'dam_height',
+    'sed_enter_volume': 'sed_local',
+    'sediment_density': 'density',
+    'sediment_retention_efficiency': 'efficiency'
+}
+
+
+class RoutingSession:
+
+    def __init__(
+        self,
+        df_reservoir,
+        df_routing,
+        df_runoff,
+        df_sedyield=None,
+        radio_mode=1,
+        df_sed_param=None,
+        density_manual=None,
+        efficiency_manual=None,
+        topology=None,
+        params=None):
+
+        self.df_runoff = df_runoff
+        self.df_merged = df_reservoir.merge(df_runoff, on='subasin_id', how='left')
+        self.topology = topology if topology is not None else compile_topology(df_routing)
+
+        self.inputs = routing_input_arrays(
+            self.topology, self.df_merged, df_runoff, df_sedyield,
+            radio_mode, df_sed_param, density_manual, efficiency_manual
+        )
+        self.with_sediment = df_sedyield is not None
+        self.params = params or DEFAULT_PARAMS
+        self.integer_fields = detect_integer_fields(self.df_merged)
+        self.state = route_arrays(self.topology, **self.inputs, params=self.params, integer_fields=self.integer_fields)
+        self._volume_inteiro = integer_volumes(
+            self.inputs['runoff_volume'], self.inputs['storage_capacity'],
+            self.state['rompeu'], self.integer_fields, self.topology
+        )
+
+        # montantes de cada nó na ordem do routing.dat e jusantes para propagar
+        n = self.topology.n_nodes
+        src = self.topology.edge_src
+        dst = self.topology.edge_dst
+        por_jusante = np.argsort(dst, kind='stable')
+        self._pred = src[por_jusante]
+        self._pred_ptr = np.concatenate([[0], np.cumsum(np.bincount(dst, minlength=n))])
+        por_montante = np.argsort(src, kind='stable')
+        self._succ = dst[por_montante]
+        self._succ_ptr = np.concatenate([[0], np.cumsum(np.bincount(src, minlength=n))])
+
+        self._pending = []
+        self.last_recomputed = 0
+
+    def _position(self, subasin_id):
+        p = int(self.topology.index_of([subasin_id])[0])
+        if p < 0:
+            raise KeyError(f"Subbacia {subasin_id} não está na rede de drenagem.")
+        return p
+
+    def _upstream_sum(self, p, valores, inteiros=None):
+        # o próprio sum() sobre ints e floats do Python, como na engine do
+        # networkx (e em ordered_sum); sem afluentes, -0.0 neutro
+        montantes = self._pred[self._pred_ptr[p]:self._pred_ptr[p + 1]]
+        if not len(montantes):
+            return -0.0, True
+        soma = sum(
+            int(valores[q]) if inteiros is not None and inteiros[q] else float(valores[q])
+            for q in montantes
+        )
+        return float(soma), isinstance(soma, int)
+
+    def _recompute(self, p):
+
+        entradas = self.inputs
+        estado = self.state
+        s = slice(p, p + 1)
+
+        antes = (estado['volume_out'][p], estado['peak_out'][p], estado['rompeu'][p], self._volume_inteiro[p])
+
+        v_up, v_up_inteiro = self._upstream_sum(p, estado['volume_out'], self._volume_inteiro)
+        v_in = entradas['runoff_volume'][s] + v_up
+        p_in = entradas['runoff_peak'][s] + self._upstream_sum(p, estado['peak_out'])[0]
+        v_out, p_out, r = water_step(v_in, p_in, entradas['storage_capacity'][s], entradas['spillway'][s], self.params)
+        self._volume_inteiro[s] = v_up_inteiro & integer_volumes(
+            entradas['runoff_volume'][s], entradas['storage_capacity'][s], r, self.integer_fields
+        )
+
+        estado['volume_in'][s] = v_in
+        estado['volume_out'][s] = v_out
+        estado['peak_in'][s] = p_in
+        estado['peak_out'][s] = p_out
+        estado['rompeu'][s] = r
+
+        depois = (estado['volume_out'][p], estado['peak_out'][p], estado['rompeu'][p], self._volume_inteiro[p])
+
+        if self.with_sediment:
+            antes += (estado['sed_out'][p],)
+
+            e = eroded_volume(r, np.trunc(v_out), entradas['dam_height'][s], self.params)
+            s_in = entradas['sed_local'][s] + self._upstream_sum(p, estado['sed_out'])[0]
+
+            estado['sed_in'][s] = s_in
+            estado['sed_out'][s] = sediment_step(s_in, r, e, entradas['density'][s], entradas['efficiency'][s])
+            estado['eroded_volume'][s] = e
+
+            depois += (estado['sed_out'][p],)
+
+        # NaN == NaN conta como "não mudou"
+        return any(
+            not (a == b or (a != a and b != b))
+            for a, b in zip(antes, depois)
+        )
+
+    def update(self, subasin_id, **valores):
+
+        p = self._position(subasin_id)
+
+        for campo, valor in valores.items():
+            if campo not in EDITABLE_FIELDS:
+                raise ValueError(f"Campo não editável: {campo}")
+            nome = EDITABLE_FIELDS[campo]
+            if nome not in self.inputs:
+                raise ValueError(f"Campo {campo} exige a simulação de sedimentos.")
+            self.inputs[nome][p] = valor
+            if campo == 'dam_height':
+                # a coluna de volume erodido do resultado lê a altura do df_merged
+                self._pending.append((subasin_id, valor))
+
+        # recalcula só o caminho de jusante, parando onde as saídas não mudam
+        fila = [p]
+        na_fila = {p}
+        alterados = []
+
+        while fila:
+            q = heapq.heappop(fila)
+            na_fila.discard(q)
+            alterados.append(q)
+
+            if not self._recompute(q):
+                continue
+
+            for filho in self._succ[self._succ_ptr[q]:self._succ_ptr[q + 1]]:
+                filho = int(filho)
+                if filho not in na_fila:
+                    heapq.heappush(fila, filho)
+                    na_fila.add(filho)
+
+        self.last_recomputed = len(alterados)
+        return self.topology.node_ids[alterados].tolist()
+
+    def _apply_pending(self):
+        for subasin_id, valor in self._pending:
+            self.df_merged.loc[self.df_merged['subasin_id'] == subasin_id, 'dam_height'] = valor
+        self._pending = []
+
+    def ruptura_dict(self):
+        return dict(zip(self.topology.node_ids.tolist(), self.state['rompeu'].tolist()))
+
+    def result(self):
+        self._apply_pending()
+        return build_routing_result(
+            self.df_runoff, self.df_merged, self.topology.node_ids, self.state, self.params
+        )
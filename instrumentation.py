@@ -0,0 +1,165 @@
+import contextlib
+import contextvars
+import functools
+import json
+import sys
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# perfil ativo no contexto atual (por thread); None = instrumentação desligada
+_ativo = contextvars.ContextVar('basinflow_profile', default=None)
+_DESLIGADO = contextlib.nullcontext()
+
+
+def _peak_rss():
+    # pico de memória residente do processo até agora, em bytes
+    if resource is not None:
+        pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # macOS informa em bytes, Linux em KiB
+        return pico if sys.platform == 'darwin' else pico * 1024
+    try:
+        import psutil
+    except ImportError:
+        return None
+    info = psutil.Process().memory_info()
+    return getattr(info, 'peak_wset', info.rss)
+
+
+class PipelineProfile:
+
+    # tempo de parede, tempo de CPU e memória por etapa, mais contadores.
+    # Etapas repetidas (ex.: um file_parse por arquivo) são somadas; com
+    # track_memory o pico de alocações de cada etapa vem do tracemalloc.
+
+    def __init__(self, track_memory=False):
+        self.track_memory = track_memory
+        self.stages = {}
+        self.counters = {}
+        self._pilha = []
+
+    @contextlib.contextmanager
+    def stage(self, nome):
+        quadro = {'pico': 0}
+        if self.track_memory and tracemalloc.is_tracing():
+            quadro['base'] = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        self._pilha.append(quadro)
+
+        parede = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield self
+        finally:
+            parede = time.perf_counter() - parede
+            cpu = time.process_time() - cpu
+            self._pilha.pop()
+
+            registro = self.stages.setdefault(nome, {
+                'wall_s': 0.0, 'cpu_s': 0.0, 'calls': 0, 'peak_rss_bytes': None
+            })
+            registro['wall_s'] += parede
+            registro['cpu_s'] += cpu
+            registro['calls'] += 1
+            registro['peak_rss_bytes'] = _peak_rss()
+
+            if 'base' in quadro:
+                # etapas aninhadas zeram o pico; o maior valor sobe para a etapa de fora
+                pico = max(quadro['pico'], tracemalloc.get_traced_memory()[1])
+                if self._pilha:
+                    self._pilha[-1]['pico'] = max(self._pilha[-1]['pico'], pico)
+                tracemalloc.reset_peak()
+                registro['peak_traced_bytes'] = max(
+                    registro.get('peak_traced_bytes', 0), pico - quadro['base']
+                )
+
+    def count(self, nome, valor=1):
+        self.counters[nome] = self.counters.get(nome, 0) + valor
+
+    def set_counter(self, nome, valor):
+        self.counters[nome] = valor
+
+    def to_dict(self):
+        return {
+            'stages': {nome: dict(valores) for nome, valores in self.stages.items()},
+            'counters': dict(self.counters)
+        }
+
+    def write_json(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False, indent=2)
+
+    def summary_lines(self):
+        linhas = []
+        for nome, r in self.stages.items():
+            memoria = r.get('peak_traced_bytes')
+            if memoria is None:
+                memoria = r['peak_rss_bytes']
+            texto = f"{nome}: {r['wall_s']:.3f} s (CPU {r['cpu_s']:.3f} s)"
+            if memoria is not None:
+                texto += f", memória {memoria / 2 ** 20:.1f} MiB"
+            if r['calls'] > 1:
+                texto += f", {r['calls']}x"
+            linhas.append(texto)
+        linhas.extend(f"{nome} = {valor}" for nome, valor in self.counters.items())
+        return linhas
+
+
+@contextlib.contextmanager
+def profiling(track_memory=False):
+
+    perfil = PipelineProfile(track_memory)
+    iniciou = track_memory and not tracemalloc.is_tracing()
+    if iniciou:
+        tracemalloc.start()
+    token = _ativo.set(perfil)
+    try:
+        yield perfil
+    finally:
+        _ativo.reset(token)
+        if iniciou:
+            tracemalloc.stop()
+
+
+def stage(nome):
+    # sem perfil ativo devolve um contexto vazio já pronto
+    perfil = _ativo.get()
+    return perfil.stage(nome) if perfil is not None else _DESLIGADO
+
+
+def staged(nome):
+    # decorador: a função inteira conta como uma etapa
+    def decorador(funcao):
+        @functools.wraps(funcao)
+        def envolvida(*args, **kwargs):
+            perfil = _ativo.get()
+            if perfil is None:
+                return funcao(*args, **kwargs)
+            with perfil.stage(nome):
+                return funcao(*args, **kwargs)
+        return envolvida
+    return decorador
+
+
+def count(nome, valor=1):
+    perfil = _ativo.get()
+    if perfil is not None:
+        perfil.count(nome, valor)
+
+
+def set_counter(nome, valor):
+    perfil = _ativo.get()
+    if perfil is not None:
+        perfil.set_counter(nome, valor)
+
+
+def active_profile():
+    return _ativo.get()
+
+
+def sidecar_path(result_path):
+    return result_path + '.profile.json'
@@ -1,11 +1,16 @@
 #myapp.py
 import logging
+import queue
+import threading
 import tkinter as tk
 from tkinter import filedialog, messagebox
-import pandas as pd
-import networkx as nx
-import numpy as np
-from data_utils import clean_dataframe_columns, FILE_SCHEMAS, load_dat_file
+from data_utils import (
+    clean_dataframe_columns, FILE_SCHEMAS, calculate_routing, map_node_values, sediment_parameter_arrays
+)
+from dat_cache import load_dat_file_cached, load_topology_cached
+from instrumentation import active_profile, profiling, sidecar_path
+from result_writer import write_result
+from routing_engine import compile_topology
 
 logger = logging.getLogger(__name__)
 FORMAT = '%(asctime)s - %(levelname)s: %(message)s'
@@ -13,6 +18,83 @@ logging.basicConfig(filename='myapp.log', level=logging.INFO,format=FORMAT)
 logger.info('Started')
 
 dataframes = {}
+# topologia compilada do routing.dat carregado (cache ao lado do arquivo)
+topologias = {}
+
+# Eventos enviados pelas threads de trabalho para a interface.
+# O Tk só pode ser tocado pela thread principal, então tudo passa por essa fila.
+fila_eventos = queue.Queue()
+cancelar_calculo = threading.Event()
+calculo_em_andamento = threading.Event()
+
+
+class CalculoCancelado(Exception):
+    pass
+
+
+def escrever_saida(mensagem):
+    txt_saida['state'] = tk.NORMAL
+    txt_saida.insert(tk.END, mensagem)
+    txt_saida.see(tk.END)
+    txt_saida['state'] = tk.DISABLED
+
+
+def processar_eventos():
+
+    try:
+        while True:
+            evento, *dados = fila_eventos.get_nowait()
+
+            if evento == 'log':
+                escrever_saida(dados[0])
+
+            elif evento == 'erro':
+                titulo, mensagem = dados
+                messagebox.showerror(titulo, mensagem)
+
+            elif evento == 'arquivo':
+                chave, df, topology = dados
+                dataframes[chave] = df
+                if topology is not None:
+                    topologias[chave] = topology
+                escrever_saida(f"Arquivo '{chave}' carregado com sucesso\n")
+
+            elif evento == 'fim':
+                calculo_em_andamento.clear()
+                btn_calcular.config(state=tk.NORMAL)
+                btn_cancelar.config(state=tk.DISABLED)
+
+    except queue.Empty:
+        pass
+
+    root.after(100, processar_eventos)
+
+
+def notificar(evento, *dados):
+    fila_eventos.put((evento,) + dados)
+
+
+def carregar_arquivo_em_segundo_plano(file_path, chave):
+
+    try:
+        config = FILE_SCHEMAS[chave]
+
+        df = load_dat_file_cached(
+            file_path,
+            config,
+            clean_dataframe_columns
+        )
+        topology = None
+        if chave == 'routing.dat':
+            topology = load_topology_cached(file_path, clean_dataframe_columns)
+
+        notificar('arquivo', chave, df, topology)
+
+    except Exception as e:
+        logger.exception("Erro ao ler o arquivo %s", chave)
+        notificar('erro', "Erro", f"Erro ao ler o arquivo {chave}:\n{e}")
+        notificar('log', f"Erro ao ler o arquivo {chave}:\n{e}\n")
+
 
 def selecionar_arquivo(entry_widget, chave):
 
@@ -29,32 +111,13 @@ def selecionar_arquivo(entry_widget, chave):
     entry_widget.insert(0, file_path)
     entry_widget.config(state=tk.DISABLED)
 
-    try:
-        config = FILE_SCHEMAS[chave]
-
-        df = load_dat_file(
-            file_path,
-            config,
-            clean_dataframe_columns
-        )
+    escrever_saida(f"Carregando arquivo '{chave}'...\n")
 
-        dataframes[chave] = df
-
-        txt_saida['state'] = tk.NORMAL
-        txt_saida.insert(tk.END, f"Arquivo '{chave}' carregado com sucesso\n")
-        txt_saida.see(tk.END)
-        txt_saida['state'] = tk.DISABLED
-
-    except Exception as e:
-        messagebox.showerror(
-            "Erro",
-            f"Erro ao ler o arquivo {chave}:\n{e}"
-        )
-
-        txt_saida['state'] = tk.NORMAL
-        txt_saida.insert(tk.END, f"Erro ao ler o arquivo {chave}:\n{e}\n")
-        txt_saida.see(tk.END)
-        txt_saida['state'] = tk.DISABLED
+    threading.Thread(
+        target=carregar_arquivo_em_segundo_plano,
+        args=(file_path, chave),
+        daemon=True
+    ).start()
 
 
 def toggle_sedimentos():
@@ -180,268 +243,191 @@ tk.Label(row_manual, text="%").grid(row=1, column=2, sticky="w")
 
 # FUNÇÃO PRINCIPAL DE CÁLCULO
 
-def on_calcular_click():
+def calcular_em_segundo_plano(parametros):
     try:
 
-        if ent_name.get():
-            nome = ent_name.get()
-        else:
-            nome = "result_discharge"
+        nome = parametros['nome'] or "result_discharge"
 
         logger.info('Cálculo iniciado pelo usuário')
 
-        txt_saida['state'] = tk.NORMAL
-        txt_saida.insert(tk.END, f"Cálculo iniciado pelo usuário...\n")
-        txt_saida.see(tk.END)
-        txt_saida['state'] = tk.DISABLED
-
-        df_reservoir = dataframes.get('reservoir.dat')
-        df_routing = dataframes.get('routing.dat')
-        df_runoff = dataframes.get('runoff.dat')
-
-        df_routing['downstream'] = df_routing['downstream'].replace(-999, np.nan)
-
-        df_merged = (df_reservoir.merge(df_runoff, on='subasin_id', how='left'))
-        node_attrs = (df_merged.set_index('subasin_id').to_dict(orient='index'))
-
-        logger.info('DataFrames mesclados para construção do grafo')
-
-        txt_saida['state'] = tk.NORMAL
-        txt_saida.insert(tk.END, f"Construindo grafo das rotas...\n")
-        txt_saida.see(tk.END)
-        txt_saida['state'] = tk.DISABLED
-
-        df_edges = df_routing.dropna(subset=['downstream'])
-        df_edges = df_routing.dropna(subset=['downstream']).copy()
-        df_edges['upstream'] = df_edges['upstream'].astype(int)
-        df_edges['downstream'] = df_edges['downstream'].astype(int)
+        notificar('log', f"Cálculo iniciado pelo usuário...\n")
 
-    # Cria um grafo direcionado (DiGraph) a partir do DataFrame.
-        G = nx.from_pandas_edgelist(
-                df_edges,
-                source='upstream',
-                target='downstream',
-                create_using=nx.DiGraph()
-            )
-        
-        txt_saida['state'] = tk.NORMAL
-        txt_saida.insert(tk.END, f"Preparando sequencia de processamento...\n")
-        txt_saida.see(tk.END)
-        txt_saida['state'] = tk.DISABLED
-
-        nx.set_node_attributes(G, node_attrs) #usando nx para determinar os atributos do grafo G com os dados do dicionario node_attrs
+        df_reservoir = parametros['dataframes'].get('reservoir.dat')
+        df_routing = parametros['dataframes'].get('routing.dat')
+        df_runoff = parametros['dataframes'].get('runoff.dat')
 
-        sequencia_processamento = list(nx.topological_sort(G))
+        df_sedyield = None
+        df_sed_param = None
+        density_manual = None
+        efficiency_manual = None
 
-        #cria um dataframe tendo como base os ids dos açudes
-        result_discharge = pd.DataFrame(columns=["subasin_id"])
-        result_discharge["subasin_id"] = df_runoff["subasin_id"]    
+        if parametros['sedimentos']:
 
-        peak_in = {} # Vazão de pico na entrada - water routing (m³/s)
-        peak_out = {} # Vazão de pico na saída - water routing (m³/s)
-        volume_in = {} # Volume na entrada do açude - water routing (m³)
-        volume_out = {} # Volume na saída do açude - water routing (m³)
-        ruptura_dict = {} # Contador de casos de ruptura (m³/s)
-        
+            df_sedyield = parametros['dataframes'].get('sedyield.dat')
+            if df_sedyield is None:
+                notificar('erro', 
+                    "Erro",
+                    "Arquivo sedyield.dat não carregado."
+                )
+                notificar('log', f"Erro: Arquivo sedyield.dat não carregado.\n")
+                return
 
-        txt_saida['state'] = tk.NORMAL
-        txt_saida.insert(tk.END, f"Calculando casos de ruptura...\n")
-        txt_saida.see(tk.END)
-        txt_saida['state'] = tk.DISABLED
+            # --- Lógica de Acesso aos Parâmetros ---
+            if parametros['modo'] == 1:
+                # MODO ARQUIVO
+                df_sed_param = parametros['dataframes'].get('sed_param.dat')
+                if df_sed_param is None:
+                    notificar('erro', "Erro", "Arquivo sed_param.dat não carregado.")
+                    return
+            else:
+                # MODO MANUAL
+                try:
+                    # Limpa string de % ou vírgulas e converte
+                    val_dens = parametros['densidade'].replace(',', '.')
+                    val_eff = parametros['eficiencia'].replace(',', '.').replace('%', '')
 
-        for i in sequencia_processamento:
+                    density_manual = float(val_dens) if val_dens else 1.5
+                    # Se for eficiência em %, divide por 100
+                    efficiency_manual = float(val_eff) / 100 if val_eff else 0.50
+                except ValueError:
+                    notificar('erro', "Erro", "Valores manuais de densidade ou eficiência inválidos.")
+                    return
 
-            upstreams = list(G.predecessors(i))  #lista com todos os predecessores do açude atual
+        verificar_cancelamento()
 
-            # 1. Entradas (volume e pico)
+        # mesmo caminho da linha de comando: topologia compilada e
+        # propagação de água e sedimentos por níveis da rede
+        notificar('log', f"Calculando casos de ruptura{' e sedimentos' if df_sedyield is not None else ''}...\n")
+        logger.info('Iniciando propagação')
 
-            if upstreams:     #se ele tiver predecessores
+        topology = parametros['topology']
+        if topology is None:
+            topology = compile_topology(df_routing)
+        notificar('log', f"Rede compilada: {topology.n_nodes} açudes, {topology.n_edges} trechos\n")
 
-                volume_in[i] = (G.nodes[i]['runoff_volume']+ sum(volume_out[up] for up in upstreams)) # o volume de entrada será o volume dele, mais a soma do volume de todos os predecessores na lista pega anteriormente
+        result_discharge, topology, ruptura_dict, sequencia_processamento, df_merged = calculate_routing(
+            df_reservoir, df_routing, df_runoff, df_sedyield,
+            parametros['modo'], df_sed_param, density_manual, efficiency_manual,
+            topology=topology, progress=progresso_propagacao()
+        )
 
-                peak_in[i] = (G.nodes[i]['runoff_peak_discharge'] + sum(peak_out[up] for up in upstreams))   # a mesma ideia ocorre aqui para o valor de pico de SAIDA
-            else:
-                volume_in[i] = G.nodes[i]['runoff_volume']
-                peak_in[i] = G.nodes[i]['runoff_peak_discharge']       #caso ele seja uma folha (sem predecessores), os valores serão os próprios dele mesmo.
+        logger.info('Finalizando propagação')
+        notificar('log', f"{len(sequencia_processamento)} açudes propagados, {sum(ruptura_dict.values())} rupturas.\n")
 
-            # 2. Dados do açude
+        if df_sedyield is not None:
+            # massa erodida com a densidade de cada açude (arquivo ou valor manual)
+            density, _ = sediment_parameter_arrays(
+                topology, parametros['modo'], df_sed_param, density_manual, efficiency_manual
+            )
+            massa = result_discharge['volume_sedimento_erodido'] * map_node_values(
+                result_discharge['subasin_id'], topology.node_ids, density
+            )
+            result_discharge.insert(
+                result_discharge.columns.get_loc('volume_sedimento_erodido') + 1,
+                'massa_sedimento_erodido', massa.round(2)
+            )
+            notificar('log', f"Cálculo de sedimentos concluído.\n")
 
-            spillway = G.nodes[i]['spillway_discharge']
-            storage_capacity = G.nodes[i]['water_storage_capacity']    #limite do vertedouro do açude i, bem como a sua capacidade
+        if cancelar_calculo.is_set():
+            raise CalculoCancelado()
 
-            # 3. Verificação de ruptura
-            # o valor 0.707121014402343, representa o percentual médio do volume efluente que passa pela fenda:
+        notificar('log', f"Gravando {nome}.dat...\n")
+        write_result(result_discharge, f"{nome}.dat")
 
-            rompeu = (0.707121014402343 * peak_in[i] > spillway)
-            ruptura_dict[i] = rompeu
+        perfil = active_profile()
+        if perfil is not None:
+            perfil.write_json(sidecar_path(f"{nome}.dat"))
+            for linha in perfil.summary_lines():
+                notificar('log', f"{linha}\n")
 
-            # 4. Saídas (volume e pico)
+        """ print("calculo de sedimentos finalizado!") """
 
-            if rompeu:
-                volume_out[i] = volume_in[i] + storage_capacity
-                peak_out[i] = 0.0344 * (volume_out[i] ** 0.6527)
+        notificar('log', f"O arquivo {nome}.dat foi gerado com sucesso! \n")
 
-                """ print(
-                    f"Volume: {volume_out[i]:.2f} | "
-                    f"Açude {i} ROMPEU | "
-                    f"Peak in = {peak_in[i]:.2f} | "
-                    f"Peak out = {peak_out[i]:.2f}"
-                ) """
+    except CalculoCancelado:
+        logger.info('Cálculo cancelado pelo usuário')
+        notificar('log', f"Cálculo cancelado pelo usuário.\n")
 
-            else:
-                volume_out[i] = volume_in[i]
-                peak_out[i] = 0.707121014402343 * peak_in[i]
-
-        result_discharge['volume_entrada'] = result_discharge['subasin_id'].map(volume_in).astype(int)
-        result_discharge['volume_total'] = result_discharge['subasin_id'].map(volume_out).astype(int)
-        result_discharge['vazão_de_entrada'] = result_discharge['subasin_id'].map(peak_in).round(2)
-        result_discharge['vazão_de_saida'] = result_discharge['subasin_id'].map(peak_out).round(2)
-        result_discharge['rompeu'] = result_discharge['subasin_id'].map(ruptura_dict)
-
-        
-        if sedimentos_checkbox.get():
-
-        
-            df_sedyield = dataframes.get('sedyield.dat')
-            
-            if df_sedyield is not None:
-                sed_attrs = df_sedyield.set_index('subasin_id').to_dict(orient='index')
-                nx.set_node_attributes(G, sed_attrs)
-            else:
-                messagebox.showerror(
-                    "Erro",
-                    "Arquivo sedyield.dat não carregado."
-                )
-                txt_saida['state'] = tk.NORMAL
-                txt_saida.insert(tk.END, f"Erro: Arquivo sedyield.dat não carregado.\n")
-                txt_saida.see(tk.END)
-                txt_saida['state'] = tk.DISABLED
-                return
+    except Exception as e:
+        import traceback
+        erro = traceback.format_exc()
+        notificar('erro', "Erro inesperado", erro)
+        logger.exception("Erro inesperado")
 
-            
-            
-            txt_saida['state'] = tk.NORMAL
-            txt_saida.insert(tk.END, f"Calculando sedimentos...\n")
-            txt_saida.see(tk.END)
-            txt_saida['state'] = tk.DISABLED
+    finally:
+        notificar('fim')
 
-            pm_fenda = 0.842584358697712
-            m = 0.0261
-            n = 0.769
 
-            # Acessar os valores
-            # --- Lógica de Acesso aos Parâmetros ---
-            if radio_var.get() == 1:
-                # MODO ARQUIVO
-                df_sed_param = dataframes.get('sed_param.dat')
-                if df_sed_param is not None:
-                    # Criar dicionários mapeando subasin_id para os valores
-                    density_map = dict(zip(df_sed_param['subasin_id'], df_sed_param['sediment_density']))
-                    efficiency_map = dict(zip(df_sed_param['subasin_id'], df_sed_param['sediment_retention_efficiency']))
-                else:
-                    messagebox.showerror("Erro", "Arquivo sed_param.dat não carregado.")
-                    return
-            else:
-                # MODO MANUAL
-                try:
-                    # Limpa string de % ou vírgulas e converte
-                    val_dens = ent_density.get().replace(',', '.')
-                    val_eff = ent_efficiency.get().replace(',', '.').replace('%', '')
-                    
-                    default_density = float(val_dens) if val_dens else 1.5
-                    # Se for eficiência em %, divide por 100
-                    default_efficiency = float(val_eff) / 100 if val_eff else 0.50
-                    
-                    # Criamos dicionários vazios, pois usaremos o valor padrão no .get() dentro do loop
-                    density_map = {}
-                    efficiency_map = {}
-                except ValueError:
-                    messagebox.showerror("Erro", "Valores manuais de densidade ou eficiência inválidos.")
-                    return
-            
-            sedimentos_discharge = pd.DataFrame(columns=["subasin_id"])
-            sedimentos_discharge["subasin_id"] = result_discharge["subasin_id"]
+def calcular_com_perfil(parametros):
 
-            sedimentos_discharge['volume_sedimento_erodido'] = (
-                result_discharge['rompeu'] * m * ( result_discharge['volume_total'] * pm_fenda * df_merged['dam_height'] ) ** n).round(2)
+    # o perfil vale só para esta thread; o relatório sai ao lado do .dat
+    with profiling():
+        calcular_em_segundo_plano(parametros)
 
-            sedimentos_discharge['massa_sedimento_erodido'] = (
-                sedimentos_discharge['volume_sedimento_erodido'] * default_density
-            ).round(2)
 
-            sed_in = {} # Massa de sedimentos afluente - sediment routing (ton)
-            sed_out = {} # Massa de sedimentos efluente - sediment routing (ton)
+def verificar_cancelamento():
 
-            logger.info('Iniciando cálculo de sedimentos')
+    if cancelar_calculo.is_set():
+        raise CalculoCancelado()
 
-            for i in sequencia_processamento:
 
-                upstreams = list(G.predecessors(i)) #lista com todas as bacias acima da bacia atual
+def progresso_propagacao(passos=10):
 
-                # Tenta pegar do mapa (arquivo). Se não existir ou for modo manual, usa o default
-                if radio_var.get() == 1:
-                    # No modo arquivo, se o ID não existir no .dat, você pode definir um fallback
-                    current_density = density_map.get(i)
-                    current_efficiency = efficiency_map.get(i)
-                else:
-                    current_density = default_density
-                    current_efficiency = default_efficiency
+    # chamado pelo route_arrays ao fim de cada nível: o cancelamento vale já
+    # no nível seguinte, e o andamento sai no log a cada décimo da rede
+    proximo = 0
 
-                sed_local = G.nodes[i]['sed_enter_volume'] 
+    def progresso(feitos, total):
+        nonlocal proximo
+        verificar_cancelamento()
+        if feitos >= proximo:
+            notificar('log', f"{feitos} de {total} nós propagados\n")
+            proximo = feitos + max(1, total // passos)
 
-                if upstreams:
-                    sed_in[i] = sed_local + sum(sed_out[up] for up in upstreams)
-                else:
-                    sed_in[i] = sed_local
+    return progresso
 
-                # 2. Saída de sedimentos
-                if ruptura_dict[i]:
-                    # Cálculo da massa erodida local usando a densidade específica deste nó
-                    vol_erodido = sedimentos_discharge.loc[sedimentos_discharge['subasin_id'] == i, 'volume_sedimento_erodido'].values[0]
-                    massa_erodida = vol_erodido * current_density
-                    
-                    sed_out[i] = sed_in[i] + massa_erodida
-                else:
-                    # Se não rompeu, aplica a eficiência de retenção
-                    sed_out[i] = current_efficiency * sed_in[i]
 
-                """ print(
-                    f"Açude {i} | "
-                    f"Sed_in = {sed_in[i]:.2f} | "
-                    f"Sed_out = {sed_out[i]:.2f} | "
-                    f"Rompeu = {ruptura_dict[i]}"
-                ) """
+def on_calcular_click():
 
-            logger.info('Finalizando cálculo de sedimentos')
+    if calculo_em_andamento.is_set():
+        return
 
-            sedimentos_discharge['sedimento_afluente'] = (sedimentos_discharge['subasin_id'].map(sed_in).round(2))
-            sedimentos_discharge['sedimento_efluente'] = (    sedimentos_discharge['subasin_id'].map(sed_out).round(2))
+    # lê os widgets aqui, na thread principal; a thread de cálculo não toca no Tk
+    parametros = {
+        'nome': ent_name.get(),
+        'sedimentos': sedimentos_checkbox.get(),
+        'modo': radio_var.get(),
+        'densidade': ent_density.get(),
+        'eficiencia': ent_efficiency.get(),
+        'dataframes': dict(dataframes),
+        'topology': topologias.get('routing.dat')
+    }
 
-            result_discharge = result_discharge.merge(
-                sedimentos_discharge,
-                on='subasin_id')
-            """ print("result_discharge com sedimentos:")
-            print(result_discharge.head(10)) """
+    cancelar_calculo.clear()
+    calculo_em_andamento.set()
+    btn_calcular.config(state=tk.DISABLED)
+    btn_cancelar.config(state=tk.NORMAL)
 
-        result_discharge.to_csv(f"{nome}.dat", index=False)
+    threading.Thread(
+        target=calcular_com_perfil,
+        args=(parametros,),
+        daemon=True
+    ).start()
 
-        """ print("calculo de sedimentos finalizado!") """
 
-        txt_saida['state'] = tk.NORMAL
-        txt_saida.insert(tk.END, f"O arquivo {nome}.dat foi gerado com sucesso! \n")
-        txt_saida.see(tk.END)
-        txt_saida['state'] = tk.DISABLED
+def on_cancelar_click():
 
-    except Exception as e:
-        import traceback
-        erro = traceback.format_exc()
-        messagebox.showerror("Erro inesperado", erro)
-        logger.exception("Erro inesperado")
+    if calculo_em_andamento.is_set():
+        cancelar_calculo.set()
+        escrever_saida("Cancelando cálculo...\n")
 
     
 
 btn_calcular = tk.Button(root, command=on_calcular_click, text="Calcular", bg="#d9d9d9", font=('Arial', 12, 'bold'), height=2)
-btn_calcular.pack(pady=15, padx=20, fill="x")
+btn_calcular.pack(pady=(15, 5), padx=20, fill="x")
+
+btn_cancelar = tk.Button(root, command=on_cancelar_click, text="Cancelar", state=tk.DISABLED)
+btn_cancelar.pack(pady=(0, 10), padx=20, fill="x")
 
 # 4. ÁREA DE SAÍDA (LOG)    
 frame_saida = tk.LabelFrame(root, text="Saída", padx=10, pady=10)
@@ -449,6 +435,7 @@ frame_saida.pack(fill="both", expand=True, padx=20, pady=10)
 txt_saida = tk.Text(frame_saida, height=6, bg="#ffffff", state=tk.DISABLED)
 txt_saida.pack(fill="both", expand=True)
 
+root.after(100, processar_eventos)
 
 root.mainloop()
 
@@ -0,0 +1,274 @@
+import numpy as np
+import pandas as pd
+
+from data_utils import map_node_values, water_input_arrays
+from routing_engine import compile_topology, route_arrays
+
+# coluna perturbável -> posição em water_input_arrays
+PERTURBABLE_FIELDS = {
+    'runoff_volume': 0,
+    'runoff_peak_discharge': 1,
+    'water_storage_capacity': 2,
+    'spillway_discharge': 3
+}
+
+DEFAULT_QUANTILES = (0.05, 0.5, 0.95)
+
+
+class StreamingStats:
+
+    # estatísticas por nó atualizadas a cada lote de cenários (N x C): contagem
+    # de rupturas, média/variância (Welford/Chan) e, para os quantis, um
+    # histograma de bins logarítmicos por nó e por métrica. A faixa de cada nó
+    # sai do primeiro lote (alargada para os dois lados) e fica fixa; o que cai
+    # fora dela vai para os bins das pontas, limitados pelo mínimo e máximo
+    # exatos. São `bins` contadores por nó, então a memória não depende do nº
+    # de amostras e todos os nós têm quantis (ou só os de quantile_nodes)
+
+    def __init__(self, n_nodes, bins=128, quantile_nodes=None):
+        if bins < 3:
+            raise ValueError(f"bins deve ser pelo menos 3: {bins}")
+        self.n = 0
+        self.failures = np.zeros(n_nodes, dtype=np.int64)
+        self.bins = bins
+        self.quantile_nodes = (
+            np.asarray(quantile_nodes, dtype=np.int64) if quantile_nodes is not None
+            else np.arange(n_nodes, dtype=np.int64)
+        )
+        self._mean = {}
+        self._m2 = {}
+        self._histograma = {}
+
+    def _update_moments(self, nome, valores, n_antes):
+        c = valores.shape[1]
+        media_lote = valores.mean(axis=1)
+        m2_lote = ((valores - media_lote[:, None]) ** 2).sum(axis=1)
+
+        if nome not in self._mean:
+            self._mean[nome] = media_lote
+            self._m2[nome] = m2_lote
+            return
+
+        total = n_antes + c
+        delta = media_lote - self._mean[nome]
+        self._mean[nome] = self._mean[nome] + delta * (c / total)
+        self._m2[nome] = self._m2[nome] + m2_lote + delta ** 2 * (n_antes * c / total)
+
+    def _new_histogram(self, valores):
+        # faixa log por nó: a do primeiro lote, alargada de um tanto igual à
+        # própria largura (no mínimo uma década) de cada lado
+        positivos = valores > 0
+        logs = np.log(np.where(positivos, valores, 1.0))
+        baixo = np.where(positivos, logs, np.inf).min(axis=1)
+        alto = np.where(positivos, logs, -np.inf).max(axis=1)
+        sem_positivos = ~positivos.any(axis=1)
+        baixo[sem_positivos] = alto[sem_positivos] = 0.0
+        margem = np.maximum(alto - baixo, np.log(10.0))
+        baixo -= margem
+        alto += margem
+        escala = (self.bins - 2) / (alto - baixo)
+        return {
+            'contagens': np.zeros((len(valores), self.bins), dtype=np.uint32),
+            'log_min': baixo,
+            'escala': escala,
+            # bin de v: log(v) * escala + deslocamento (o 1 é o bin 0)
+            'deslocamento': 1.0 - baixo * escala,
+            'minimo': np.full(len(valores), np.inf),
+            'maximo': np.full(len(valores), -np.inf),
+            'nan': np.zeros(len(valores), dtype=bool)
+        }
+
+    def _update_histogram(self, nome, valores, bloco=1 << 20):
+        valores = valores[self.quantile_nodes]
+        if nome not in self._histograma:
+            self._histograma[nome] = self._new_histogram(valores)
+        h = self._histograma[nome]
+        k = self.bins
+
+        h['nan'] |= np.isnan(valores).any(axis=1)
+        np.fmin(h['minimo'], np.nanmin(valores, axis=1, initial=np.inf), out=h['minimo'])
+        np.fmax(h['maximo'], np.nanmax(valores, axis=1, initial=-np.inf), out=h['maximo'])
+
+        # bin 0: abaixo da faixa (e zeros); bin k - 1: acima dela. Em blocos de
+        # nós para o bincount não alocar N x bins de uma vez
+        linhas = max(1, bloco // max(k, valores.shape[1]))
+        for a in range(0, len(valores), linhas):
+            b = min(a + linhas, len(valores))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                posicao = np.log(valores[a:b])
+            posicao *= h['escala'][a:b, None]
+            posicao += h['deslocamento'][a:b, None]
+            # fmax leva NaN (nós sem açude) e -inf (zeros) para o bin 0
+            np.fmax(posicao, 0.0, out=posicao)
+            np.minimum(posicao, k - 1, out=posicao)
+            indice = posicao.astype(np.intp)
+            indice += (np.arange(b - a) * k)[:, None]
+            contagem = np.bincount(indice.ravel(), minlength=(b - a) * k)
+            h['contagens'][a:b] += contagem.reshape(b - a, k).astype(np.uint32)
+
+    def update(self, rompeu, **valores):
+        n_antes = self.n
+        self.failures += rompeu.sum(axis=1)
+        for nome, v in valores.items():
+            self._update_moments(nome, v, n_antes)
+            if len(self.quantile_nodes):
+                self._update_histogram(nome, v)
+        self.n += rompeu.shape[1]
+
+    def failure_frequency(self):
+        return self.failures / self.n if self.n else np.full(len(self.failures), np.nan)
+
+    def mean(self, nome):
+        return self._mean[nome]
+
+    def variance(self, nome, ddof=1):
+        if self.n <= ddof:
+            return np.full(len(self.failures), np.nan)
+        return self._m2[nome] / (self.n - ddof)
+
+    def quantile(self, nome, q):
+        # (len(q), N), com NaN nos nós fora de quantile_nodes; dentro do bin a
+        # interpolação é linear no log (nas pontas, linear até o mínimo/máximo)
+        q = np.atleast_1d(q)
+        resultado = np.full((len(q), len(self.failures)), np.nan)
+        if not self.n or nome not in self._histograma:
+            return resultado
+
+        h = self._histograma[nome]
+        k = self.bins
+        acumulado = np.cumsum(h['contagens'], axis=1, dtype=np.int64)
+        total = acumulado[:, -1]
+        linhas = np.arange(len(total))
+        borda_baixa = np.exp(h['log_min'])
+        borda_alta = np.exp(h['log_min'] + (k - 2) / h['escala'])
+
+        for i, p in enumerate(q):
+            posto = p * (total - 1)
+            j = (acumulado <= posto[:, None]).sum(axis=1)
+            antes = np.where(j > 0, acumulado[linhas, j - 1], 0)
+            f = (posto - antes + 0.5) / np.maximum(acumulado[linhas, j] - antes, 1)
+            f = np.clip(f, 0.0, 1.0)
+
+            valor = np.exp(h['log_min'] + (j - 1 + f) / h['escala'])
+            valor = np.where(j == 0, h['minimo'] + f * (borda_baixa - h['minimo']), valor)
+            valor = np.where(j == k - 1, borda_alta + f * (h['maximo'] - borda_alta), valor)
+            valor = np.clip(valor, h['minimo'], h['maximo'])
+            valor[h['nan']] = np.nan
+            resultado[i, self.quantile_nodes] = valor
+        return resultado
+
+
+def _perturb(base, sigma, rng, c):
+    # fator multiplicativo lognormal com média 1
+    fator = rng.lognormal(-0.5 * sigma ** 2, sigma, size=(c, len(base))).T
+    return base[:, None] * fator
+
+
+def iter_monte_carlo(
+    df_reservoir,
+    df_routing,
+    df_runoff,
+    perturbations,
+    n_samples,
+    chunk_size=256,
+    seed=None,
+    bins=128,
+    topology=None,
+    params=None,
+    quantile_nodes=None):
+
+    # perturbations: {coluna: sigma}; cada nó recebe um fator lognormal
+    # independente por amostra. Gera (stats, amostras_processadas) após cada lote.
+    # quantile_nodes: restringe os quantis a estes subasin_ids (padrão: todos)
+    for nome in perturbations:
+        if nome not in PERTURBABLE_FIELDS:
+            raise ValueError(f"Campo não perturbável: {nome}")
+    if n_samples <= 0:
+        raise ValueError(f"n_samples deve ser positivo: {n_samples}")
+
+    if topology is None:
+        topology = compile_topology(df_routing)
+    if quantile_nodes is not None:
+        ids_quantis = np.atleast_1d(quantile_nodes)
+        quantile_nodes = np.unique(topology.index_of(ids_quantis))
+        if len(quantile_nodes) and quantile_nodes[0] < 0:
+            faltando = ids_quantis[topology.index_of(ids_quantis) < 0]
+            raise KeyError(f"Subbacias fora da rede de drenagem: {faltando.tolist()}")
+    df_merged = df_reservoir.merge(df_runoff, on='subasin_id', how='left')
+    base = water_input_arrays(topology, df_merged)
+
+    # um gerador por campo: a sequência de amostras não depende do chunk_size
+    sementes = np.random.SeedSequence(seed).spawn(len(PERTURBABLE_FIELDS))
+    geradores = {
+        nome: np.random.default_rng(sementes[i])
+        for nome, i in PERTURBABLE_FIELDS.items()
+    }
+    stats = StreamingStats(topology.n_nodes, bins, quantile_nodes)
+
+    feitas = 0
+    while feitas < n_samples:
+        c = min(chunk_size, n_samples - feitas)
+
+        entradas = [
+            _perturb(base[i], perturbations[nome], geradores[nome], c) if nome in perturbations
+            else base[i][:, None]
+            for nome, i in PERTURBABLE_FIELDS.items()
+        ]
+        saida = route_arrays(topology, *entradas, params=params)
+
+        stats.update(
+            saida['rompeu'],
+            volume_total=saida['volume_out'],
+            vazão_de_saida=saida['peak_out']
+        )
+        feitas += c
+        yield stats, feitas
+
+
+def run_monte_carlo(
+    df_reservoir,
+    df_routing,
+    df_runoff,
+    perturbations,
+    n_samples,
+    chunk_size=256,
+    seed=None,
+    quantiles=DEFAULT_QUANTILES,
+    bins=128,
+    topology=None,
+    params=None,
+    quantile_nodes=None):
+
+    if topology is None:
+        topology = compile_topology(df_routing)
+
+    stats = None
+    for stats, _ in iter_monte_carlo(
+        df_reservoir, df_routing, df_runoff, perturbations, n_samples,
+        chunk_size, seed, bins, topology, params, quantile_nodes
+    ):
+        pass
+
+    return monte_carlo_summary(stats, topology, df_runoff["subasin_id"], quantiles)
+
+
+def monte_carlo_summary(stats, topology, subasin_ids, quantiles=DEFAULT_QUANTILES):
+
+    ids = pd.Series(subasin_ids)
+    node_ids = topology.node_ids
+
+    colunas = {
+        "subasin_id": ids,
+        "amostras": stats.n,
+        "probabilidade_ruptura": map_node_values(ids, node_ids, stats.failure_frequency())
+    }
+    for nome in ('volume_total', 'vazão_de_saida'):
+        colunas[f"{nome}_media"] = map_node_values(ids, node_ids, stats.mean(nome))
+        colunas[f"{nome}_desvio"] = map_node_values(ids, node_ids, np.sqrt(stats.variance(nome)))
+        if not len(stats.quantile_nodes):
+            continue
+        valores = stats.quantile(nome, quantiles)
+        for q, linha in zip(quantiles, valores):
+            colunas[f"{nome}_p{round(q * 100):02d}"] = map_node_values(ids, node_ids, linha)
+
+    return pd.DataFrame(colunas)
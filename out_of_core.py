@@ -0,0 +1,503 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from data_utils import FILE_SCHEMAS, build_model_result, iter_dat_chunks
+from instrumentation import count, set_counter, stage
+from result_writer import open_result_writer
+from routing_engine import (
+    DEFAULT_PARAMS,
+    compute_levels,
+    eroded_volume,
+    integer_volumes,
+    ordered_sum,
+    routing_edges,
+    sediment_step,
+    sort_topology,
+    sum_plan,
+    water_step
+)
+
+STORE_VERSION = 1
+
+TOPOLOGY_FILES = ('node_ids', 'level_bounds', 'edge_src', 'edge_dst', 'edge_bounds', 'out_degree')
+WATER_FILES = ('runoff_volume', 'runoff_peak', 'storage_capacity', 'spillway')
+SEDIMENT_FILES = ('sed_local', 'dam_height', 'density', 'efficiency')
+OUTPUT_FIELDS = ('volume_in', 'volume_out', 'peak_in', 'peak_out', 'rompeu')
+SEDIMENT_OUTPUTS = ('sed_in', 'sed_out', 'eroded_volume')
+
+DEFAULT_CHUNKSIZE = 500000
+DEFAULT_CHUNK_ROWS = 200000
+# bytes de cada matriz (nós x cenários) de um bloco de nível
+DEFAULT_BLOCK_BYTES = 16 * 2 ** 20
+
+
+def _read_routing(path, chunksize):
+    # só as três colunas inteiras: a topologia é O(N) inteiros, não O(N x S)
+    blocos = list(iter_dat_chunks(path, FILE_SCHEMAS['routing.dat'], chunksize))
+    if not blocos:
+        return pd.DataFrame(columns=FILE_SCHEMAS['routing.dat']['names'])
+    return pd.concat(blocos, ignore_index=True)
+
+
+def compile_late_topology(df_routing):
+
+    # níveis "o mais tarde possível": nível máximo menos o maior caminho até
+    # um exutório. Numa árvore cada nó fica no nível logo antes do seu
+    # jusante, e a frente de vazões efluentes nunca passa de um nível
+    with stage('graph_build'):
+        ids, src, dst = routing_edges(df_routing)
+    with stage('topological_sort'):
+        ate_exutorio = compute_levels(len(ids), dst, src)
+        topology = sort_topology(ids, src, dst, ate_exutorio.max(initial=0) - ate_exutorio)
+
+    set_counter('nodes', topology.n_nodes)
+    set_counter('edges', topology.n_edges)
+    set_counter('levels', topology.n_levels)
+    return topology
+
+
+def _scatter(topology, path, nome_arquivo, colunas, destinos, chunksize, presentes=None):
+
+    # grava as colunas do .dat na posição topológica de cada id, bloco a
+    # bloco; com ids repetidos vale a última linha, como em node_array.
+    # Devolve as colunas que vieram inteiras em todos os blocos
+    inteiras = set(colunas)
+    for bloco in iter_dat_chunks(path, FILE_SCHEMAS[nome_arquivo], chunksize):
+        count('rows_read', len(bloco))
+        pos = topology.index_of(bloco['subasin_id'].to_numpy())
+        ok = pos >= 0
+        if presentes is not None:
+            presentes[pos[ok]] = True
+        for coluna, destino in zip(colunas, destinos):
+            destino[pos[ok]] = bloco[coluna].to_numpy(dtype=np.float64)[ok]
+            if not pd.api.types.is_integer_dtype(bloco[coluna]):
+                inteiras.discard(coluna)
+    return inteiras
+
+
+def prepare_store(
+    directory,
+    reservoir,
+    routing,
+    runoff=None,
+    runoff_files=None,
+    sedyield=None,
+    sed_param=None,
+    density=None,
+    efficiency=None,
+    chunksize=DEFAULT_CHUNKSIZE):
+
+    # converte os .dat num diretório de vetores .npy na ordem topológica (nós
+    # agrupados por nível), lidos depois por memory-map um nível por vez.
+    # runoff_files: um runoff.dat por cenário, colunas da matriz N x S;
+    # density/efficiency (fração) valem para os nós fora do sed_param.dat
+    if (runoff is None) == (runoff_files is None):
+        raise ValueError("Informe runoff ou runoff_files.")
+    runoff_files = [runoff] if runoff_files is None else list(runoff_files)
+    os.makedirs(directory, exist_ok=True)
+
+    def novo(nome, forma, fill=np.nan):
+        valores = np.lib.format.open_memmap(
+            os.path.join(directory, f'{nome}.npy'), mode='w+', dtype=np.float64, shape=forma
+        )
+        valores[...] = fill
+        return valores
+
+    topology = compile_late_topology(_read_routing(routing, chunksize))
+    n = topology.n_nodes
+
+    with stage('store_write'):
+        for nome in TOPOLOGY_FILES[:-1]:
+            np.save(os.path.join(directory, f'{nome}.npy'), getattr(topology, nome))
+        # quantos nós de jusante ainda vão ler a vazão efluente de cada nó
+        np.save(
+            os.path.join(directory, 'out_degree.npy'),
+            np.bincount(topology.edge_src, minlength=n).astype(np.int32)
+        )
+
+        gravados = []
+        com_reservatorio = np.zeros(n, dtype=bool)
+        colunas = ['water_storage_capacity', 'spillway_discharge']
+        destinos = [novo('storage_capacity', (n,)), novo('spillway', (n,))]
+        if sedyield is not None:
+            colunas.append('dam_height')
+            destinos.append(novo('dam_height', (n,)))
+        inteiras = _scatter(topology, reservoir, 'reservoir.dat', colunas, destinos, chunksize, com_reservatorio)
+        inteiras.add('runoff_volume')
+        gravados += destinos
+
+        volume = novo('runoff_volume', (n, len(runoff_files)))
+        pico = novo('runoff_peak', (n, len(runoff_files)))
+        for s, caminho in enumerate(runoff_files):
+            if 'runoff_volume' not in _scatter(
+                topology, caminho, 'runoff.dat', ['runoff_volume', 'runoff_peak_discharge'],
+                [volume[:, s], pico[:, s]], chunksize
+            ):
+                inteiras.discard('runoff_volume')
+        # escoamento só para ids também presentes no reservoir.dat (merge à
+        # esquerda do calculate_routing)
+        sem_reservatorio = np.flatnonzero(~com_reservatorio)
+        volume[sem_reservatorio] = np.nan
+        pico[sem_reservatorio] = np.nan
+        gravados += [volume, pico]
+
+        # colunas inteiras do .dat, como em detect_integer_fields: açude sem
+        # escoamento deixa o volume em float no merge
+        com_reservatorio = np.flatnonzero(com_reservatorio)
+        for i in range(0, len(com_reservatorio), DEFAULT_CHUNK_ROWS):
+            if np.isnan(volume[com_reservatorio[i:i + DEFAULT_CHUNK_ROWS]]).any():
+                inteiras.discard('runoff_volume')
+                break
+        integer_fields = [
+            nome for nome, coluna in (('runoff_volume', 'runoff_volume'), ('storage_capacity', 'water_storage_capacity'))
+            if coluna in inteiras
+        ]
+
+        if sedyield is not None:
+            sedimento = novo('sed_local', (n,))
+            _scatter(topology, sedyield, 'sedyield.dat', ['sed_enter_volume'], [sedimento], chunksize)
+            densidade = novo('density', (n,), density if density else 1.5)
+            eficiencia = novo('efficiency', (n,), efficiency if efficiency else 0.50)
+            if sed_param is not None:
+                _scatter(
+                    topology, sed_param, 'sed_param.dat',
+                    ['sediment_density', 'sediment_retention_efficiency'], [densidade, eficiencia], chunksize
+                )
+            gravados += [sedimento, densidade, eficiencia]
+
+        for valores in gravados:
+            valores.flush()
+        del gravados, destinos, volume, pico
+
+    meta = {
+        'version': STORE_VERSION,
+        'n_nodes': int(n),
+        'n_edges': int(topology.n_edges),
+        'n_levels': int(topology.n_levels),
+        'n_scenarios': len(runoff_files),
+        'widest_level': int(np.diff(topology.level_bounds).max(initial=0)),
+        'sediment': sedyield is not None,
+        'integer_fields': integer_fields
+    }
+    with open(os.path.join(directory, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump(meta, f, indent=2)
+    return OutOfCoreBasin(directory)
+
+
+class OutOfCoreBasin:
+
+    # bacia gravada por prepare_store; os vetores ficam em disco (mmap) e a
+    # propagação lê um nível por vez, com residentes só o bloco do nível e a
+    # frente de vazões efluentes que ainda vão para jusante
+    def __init__(self, directory):
+        with open(os.path.join(directory, 'meta.json'), encoding='utf-8') as f:
+            self.meta = json.load(f)
+        if self.meta.get('version') != STORE_VERSION:
+            raise ValueError(f"Versão de store incompatível em {directory}")
+        self.directory = directory
+        nomes = TOPOLOGY_FILES + WATER_FILES + (SEDIMENT_FILES if self.has_sediment else ())
+        self.arrays = {
+            nome: np.load(os.path.join(directory, f'{nome}.npy'), mmap_mode='r') for nome in nomes
+        }
+        self.stats = {}
+
+    @property
+    def n_nodes(self):
+        return self.meta['n_nodes']
+
+    @property
+    def n_levels(self):
+        return self.meta['n_levels']
+
+    @property
+    def n_scenarios(self):
+        return self.meta['n_scenarios']
+
+    @property
+    def widest_level(self):
+        return self.meta['widest_level']
+
+    @property
+    def has_sediment(self):
+        return self.meta['sediment']
+
+    def __getitem__(self, nome):
+        return self.arrays[nome]
+
+    def default_block_nodes(self, block_bytes=DEFAULT_BLOCK_BYTES):
+        # nós por bloco para que cada matriz do bloco caiba em block_bytes
+        return max(1, int(block_bytes) // (8 * max(self.n_scenarios, 1)))
+
+    def frontier_capacity(self):
+
+        # maior frente da propagação (nós já propagados cuja vazão efluente
+        # ainda será lida a jusante), contada só com a topologia em inteiros
+        arq = self.arrays
+        level_bounds = np.asarray(arq['level_bounds'])
+        edge_bounds = np.asarray(arq['edge_bounds'])
+        pendentes = np.array(arq['out_degree'])
+        tamanho = pico = 0
+        for nivel in range(self.n_levels):
+            a, b = int(level_bounds[nivel]), int(level_bounds[nivel + 1])
+            src = np.asarray(arq['edge_src'][int(edge_bounds[nivel]):int(edge_bounds[nivel + 1])])
+            tamanho += int(np.count_nonzero(pendentes[a:b]))
+            pico = max(pico, tamanho)
+            np.subtract.at(pendentes, src, 1)
+            tamanho -= int(np.count_nonzero(pendentes[np.unique(src)] == 0))
+        return pico
+
+    def iter_levels(self, params=None, block_nodes=None):
+
+        # (nível, a, b, saída de [a, b) como em route_arrays, (b - a) x S).
+        # Níveis largos são divididos em blocos de até block_nodes nós (os nós
+        # de um nível não dependem uns dos outros). Mesmas operações e mesma
+        # soma dos afluentes (ordered_sum) que route_arrays: resultado
+        # idêntico ao da propagação em memória
+        params = params or DEFAULT_PARAMS
+        block_nodes = block_nodes or self.default_block_nodes()
+        arq = self.arrays
+        n_cenarios = self.n_scenarios
+        level_bounds = np.asarray(arq['level_bounds'])
+        edge_bounds = np.asarray(arq['edge_bounds'])
+        com_sedimentos = self.has_sediment
+        campos = ('volume_out', 'peak_out') + (('sed_out',) if com_sedimentos else ())
+
+        # frente alocada uma vez no tamanho máximo: posições (crescentes),
+        # leituras pendentes a jusante e as vazões efluentes; as k primeiras
+        # linhas estão em uso
+        capacidade = self.frontier_capacity()
+        frente_pos = np.empty(capacidade, dtype=np.int64)
+        pendentes = np.empty(capacidade, dtype=np.int32)
+        frente = {campo: np.empty((capacidade, n_cenarios)) for campo in campos}
+        # volume_out que a referência guarda como int (ver route_arrays)
+        integer_fields = self.meta.get('integer_fields', [])
+        inteiros = 'runoff_volume' in integer_fields
+        if inteiros:
+            frente['volume_inteiro'] = np.empty((capacidade, n_cenarios), dtype=bool)
+        k = 0
+        bytes_frente = frente_pos.nbytes + pendentes.nbytes + sum(v.nbytes for v in frente.values())
+        self.stats = {'block_nodes': block_nodes, 'peak_frontier': capacidade, 'peak_resident_bytes': bytes_frente}
+
+        def coluna(nome, a, b):
+            return np.asarray(arq[nome][a:b])[:, None]
+
+        for nivel in range(self.n_levels):
+            inicio_nivel, fim_nivel = int(level_bounds[nivel]), int(level_bounds[nivel + 1])
+            e0, e1 = int(edge_bounds[nivel]), int(edge_bounds[nivel + 1])
+            src_nivel = np.asarray(arq['edge_src'][e0:e1])
+            dst_nivel = np.asarray(arq['edge_dst'][e0:e1])
+            origem_nivel = np.searchsorted(frente_pos[:k], src_nivel)
+
+            for a in range(inicio_nivel, fim_nivel, block_nodes):
+                b = min(a + block_nodes, fim_nivel)
+                # máscara estável: cada nó soma seus afluentes na ordem do routing.dat
+                no_bloco = (dst_nivel >= a) & (dst_nivel < b)
+                plano = sum_plan(origem_nivel[no_bloco], dst_nivel[no_bloco] - a, b - a)
+                forma = (b - a, n_cenarios)
+
+                def montante(campo, marcas=None):
+                    return ordered_sum(plano, frente[campo], forma, None if marcas is None else frente[marcas])
+
+                runoff_volume = np.asarray(arq['runoff_volume'][a:b])
+                capacidade_bloco = coluna('storage_capacity', a, b)
+                v_up, v_up_inteiro = montante('volume_out', 'volume_inteiro' if inteiros else None)
+                v_in = runoff_volume + v_up
+                p_in = np.asarray(arq['runoff_peak'][a:b]) + montante('peak_out')[0]
+                v_out, p_out, r = water_step(v_in, p_in, capacidade_bloco, coluna('spillway', a, b), params)
+                saida = {'volume_in': v_in, 'volume_out': v_out, 'peak_in': p_in, 'peak_out': p_out, 'rompeu': r}
+                if inteiros:
+                    v_inteiro = v_up_inteiro & integer_volumes(runoff_volume, capacidade_bloco, r, integer_fields)
+
+                if com_sedimentos:
+                    e = eroded_volume(r, np.trunc(v_out), coluna('dam_height', a, b), params)
+                    s_in = coluna('sed_local', a, b) + montante('sed_out')[0]
+                    saida.update(
+                        sed_in=s_in,
+                        sed_out=sediment_step(s_in, r, e, coluna('density', a, b), coluna('efficiency', a, b)),
+                        eroded_volume=e
+                    )
+
+                # nós do bloco com jusante entram no fim da frente
+                grau = np.asarray(arq['out_degree'][a:b])
+                novos = np.flatnonzero(grau > 0)
+                m = len(novos)
+                frente_pos[k:k + m] = a + novos
+                pendentes[k:k + m] = grau[novos]
+                for campo in campos:
+                    frente[campo][k:k + m] = saida[campo][novos]
+                if inteiros:
+                    frente['volume_inteiro'][k:k + m] = v_inteiro[novos]
+                k += m
+
+                residente = bytes_frente + sum(v.nbytes for v in saida.values())
+                self.stats['peak_resident_bytes'] = max(self.stats['peak_resident_bytes'], residente)
+
+                yield nivel, a, b, saida
+
+            # sai da frente quem já foi lido por todos os nós de jusante;
+            # compactação no lugar, em fatias do tamanho de um bloco (o destino
+            # nunca passa à frente da origem)
+            if len(src_nivel):
+                np.subtract.at(pendentes, origem_nivel, 1)
+            manter = np.flatnonzero(pendentes[:k] > 0)
+            for i in range(0, len(manter), block_nodes):
+                linhas = manter[i:i + block_nodes]
+                for valores in (frente_pos, pendentes, *frente.values()):
+                    valores[i:i + len(linhas)] = valores[linhas]
+            k = len(manter)
+
+    def route(self, output=None, format='dat', params=None, matrices_dir=None,
+              chunk_rows=DEFAULT_CHUNK_ROWS, block_nodes=None):
+
+        # propaga nível a nível e grava o resultado em fluxo, na ordem dos
+        # níveis (não na do runoff.dat). Um cenário: mesmas colunas do
+        # calculate_routing; vários: o resumo do calculate_ensemble_routing.
+        # matrices_dir recebe as saídas completas (N x S, ordem topológica)
+        # como .npy gravados por memory-map
+        inicio = time.perf_counter()
+        arq = self.arrays
+        node_ids = arq['node_ids']
+        escritor = open_result_writer(output, format) if output is not None else None
+
+        matrizes = {}
+        if matrices_dir is not None:
+            os.makedirs(matrices_dir, exist_ok=True)
+            np.save(os.path.join(matrices_dir, 'node_ids.npy'), node_ids)
+            nomes = OUTPUT_FIELDS + (SEDIMENT_OUTPUTS if self.has_sediment else ())
+            for nome in nomes:
+                matrizes[nome] = np.lib.format.open_memmap(
+                    os.path.join(matrices_dir, f'{nome}.npy'), mode='w+',
+                    dtype=bool if nome == 'rompeu' else np.float64, shape=(self.n_nodes, self.n_scenarios)
+                )
+
+        falhas = 0
+        pendentes, linhas_pendentes = [], 0
+        try:
+            for nivel, a, b, saida in self.iter_levels(params, block_nodes):
+                falhas += int(saida['rompeu'].sum())
+                for nome, destino in matrizes.items():
+                    destino[a:b] = saida[nome]
+                if escritor is None:
+                    continue
+
+                ids = np.asarray(node_ids[a:b])
+                if self.n_scenarios == 1:
+                    bloco = build_model_result(
+                        pd.DataFrame({'subasin_id': ids}), ids, {k: v[:, 0] for k, v in saida.items()}
+                    )
+                else:
+                    bloco = _ensemble_summary(ids, saida)
+                pendentes.append(bloco)
+                linhas_pendentes += len(bloco)
+                if linhas_pendentes >= chunk_rows:
+                    escritor.write(pd.concat(pendentes, ignore_index=True))
+                    pendentes, linhas_pendentes = [], 0
+
+            if escritor is not None and (pendentes or linhas_pendentes == 0):
+                escritor.write(pd.concat(pendentes, ignore_index=True) if pendentes else _empty_result(self))
+        finally:
+            if escritor is not None:
+                escritor.close()
+            for destino in matrizes.values():
+                destino.flush()
+
+        set_counter('nodes', self.n_nodes)
+        set_counter('levels', self.n_levels)
+        set_counter('failures', falhas)
+        return {
+            'nodes': self.n_nodes,
+            'levels': self.n_levels,
+            'scenarios': self.n_scenarios,
+            'failures': falhas,
+            'widest_level': self.widest_level,
+            **self.stats,
+            'timings': {'total': time.perf_counter() - inicio}
+        }
+
+
+def _ensemble_summary(ids, saida):
+    # mesmas colunas e contas do resumo do calculate_ensemble_routing
+    return pd.DataFrame({
+        "subasin_id": ids,
+        "probabilidade_ruptura": saida['rompeu'].mean(axis=1),
+        "volume_total_medio": saida['volume_out'].mean(axis=1),
+        "volume_total_max": saida['volume_out'].max(axis=1),
+        "vazão_de_saida_media": saida['peak_out'].mean(axis=1),
+        "vazão_de_saida_max": saida['peak_out'].max(axis=1)
+    })
+
+
+def _empty_result(basin):
+    vazio = {nome: np.empty((0, basin.n_scenarios)) for nome in OUTPUT_FIELDS + SEDIMENT_OUTPUTS}
+    ids = np.empty(0, dtype=np.int64)
+    if basin.n_scenarios == 1:
+        if not basin.has_sediment:
+            vazio = {nome: vazio[nome] for nome in OUTPUT_FIELDS}
+        return build_model_result(pd.DataFrame({'subasin_id': ids}), ids, {k: v[:, 0] for k, v in vazio.items()})
+    return _ensemble_summary(ids, vazio)
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(
+        prog='out_of_core',
+        description='Propagação fora da memória: a bacia vai para vetores em disco e é lida nível a nível.'
+    )
+    comandos = parser.add_subparsers(dest='comando', required=True)
+
+    prep = comandos.add_parser('prepare', help='converte os .dat num store em disco')
+    prep.add_argument('store')
+    prep.add_argument('--reservoir', required=True)
+    prep.add_argument('--routing', required=True)
+    prep.add_argument('--runoff', help='runoff.dat de um cenário')
+    prep.add_argument('--runoff-files', dest='runoff_files', nargs='+', help='um runoff.dat por cenário')
+    prep.add_argument('--sedyield', help='caminho do sedyield.dat (ativa sedimentos)')
+    prep.add_argument('--sed-param', dest='sed_param', help='caminho do sed_param.dat (modo arquivo)')
+    prep.add_argument('--density', type=float, help='densidade aparente seca (g/cm³), modo manual')
+    prep.add_argument('--efficiency', type=float, help='eficiência de retenção (%%), modo manual')
+    prep.add_argument('--chunksize', type=int, default=DEFAULT_CHUNKSIZE, help='linhas lidas por bloco')
+
+    rota = comandos.add_parser('route', help='propaga um store e grava o resultado em fluxo')
+    rota.add_argument('store')
+    rota.add_argument('-o', '--output', help='arquivo de resultado (por nó; resumo com vários cenários)')
+    rota.add_argument('--format', dest='output_format', choices=['dat', 'wasa', 'columnar'], default='dat')
+    rota.add_argument('--matrices', help='diretório para as saídas completas N x S em .npy')
+    rota.add_argument('--chunk-rows', dest='chunk_rows', type=int, default=DEFAULT_CHUNK_ROWS)
+    rota.add_argument('--block-nodes', dest='block_nodes', type=int,
+                      help='nós por bloco de nível (padrão: matrizes de 16 MiB)')
+    args = parser.parse_args(argv)
+
+    try:
+        if args.comando == 'prepare':
+            if args.sedyield and not args.sed_param and args.density is None and args.efficiency is None:
+                raise ValueError("Informe sed_param ou density/efficiency para simular sedimentos.")
+            basin = prepare_store(
+                args.store, args.reservoir, args.routing, args.runoff, args.runoff_files,
+                args.sedyield, args.sed_param, args.density,
+                # eficiência em %, como no basinflow
+                args.efficiency / 100 if args.efficiency is not None else None,
+                args.chunksize
+            )
+            print(json.dumps(basin.meta, ensure_ascii=False))
+        else:
+            if not args.output and not args.matrices:
+                raise ValueError("Informe --output e/ou --matrices.")
+            relatorio = OutOfCoreBasin(args.store).route(
+                args.output, args.output_format, matrices_dir=args.matrices,
+                chunk_rows=args.chunk_rows, block_nodes=args.block_nodes
+            )
+            print(json.dumps(relatorio, ensure_ascii=False))
+    except (OSError, ValueError) as e:
+        print(f"out_of_core: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,154 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from routing_engine import partition_components, route_arrays, subtopology
+from shared_arrays import SharedArrays, attach_topology, share_topology
+
+WATER_OUTPUTS = ('volume_in', 'volume_out', 'peak_in', 'peak_out')
+SEDIMENT_OUTPUTS = ('sed_in', 'sed_out', 'eroded_volume')
+
+# estado de cada processo do pool, preenchido uma vez pelo initializer
+_worker = {}
+
+
+def pool_context():
+    # com fork os workers sobem mais rápido; os dados vêm sempre dos
+    # segmentos compartilhados, então spawn também funciona
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('fork')
+    return multiprocessing.get_context()
+
+
+def _init_worker(spec, prefixo, entradas, saidas, params, integer_fields=()):
+    # entradas/saidas: nome do argumento/resultado -> nome no SharedArrays
+    buffers = SharedArrays.attach(spec)
+    _worker['buffers'] = buffers
+    _worker['topology'] = attach_topology(buffers, prefixo + 'topology.')
+    _worker['entradas'] = {nome: (buffers[chave] if chave else None) for nome, chave in entradas.items()}
+    _worker['saida'] = {nome: buffers[chave] for nome, chave in saidas.items()}
+    _worker['params'] = params
+    _worker['integer_fields'] = integer_fields
+
+
+def _route_part(tarefa):
+
+    # tarefa: (posições de sub-bacias inteiras ou None, colunas de cenários ou None);
+    # o resultado vai direto para os vetores de saída compartilhados
+    positions, colunas = tarefa
+    topology = _worker['topology']
+    entradas = _worker['entradas']
+    saida = _worker['saida']
+
+    if colunas is not None:
+        a, b = colunas
+        entradas = {
+            nome: (valores[:, a:b] if valores is not None and valores.ndim == 2 and valores.shape[1] > 1 else valores)
+            for nome, valores in entradas.items()
+        }
+    if positions is not None:
+        topology = subtopology(topology, positions)
+        entradas = {
+            nome: (valores[positions] if valores is not None else None)
+            for nome, valores in entradas.items()
+        }
+
+    parcial = route_arrays(topology, **entradas, params=_worker['params'], integer_fields=_worker['integer_fields'])
+
+    linhas = positions if positions is not None else slice(None)
+    for nome, valores in parcial.items():
+        destino = saida[nome]
+        if colunas is not None:
+            destino[linhas, colunas[0]:colunas[1]] = valores
+        else:
+            destino[linhas] = valores
+    return topology.n_nodes
+
+
+def _shared_name(buffers, valores):
+    # vetor que já mora no SharedArrays não é copiado de novo
+    for chave in buffers:
+        if buffers[chave] is valores:
+            return chave
+    return None
+
+
+def _plan(topology, processes, n_cenarios):
+
+    # sub-bacias independentes primeiro; se sobrarem processos (poucas
+    # sub-bacias, ensembles grandes), os cenários são divididos em blocos
+    partes = [p for p in partition_components(topology, processes) if len(p)]
+    blocos = min(n_cenarios, max(1, -(-processes // max(len(partes), 1))))
+    limites = np.linspace(0, n_cenarios, blocos + 1).astype(np.int64)
+    colunas = [(int(a), int(b)) for a, b in zip(limites[:-1], limites[1:])] if blocos > 1 else [None]
+    if len(partes) <= 1:
+        partes = [None]
+    return [(p, c) for p in partes for c in colunas]
+
+
+def route_arrays_parallel(topology, processes=None, params=None, buffers=None, integer_fields=(), **entradas):
+
+    # sub-bacias independentes (exutórios distintos) e blocos de cenários são
+    # propagados em paralelo. Topologia, entradas e saídas ficam em memória
+    # compartilhada: os workers anexam os segmentos e escrevem suas fatias
+    # direto nos vetores de saída, sem pickle dos dados.
+    # Com buffers= (um SharedArrays do chamador), entradas que já estão nele
+    # não são copiadas e as saídas devolvidas são views desses segmentos,
+    # válidas até o close() do chamador.
+    processes = processes or os.cpu_count() or 1
+    agua = [np.asarray(entradas[nome]) for nome in ('runoff_volume', 'runoff_peak', 'storage_capacity', 'spillway')]
+    ndim = max(a.ndim for a in agua)
+    forma_saida = np.broadcast_shapes(*(a.shape + (1,) * (ndim - a.ndim) for a in agua))
+    n_cenarios = forma_saida[1] if ndim == 2 else 1
+
+    tarefas = _plan(topology, processes, n_cenarios)
+    if len(tarefas) <= 1:
+        return route_arrays(topology, **entradas, params=params, integer_fields=integer_fields)
+
+    proprio = buffers is None
+    if proprio:
+        buffers = SharedArrays()
+    try:
+        prefixo = f'routing{len(list(buffers))}.'
+        share_topology(buffers, topology, prefixo + 'topology.')
+
+        nomes_entrada = {}
+        for nome, valores in entradas.items():
+            if valores is None:
+                nomes_entrada[nome] = None
+                continue
+            chave = _shared_name(buffers, valores)
+            if chave is None:
+                chave = prefixo + nome
+                buffers.put(chave, valores)
+            nomes_entrada[nome] = chave
+
+        # mesmas chaves, ordem e dtypes do route_arrays
+        saida = {nome: buffers.empty(prefixo + nome, forma_saida) for nome in WATER_OUTPUTS}
+        saida['rompeu'] = buffers.empty(prefixo + 'rompeu', forma_saida, dtype=bool)
+        if entradas.get('sed_local') is not None:
+            saida.update({nome: buffers.empty(prefixo + nome, forma_saida) for nome in SEDIMENT_OUTPUTS})
+
+        with ProcessPoolExecutor(
+            max_workers=min(len(tarefas), processes),
+            mp_context=pool_context(),
+            initializer=_init_worker,
+            initargs=(
+                buffers.spec(), prefixo, nomes_entrada, {nome: prefixo + nome for nome in saida},
+                params, tuple(integer_fields)
+            )
+        ) as pool:
+            for _ in pool.map(_route_part, tarefas):
+                pass
+
+        if not proprio:
+            return saida
+        # os segmentos próprios são fechados no finally: as saídas saem copiadas
+        copia = {nome: np.array(valores) for nome, valores in saida.items()}
+        del saida
+        return copia
+    finally:
+        if proprio:
+            buffers.close()
@@ -0,0 +1,139 @@
+import numpy as np
+import pandas as pd
+
+from data_utils import FILE_SCHEMAS, build_water_result, detect_integer_fields
+from routing_engine import BasinTopology, node_levels, route_arrays
+
+
+class _RowLookup:
+
+    # subasin_id -> última linha do arquivo com esse id (como node_array)
+    def __init__(self, ids):
+        ids = np.asarray(ids)
+        ordem = np.argsort(ids, kind='stable')
+        ordenados = ids[ordem]
+        ultima = np.r_[ordenados[1:] != ordenados[:-1], True] if len(ids) else np.zeros(0, bool)
+        self._ids = ordenados[ultima]
+        self._rows = ordem[ultima]
+
+    def rows(self, ids):
+        if not len(self._ids):
+            return np.full(len(ids), -1, dtype=np.int64)
+        pos = np.clip(np.searchsorted(self._ids, ids), 0, len(self._ids) - 1)
+        return np.where(self._ids[pos] == ids, self._rows[pos], -1)
+
+
+class BasinQuery:
+
+    # consultas pontuais: só o fecho de montante dos alvos é extraído e
+    # propagado. Os índices de montante são montados uma vez; as colunas dos
+    # .dat são lidas apenas nas linhas dos nós do fecho (com o cache em memmap,
+    # as páginas dos nós fora do fecho nem chegam a ser lidas do disco).
+
+    def __init__(self, topology, df_reservoir, df_runoff, params=None):
+        self.topology = topology
+        self.params = params
+        self.df_reservoir = df_reservoir
+        self.df_runoff = df_runoff
+        self.integer_fields = detect_integer_fields(df_reservoir, df_runoff['runoff_volume'])
+        self._reservoir_rows = _RowLookup(df_reservoir['subasin_id'].to_numpy())
+        self._runoff_rows = _RowLookup(df_runoff['subasin_id'].to_numpy())
+
+        # montantes de cada nó (CSR), guardando o índice original da aresta
+        n = topology.n_nodes
+        self._pred_edges = np.argsort(topology.edge_dst, kind='stable')
+        self._pred_ptr = np.concatenate([[0], np.cumsum(np.bincount(topology.edge_dst, minlength=n))])
+        self._levels = node_levels(topology)
+
+    @classmethod
+    def from_files(cls, reservoir_path, routing_path, runoff_path, cache_dir=None, params=None):
+        from dat_cache import load_dat_file_cached, load_topology_cached
+
+        return cls(
+            load_topology_cached(routing_path),
+            load_dat_file_cached(reservoir_path, FILE_SCHEMAS["reservoir.dat"], cache_dir=cache_dir),
+            load_dat_file_cached(runoff_path, FILE_SCHEMAS["runoff.dat"], cache_dir=cache_dir),
+            params=params
+        )
+
+    def _incoming(self, positions):
+        # índices (originais) das arestas que chegam às posições dadas
+        inicio = self._pred_ptr[positions]
+        quantos = self._pred_ptr[positions + 1] - inicio
+        if not quantos.sum():
+            return np.zeros(0, dtype=np.int64)
+        deslocamento = np.arange(quantos.sum()) - np.repeat(np.cumsum(quantos) - quantos, quantos)
+        return self._pred_edges[np.repeat(inicio, quantos) + deslocamento]
+
+    def closure(self, subasin_ids):
+
+        # posições (crescentes) dos alvos e de tudo o que drena para eles
+        t = self.topology
+        alvos = t.index_of(np.atleast_1d(subasin_ids))
+        if (alvos < 0).any():
+            faltando = np.atleast_1d(subasin_ids)[alvos < 0]
+            raise KeyError(f"Subbacias fora da rede de drenagem: {faltando.tolist()}")
+
+        visitado = np.zeros(t.n_nodes, dtype=bool)
+        fronteira = np.unique(alvos)
+        visitado[fronteira] = True
+        fecho = [fronteira]
+        while len(fronteira):
+            montantes = np.unique(t.edge_src[self._incoming(fronteira)])
+            fronteira = montantes[~visitado[montantes]]
+            visitado[fronteira] = True
+            fecho.append(fronteira)
+
+        return np.sort(np.concatenate(fecho))
+
+    def subtopology(self, positions):
+
+        # fecho de montante: toda aresta que chega a um nó do fecho sai de
+        # outro nó do fecho, e os níveis (caminho mais longo desde as
+        # nascentes) não mudam
+        t = self.topology
+        arestas = np.sort(self._incoming(positions))
+        niveis = self._levels[positions]
+        n_niveis = int(niveis[-1]) + 1 if len(positions) else 0
+
+        return BasinTopology(
+            t.node_ids[positions],
+            np.searchsorted(niveis, np.arange(n_niveis + 1)),
+            np.searchsorted(positions, t.edge_src[arestas]),
+            np.searchsorted(positions, t.edge_dst[arestas]),
+            np.searchsorted(self._levels[t.edge_dst[arestas]], np.arange(n_niveis + 1))
+        )
+
+    def _gather(self, df, lookup, coluna, ids):
+        linhas = lookup.rows(ids)
+        valores = np.asarray(df[coluna])[np.maximum(linhas, 0)].astype(np.float64)
+        valores[linhas < 0] = np.nan
+        return valores
+
+    def route(self, subasin_ids, include_upstream=False):
+
+        # propaga só o fecho de montante; devolve as linhas dos alvos (ou do
+        # fecho inteiro) no mesmo formato de calculate_water_routing
+        posicoes = self.closure(subasin_ids)
+        sub = self.subtopology(posicoes)
+        ids = sub.node_ids
+
+        # mesma regra do merge reservoir/runoff: nó sem açude fica com NaN
+        no_reservatorio = self._reservoir_rows.rows(ids) >= 0
+        runoff_volume = self._gather(self.df_runoff, self._runoff_rows, 'runoff_volume', ids)
+        runoff_peak = self._gather(self.df_runoff, self._runoff_rows, 'runoff_peak_discharge', ids)
+        runoff_volume[~no_reservatorio] = np.nan
+        runoff_peak[~no_reservatorio] = np.nan
+
+        saida = route_arrays(
+            sub,
+            runoff_volume,
+            runoff_peak,
+            self._gather(self.df_reservoir, self._reservoir_rows, 'water_storage_capacity', ids),
+            self._gather(self.df_reservoir, self._reservoir_rows, 'spillway_discharge', ids),
+            params=self.params,
+            integer_fields=self.integer_fields
+        )
+
+        linhas = ids if include_upstream else np.atleast_1d(subasin_ids)
+        return build_water_result(pd.DataFrame({"subasin_id": linhas}), ids, saida)
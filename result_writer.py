@@ -0,0 +1,376 @@
+import io
+import json
+import queue
+import threading
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+from instrumentation import staged
+
+COLUMNAR_VERSION = 1
+
+_POTENCIAS = 10 ** np.arange(1, 19, dtype=np.uint64)
+_BOOL_TEXT = np.frombuffer(b'FalseTrue\0', dtype=np.uint8).reshape(2, 5)
+_BOOL_LEN = np.array([5, 4], dtype=np.int64)
+
+# cada campo formatado é (matriz N x W, início, comprimento): os bytes da
+# linha i são matriz[i, início[i]:início[i] + comprimento[i]]
+
+
+def _text_matrix(textos):
+    # lista/array de str -> matriz de bytes (N x W) alinhada à esquerda
+    codificado = np.char.encode(np.asarray(textos, dtype=object).astype(str), 'utf-8')
+    largura = max(codificado.dtype.itemsize, 1)
+    matriz = np.frombuffer(codificado.tobytes(), dtype=np.uint8).reshape(len(codificado), largura)
+    return matriz, np.zeros(len(codificado), dtype=np.int64), np.char.str_len(codificado).astype(np.int64)
+
+
+def _digit_matrix(valores):
+    # inteiros sem sinal -> dígitos ASCII alinhados à direita, uma coluna
+    # inteira por casa decimal (os zeros à esquerda ficam fora do campo)
+    n_digitos = np.searchsorted(_POTENCIAS, valores, side='right') + 1
+    largura = int(n_digitos.max(initial=1))
+    matriz = np.empty((len(valores), largura), dtype=np.uint8)
+    # a divisão em 32 bits é bem mais rápida que em 64
+    resto = valores.astype(np.uint32) if largura < 10 else valores.copy()
+    dez = resto.dtype.type(10)
+    for k in range(largura):
+        resto, digito = np.divmod(resto, dez)
+        matriz[:, largura - 1 - k] = digito
+    matriz += 48
+    return matriz, largura - n_digitos, n_digitos.astype(np.int64)
+
+
+def _prefix(matriz, inicio, comprimento, marcados, caractere):
+    # insere um caractere no início dos campos marcados (sinal de menos)
+    if not marcados.any():
+        return matriz, inicio, comprimento
+    if inicio[marcados].min() == 0:
+        matriz = np.hstack([np.zeros((len(matriz), 1), dtype=np.uint8), matriz])
+        inicio = inicio + 1
+    inicio = inicio - marcados
+    matriz[marcados, inicio[marcados]] = ord(caractere)
+    return matriz, inicio, comprimento + marcados
+
+
+def _quote(matriz, inicio, comprimento):
+    # aspas em volta dos campos não vazios, como nos .dat exportados pelo WASA
+    cheios = comprimento > 0
+    nova = np.zeros((len(matriz), matriz.shape[1] + 2), dtype=np.uint8)
+    nova[:, 1:-1] = matriz
+    linhas = np.flatnonzero(cheios)
+    nova[linhas, inicio[cheios]] = ord('"')
+    nova[linhas, inicio[cheios] + comprimento[cheios] + 1] = ord('"')
+    return nova, inicio + 1 - cheios, comprimento + 2 * cheios
+
+
+def _format_integers(valores):
+    negativos = valores < 0
+    matriz, inicio, comprimento = _digit_matrix(np.abs(valores.astype(np.int64)).astype(np.uint64))
+    return _prefix(matriz, inicio, comprimento, negativos, '-')
+
+
+def _format_floats(valores, decimal):
+
+    finitos = np.isfinite(valores)
+    absolutos = np.abs(np.where(finitos, valores, 0.0))
+    centavos = np.round(absolutos * 100)
+
+    # caminho rápido: float64 já arredondado em 2 casas, como nas colunas do
+    # resultado; o texto sai igual ao repr do float ("48.5", "3.0", "0.07").
+    # float32 vai pelo repr do próprio tipo ("0.07", "1e+10"), como no to_csv
+    rapido = valores.dtype == np.float64 and (absolutos < 1e13).all()
+    if not (rapido and np.array_equal(centavos / 100, absolutos)):
+        textos = np.where(finitos, valores.astype(str), '')
+        textos = np.where(np.isinf(valores), np.where(valores > 0, 'inf', '-inf'), textos)
+        matriz, inicio, comprimento = _text_matrix(textos)
+        if decimal != '.':
+            matriz = np.where(matriz == ord('.'), np.uint8(ord(decimal)), matriz)
+        return matriz, inicio, comprimento
+
+    centavos = centavos.astype(np.uint64)
+    inteiro, inicio, comprimento = _digit_matrix(centavos // 100)
+    fracao = (centavos % 100).astype(np.uint8)
+    duas_casas = fracao % 10 != 0
+
+    # parte inteira alinhada à direita, depois separador e as duas casas; a
+    # segunda só entra no campo quando não é zero
+    largura = inteiro.shape[1]
+    matriz = np.empty((len(valores), largura + 3), dtype=np.uint8)
+    matriz[:, :largura] = inteiro
+    matriz[:, largura] = ord(decimal)
+    matriz[:, largura + 1] = 48 + fracao // 10
+    matriz[:, largura + 2] = 48 + fracao % 10
+    comprimento = comprimento + 2 + duas_casas
+
+    # NaN vira campo vazio, como no to_csv
+    comprimento = np.where(np.isnan(valores), 0, comprimento)
+    matriz, inicio, comprimento = _prefix(matriz, inicio, comprimento, finitos & np.signbit(valores), '-')
+    if np.isinf(valores).any():
+        infinitos = np.isinf(valores)
+        texto, _, tam = _text_matrix(np.where(valores[infinitos] > 0, 'inf', '-inf'))
+        matriz[infinitos] = 0
+        matriz[infinitos, :texto.shape[1]] = texto
+        inicio = np.where(infinitos, 0, inicio)
+        comprimento[infinitos] = tam
+    return matriz, inicio, comprimento
+
+
+def _format_column(serie, decimal):
+    valores = serie.to_numpy()
+    if valores.dtype == bool:
+        return (
+            _BOOL_TEXT[valores.view(np.uint8)], np.zeros(len(valores), dtype=np.int64),
+            _BOOL_LEN[valores.view(np.uint8)]
+        )
+    if valores.dtype.kind in 'iu':
+        return _format_integers(valores)
+    if valores.dtype.kind == 'f':
+        return _format_floats(valores, decimal)
+    # objeto (ex.: rompeu com NaN): mesmo texto do to_csv, célula a célula; o
+    # to_csv não aplica o decimal a floats dentro de colunas de objeto
+    return _text_matrix(['' if pd.isna(v) else str(v) for v in valores])
+
+
+def format_chunk(df, sep=',', decimal='.', quote_floats=False):
+
+    # monta todas as linhas num único buffer: cada coluna vira uma matriz de
+    # bytes e é espalhada nas posições certas de cada linha; quote_floats põe
+    # as colunas de ponto flutuante entre aspas ("8,22")
+    n = len(df)
+    if not n:
+        return b''
+
+    campos = []
+    for c in df.columns:
+        campo = _format_column(df[c], decimal)
+        if quote_floats and df[c].dtype.kind == 'f':
+            campo = _quote(*campo)
+        campos.append(campo)
+
+    # com uma coluna só, o to_csv escreve o campo vazio como "" (uma linha
+    # vazia não seria lida de volta)
+    if len(campos) == 1:
+        matriz, inicio, comprimento = campos[0]
+        vazios = comprimento == 0
+        if vazios.any():
+            matriz = np.hstack([matriz, np.zeros((n, max(0, 2 - matriz.shape[1])), dtype=np.uint8)])
+            matriz[vazios, :2] = ord('"')
+            campos[0] = (matriz, np.where(vazios, 0, inicio), np.where(vazios, 2, comprimento))
+
+    # com o tamanho de cada linha conhecido, o buffer final é alocado uma vez
+    # e cada coluna escreve nele uma coluna de bytes por vez; bytes fora do
+    # campo vão para um byte extra no fim, descartado
+    tamanho_linha = sum(comprimento for _, _, comprimento in campos) + len(campos)
+    posicao = np.cumsum(tamanho_linha) - tamanho_linha
+    total = int(posicao[-1] + tamanho_linha[-1])
+    buffer = np.empty(total + 1, dtype=np.uint8)
+
+    for k, (matriz, inicio, comprimento) in enumerate(campos):
+        fim = inicio + comprimento
+        # colunas a..b estão dentro do campo em todas as linhas
+        a, b = int(inicio.max()), int(fim.min())
+        base = posicao - inicio
+        for j in range(int(inicio.min()), int(fim.max())):
+            destino = base + j if a <= j < b else np.where((inicio <= j) & (j < fim), base + j, total)
+            buffer[destino] = matriz[:, j]
+        posicao += comprimento
+        buffer[posicao] = ord('\n') if k == len(campos) - 1 else ord(sep)
+        posicao += 1
+
+    return buffer[:total].tobytes()
+
+
+class _BackgroundWriter:
+
+    # os blocos entram numa fila limitada e são gravados por uma thread, em
+    # paralelo com o cálculo; um erro na gravação reaparece no próximo write
+    # ou no close
+
+    def __init__(self, max_pending=4):
+        self._fila = queue.Queue(maxsize=max_pending)
+        self._erro = None
+        self._fechado = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            bloco = self._fila.get()
+            if bloco is None:
+                break
+            if self._erro is not None:
+                continue
+            try:
+                self._write_chunk(bloco)
+            except Exception as e:
+                self._erro = e
+        try:
+            if self._erro is None:
+                self._finish()
+        except Exception as e:
+            self._erro = e
+        finally:
+            self._release()
+
+    def _check(self):
+        if self._erro is not None:
+            raise self._erro
+
+    def write(self, df):
+        self._check()
+        if self._fechado:
+            raise ValueError("Escritor de resultados já foi fechado.")
+        self._fila.put(df)
+
+    def close(self):
+        if not self._fechado:
+            self._fechado = True
+            self._fila.put(None)
+            self._thread.join()
+        self._check()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, tipo, valor, tb):
+        if tipo is None:
+            self.close()
+        else:
+            # não mascara a exceção original
+            try:
+                self.close()
+            except Exception:
+                pass
+        return False
+
+    def _write_chunk(self, df):
+        raise NotImplementedError
+
+    def _finish(self):
+        pass
+
+    def _release(self):
+        pass
+
+
+class TextResultWriter(_BackgroundWriter):
+
+    # mesmo layout do result_discharge.to_csv(index=False); com wasa_title o
+    # arquivo ganha as duas linhas de cabeçalho do WASA, tabulação e, por
+    # padrão, vírgula decimal
+    def __init__(self, path, wasa_title=None, sep=None, decimal=None, max_pending=4):
+        self.path = path
+        self.wasa_title = wasa_title
+        self.sep = sep or ('\t' if wasa_title is not None else ',')
+        self.decimal = decimal or (',' if wasa_title is not None else '.')
+        if self.sep == self.decimal:
+            raise ValueError("Separador e decimal não podem ser o mesmo caractere.")
+        self._arquivo = open(path, 'wb')
+        self._colunas = None
+        super().__init__(max_pending)
+
+    def _header(self, colunas):
+        if self.wasa_title is not None:
+            return f'{self.wasa_title}\n"{", ".join(colunas)}"\n'
+        return self.sep.join(colunas) + '\n'
+
+    def _write_chunk(self, df):
+        if self._colunas is None:
+            self._colunas = list(df.columns)
+            self._arquivo.write(self._header(self._colunas).encode('utf-8'))
+        elif list(df.columns) != self._colunas:
+            raise ValueError("Bloco com colunas diferentes do primeiro.")
+        self._arquivo.write(format_chunk(df, self.sep, self.decimal))
+
+    def _release(self):
+        self._arquivo.close()
+
+
+class ColumnarResultWriter(_BackgroundWriter):
+
+    # zip com um .npy comprimido por coluna e por bloco, mais meta.json com
+    # colunas e dtypes; dtypes força o tipo gravado (ex.: float32)
+    def __init__(self, path, dtypes=None, compression=zipfile.ZIP_DEFLATED, compresslevel=1, max_pending=4):
+        self.path = path
+        self.dtypes = dtypes or {}
+        self._zip = zipfile.ZipFile(
+            path, 'w', compression=compression, compresslevel=compresslevel, allowZip64=True
+        )
+        self._colunas = None
+        self._tipos = None
+        self._blocos = 0
+        self._linhas = 0
+        super().__init__(max_pending)
+
+    def _write_chunk(self, df):
+        if self._colunas is None:
+            self._colunas = list(df.columns)
+            self._tipos = {
+                c: np.dtype(self.dtypes.get(c, df[c].dtype if df[c].dtype != object else str)).str
+                for c in self._colunas
+            }
+        elif list(df.columns) != self._colunas:
+            raise ValueError("Bloco com colunas diferentes do primeiro.")
+
+        for i, c in enumerate(self._colunas):
+            valores = df[c].to_numpy()
+            if valores.dtype == object:
+                valores = np.asarray(['' if pd.isna(v) else str(v) for v in valores])
+            buffer = io.BytesIO()
+            np.save(buffer, valores.astype(self._tipos[c]), allow_pickle=False)
+            self._zip.writestr(f'{self._blocos:06d}/{i}.npy', buffer.getvalue())
+        self._blocos += 1
+        self._linhas += len(df)
+
+    def _finish(self):
+        meta = {
+            "version": COLUMNAR_VERSION,
+            "columns": self._colunas or [],
+            "dtypes": self._tipos or {},
+            "chunks": self._blocos,
+            "rows": self._linhas
+        }
+        self._zip.writestr('meta.json', json.dumps(meta, ensure_ascii=False))
+
+    def _release(self):
+        self._zip.close()
+
+
+def read_columnar(path, columns=None):
+
+    with zipfile.ZipFile(path) as arquivo:
+        meta = json.loads(arquivo.read('meta.json'))
+        if meta["version"] != COLUMNAR_VERSION:
+            raise ValueError(f"Versão de arquivo colunar incompatível em {path}")
+        colunas = columns or meta["columns"]
+        dados = {}
+        for c in colunas:
+            i = meta["columns"].index(c)
+            blocos = [
+                np.load(io.BytesIO(arquivo.read(f'{k:06d}/{i}.npy')), allow_pickle=False)
+                for k in range(meta["chunks"])
+            ]
+            dados[c] = np.concatenate(blocos) if blocos else np.empty(0, dtype=meta["dtypes"][c])
+    return pd.DataFrame(dados)
+
+
+def open_result_writer(path, format='dat', **kwargs):
+    if format == 'dat':
+        return TextResultWriter(path, **kwargs)
+    if format == 'wasa':
+        kwargs.setdefault('wasa_title', 'Routing results')
+        return TextResultWriter(path, **kwargs)
+    if format == 'columnar':
+        return ColumnarResultWriter(path, **kwargs)
+    raise ValueError(f"Formato de saída desconhecido: {format}")
+
+
+@staged('output_write')
+def write_result(df, path, format='dat', chunk_rows=200000, **kwargs):
+    # grava um resultado já pronto em blocos, pelo mesmo caminho dos streams
+    with open_result_writer(path, format, **kwargs) as escritor:
+        for i in range(0, max(len(df), 1), chunk_rows):
+            escritor.write(df.iloc[i:i + chunk_rows])
@@ -0,0 +1,734 @@
+from dataclasses import dataclass
+
+import numpy as np
+
+from instrumentation import set_counter, stage
+
+# fração média da vazão de pico que passa pela fenda / pelo vertedouro
+COEF_FENDA = 0.707121014402343
+# vazão de pico da ruptura: 0.0344 * V ** 0.6527
+COEF_PICO_RUPTURA = 0.0344
+EXP_PICO_RUPTURA = 0.6527
+# erosão da barragem rompida: m * (V * pm_fenda * altura) ** n
+PM_FENDA = 0.842584358697712
+M_EROSAO = 0.0261
+N_EROSAO = 0.769
+
+TOPOLOGY_VERSION = 1
+
+# entradas que no .dat podem ser colunas inteiras: na engine do networkx viram
+# int do Python, que o sum() acumula de outro jeito que os floats
+INTEGER_FIELDS = ('runoff_volume', 'storage_capacity')
+
+
+@dataclass(frozen=True)
+class RoutingParams:
+    # constantes empíricas do modelo, expostas para calibração
+    coef_fenda: float = COEF_FENDA
+    coef_pico_ruptura: float = COEF_PICO_RUPTURA
+    exp_pico_ruptura: float = EXP_PICO_RUPTURA
+    pm_fenda: float = PM_FENDA
+    m_erosao: float = M_EROSAO
+    n_erosao: float = N_EROSAO
+
+
+DEFAULT_PARAMS = RoutingParams()
+
+
+class BasinTopology:
+
+    def __init__(self, node_ids, level_bounds, edge_src, edge_dst, edge_bounds):
+        # node_ids[p] é o subasin_id da posição p; as posições seguem a ordem
+        # topológica, agrupadas por nível (level_bounds[L]:level_bounds[L+1])
+        self.node_ids = node_ids
+        self.level_bounds = level_bounds
+        # arestas agrupadas pelo nível do nó de jusante (edge_bounds), mantendo
+        # a ordem do routing.dat dentro de cada nó
+        self.edge_src = edge_src
+        self.edge_dst = edge_dst
+        self.edge_bounds = edge_bounds
+
+        self._sorted_order = np.argsort(node_ids, kind='stable')
+        self._sorted_ids = node_ids[self._sorted_order]
+
+    @property
+    def n_nodes(self):
+        return len(self.node_ids)
+
+    @property
+    def n_edges(self):
+        return len(self.edge_src)
+
+    @property
+    def n_levels(self):
+        return len(self.level_bounds) - 1
+
+    def levels(self):
+        for nivel in range(self.n_levels):
+            yield nivel, self.level_bounds[nivel], self.level_bounds[nivel + 1]
+
+    def level_edges(self, nivel):
+        e0 = self.edge_bounds[nivel]
+        e1 = self.edge_bounds[nivel + 1]
+        return self.edge_src[e0:e1], self.edge_dst[e0:e1]
+
+    def level_plan(self, nivel):
+        # plano de ordered_sum de um nível avulso
+        src, dst = self.level_edges(nivel)
+        return sum_plan(src, dst - self.level_bounds[nivel], self.level_bounds[nivel + 1] - self.level_bounds[nivel])
+
+    def level_plans(self):
+
+        # planos de ordered_sum de todos os níveis, em ordem, montados de uma
+        # vez a cada roteamento e soltos no fim (não ficam na topologia); os
+        # limites de cada nível numa linha de uma matriz, lida com um tolist
+        # só, porque o laço por nível é o gargalo
+        arestas, linhas, colunas, limites_arestas, nos, limites_nos = _exact_rows(self.edge_dst, self.level_bounds)
+        src_exatas = self.edge_src[arestas].astype(np.int32)
+        del arestas
+        limites = np.stack(
+            [self.level_bounds, self.edge_bounds, limites_arestas, limites_nos], axis=1, dtype=np.int32
+        )
+        for nivel in range(self.n_levels):
+            (a, e0, x0, n0), (b, e1, x1, n1) = limites[nivel:nivel + 2].tolist()
+            dst = self.edge_dst[e0:e1] - a
+            yield (
+                self.edge_src[e0:e1], dst,
+                src_exatas[x0:x1], linhas[x0:x1], colunas[x0:x1], nos[n0:n1], _empty_rows(dst, b - a)
+            )
+
+    def index_of(self, ids, missing=-1):
+        ids = np.asarray(ids)
+        pos = np.searchsorted(self._sorted_ids, ids)
+        pos = np.clip(pos, 0, max(len(self._sorted_ids) - 1, 0))
+        if len(self._sorted_ids) == 0:
+            return np.full(ids.shape, missing, dtype=np.int64)
+        achou = self._sorted_ids[pos] == ids
+        return np.where(achou, self._sorted_order[pos], missing).astype(np.int64)
+
+    def predecessors(self, subasin_id):
+        p = self.index_of([subasin_id])[0]
+        if p < 0:
+            return []
+        mask = self.edge_dst == p
+        return self.node_ids[self.edge_src[mask]].tolist()
+
+    def sequence(self):
+        return self.node_ids.tolist()
+
+    def outlets(self):
+        # posições sem trecho de jusante (exutórios)
+        tem_jusante = np.zeros(self.n_nodes, dtype=bool)
+        tem_jusante[self.edge_src] = True
+        return np.flatnonzero(~tem_jusante)
+
+    def save(self, path, source_hash=''):
+        with open(path, 'wb') as f:
+            np.savez(
+                f,
+                version=np.int64(TOPOLOGY_VERSION),
+                source_hash=np.str_(source_hash),
+                node_ids=self.node_ids,
+                level_bounds=self.level_bounds,
+                edge_src=self.edge_src,
+                edge_dst=self.edge_dst,
+                edge_bounds=self.edge_bounds
+            )
+
+    @classmethod
+    def load(cls, path, source_hash=None):
+        with np.load(path) as dados:
+            if int(dados['version']) != TOPOLOGY_VERSION:
+                raise ValueError(f"Versão de topologia incompatível em {path}")
+            if source_hash is not None and str(dados['source_hash']) != source_hash:
+                raise ValueError(f"Topologia em {path} não corresponde ao routing.dat atual")
+            return cls(
+                dados['node_ids'],
+                dados['level_bounds'],
+                dados['edge_src'],
+                dados['edge_dst'],
+                dados['edge_bounds']
+            )
+
+
+def compile_topology(df_routing):
+
+    with stage('graph_build'):
+        ids, src, dst = routing_edges(df_routing)
+    with stage('topological_sort'):
+        topology = sort_topology(ids, src, dst)
+
+    set_counter('nodes', topology.n_nodes)
+    set_counter('edges', topology.n_edges)
+    set_counter('levels', topology.n_levels)
+    return topology
+
+
+def routing_edges(df_routing):
+
+    upstream = df_routing['upstream'].to_numpy()
+    downstream = df_routing['downstream'].to_numpy(dtype=float)
+
+    tem_jusante = ~np.isnan(downstream) & (downstream != -999)
+    ups = upstream[tem_jusante].astype(np.int64)
+    downs = downstream[tem_jusante].astype(np.int64)
+
+    # nós isolados (jusante -999 e sem montante) também entram na topologia
+    todos = np.concatenate([ups, downs, upstream[~tem_jusante].astype(np.int64)])
+    ids, inverso = np.unique(todos, return_inverse=True)
+    n = len(ids)
+    src = inverso[:len(ups)]
+    dst = inverso[len(ups):2 * len(ups)]
+
+    # arestas repetidas contam uma vez só (como no DiGraph)
+    if len(src):
+        chave = src * n + dst
+        _, primeira = np.unique(chave, return_index=True)
+        primeira.sort()
+        src = src[primeira]
+        dst = dst[primeira]
+
+    return ids, src, dst
+
+
+def sort_topology(ids, src, dst, nivel=None):
+
+    # nivel: nível de cada nó (padrão: maior caminho desde uma cabeceira)
+    n = len(ids)
+    if nivel is None:
+        nivel = compute_levels(n, src, dst)
+
+    ordem = np.argsort(nivel, kind='stable')
+    posicao = np.empty(n, dtype=np.int64)
+    posicao[ordem] = np.arange(n)
+
+    n_niveis = int(nivel.max()) + 1 if n else 0
+    level_bounds = np.searchsorted(nivel[ordem], np.arange(n_niveis + 1))
+
+    src = posicao[src]
+    dst = posicao[dst]
+    nivel_dst = nivel[ordem][dst] if len(dst) else np.empty(0, dtype=np.int64)
+    ordem_arestas = np.argsort(nivel_dst, kind='stable')
+    edge_src = src[ordem_arestas]
+    edge_dst = dst[ordem_arestas]
+    edge_bounds = np.searchsorted(nivel_dst[ordem_arestas], np.arange(n_niveis + 1))
+
+    return BasinTopology(ids[ordem], level_bounds, edge_src, edge_dst, edge_bounds)
+
+
+def compute_levels(n, src, dst):
+
+    # nível = maior caminho desde uma cabeceira (algoritmo de Kahn por frentes)
+    grau = np.bincount(dst, minlength=n)
+    ordem = np.argsort(src, kind='stable')
+    filhos = dst[ordem]
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(src, minlength=n))])
+
+    nivel = np.full(n, -1, dtype=np.int64)
+    frente = np.flatnonzero(grau == 0)
+    atual = 0
+    visitados = 0
+
+    while len(frente):
+        nivel[frente] = atual
+        visitados += len(frente)
+
+        inicio = indptr[frente]
+        qtd = indptr[frente + 1] - inicio
+        total = int(qtd.sum())
+        if total == 0:
+            break
+        desloc = np.repeat(inicio - np.cumsum(qtd) + qtd, qtd) + np.arange(total)
+        alvo = filhos[desloc]
+        np.subtract.at(grau, alvo, 1)
+        alvo = np.unique(alvo)
+        frente = alvo[grau[alvo] == 0]
+        atual += 1
+
+    if visitados != n:
+        raise ValueError("A rede de drenagem do routing.dat contém ciclos.")
+
+    return nivel
+
+
+def node_levels(topology):
+    return np.repeat(np.arange(topology.n_levels), np.diff(topology.level_bounds))
+
+
+def component_labels(topology):
+
+    # componentes fracamente conexas: cada nó termina apontando para a menor
+    # posição da sua sub-bacia (union-find vetorizado com salto de ponteiros)
+    pai = np.arange(topology.n_nodes)
+    src = topology.edge_src
+    dst = topology.edge_dst
+
+    while True:
+        a = pai[src]
+        b = pai[dst]
+        diferentes = a != b
+        if not diferentes.any():
+            break
+        np.minimum.at(pai, np.maximum(a, b)[diferentes], np.minimum(a, b)[diferentes])
+        while True:
+            avo = pai[pai]
+            if (avo == pai).all():
+                break
+            pai = avo
+
+    return pai
+
+
+def partition_components(topology, n_parts):
+
+    # distribui as sub-bacias inteiras entre n_parts grupos de tamanho parecido
+    rotulos = component_labels(topology)
+    raizes, inverso, tamanhos = np.unique(rotulos, return_inverse=True, return_counts=True)
+
+    n_parts = max(1, min(n_parts, len(raizes)))
+    carga = np.zeros(n_parts, dtype=np.int64)
+    parte_da_raiz = np.empty(len(raizes), dtype=np.int64)
+    for r in np.argsort(-tamanhos, kind='stable'):
+        destino = int(np.argmin(carga))
+        parte_da_raiz[r] = destino
+        carga[destino] += tamanhos[r]
+
+    parte = parte_da_raiz[inverso]
+    return [np.flatnonzero(parte == k) for k in range(n_parts)]
+
+
+def subtopology(topology, positions):
+
+    # positions deve ser fechado para montante e jusante (sub-bacias inteiras)
+    # e estar em ordem crescente, o que mantém a ordem topológica
+    positions = np.asarray(positions, dtype=np.int64)
+    nova = np.full(topology.n_nodes, -1, dtype=np.int64)
+    nova[positions] = np.arange(len(positions))
+
+    niveis = node_levels(topology)[positions]
+    n_niveis = int(niveis.max()) + 1 if len(positions) else 0
+    level_bounds = np.searchsorted(niveis, np.arange(n_niveis + 1))
+
+    dentro = nova[topology.edge_dst] >= 0
+    edge_src = nova[topology.edge_src[dentro]]
+    edge_dst = nova[topology.edge_dst[dentro]]
+    edge_bounds = np.searchsorted(niveis[edge_dst], np.arange(n_niveis + 1))
+
+    return BasinTopology(topology.node_ids[positions], level_bounds, edge_src, edge_dst, edge_bounds)
+
+
+def node_array(topology, ids, values, fill=np.nan, keep='last'):
+    values = np.asarray(values, dtype=np.float64)
+    # values pode ter uma coluna por cenário (N x S)
+    arr = np.full((topology.n_nodes,) + values.shape[1:], fill, dtype=np.float64)
+    pos = topology.index_of(ids)
+    if keep == 'first':
+        # com ids repetidos, fica o primeiro valor (como um .loc[...].values[0])
+        pos = pos[::-1]
+        values = values[::-1]
+    ok = pos >= 0
+    arr[pos[ok]] = values[ok]
+    return arr
+
+
+def _exact_rows(dst, bounds):
+
+    # linhas com três ou mais afluentes, em grupos de linhas bounds[g]:bounds[g + 1]
+    # (níveis ou um bloco), em cada grupo em ordem crescente de afluentes
+    # (_compensated_sum). Devolve as arestas dessas linhas, ordenadas por
+    # linha, a linha compacta (dentro do grupo) e a coluna (posição do
+    # afluente na ordem de entrada) de cada uma, e as linhas locais; cada um
+    # com os limites por grupo. Em int32, que os planos vivem durante o
+    # roteamento todo
+    afluentes = np.bincount(dst, minlength=int(bounds[-1]))
+    nos = np.flatnonzero(afluentes > 2)
+    grupo = np.searchsorted(bounds, nos, side='right') - 1
+    ordem = np.lexsort((afluentes[nos], grupo))
+    nos, grupo = nos[ordem], grupo[ordem]
+    limites_nos = np.searchsorted(grupo, np.arange(len(bounds)))
+    posto = np.full(len(afluentes), -1, dtype=np.int32)
+    posto[nos] = np.arange(len(nos))
+    del afluentes
+
+    # arestas por linha, na ordem de entrada dentro de cada uma: a chave
+    # (linha, aresta) é única, e ordená-la sai bem mais barato que um
+    # argsort estável
+    arestas = np.flatnonzero(posto[dst] >= 0)
+    chave = posto[dst[arestas]].astype(np.int64) * len(dst) + arestas
+    chave.sort()
+    arestas = chave % len(dst)
+    linhas = (chave // len(dst)).astype(np.int32)
+    del chave
+    # a coluna é a distância até a primeira aresta da linha
+    afluentes_linha = np.bincount(linhas, minlength=len(nos))
+    colunas = (np.arange(len(linhas)) - (np.cumsum(afluentes_linha) - afluentes_linha)[linhas]).astype(np.int32)
+    return (
+        arestas, (linhas - limites_nos[grupo[linhas]]).astype(np.int32), colunas,
+        np.searchsorted(linhas, limites_nos), (nos - bounds[grupo]).astype(np.int32), limites_nos
+    )
+
+
+def sum_plan(src, linhas, n_linhas):
+    # plano de ordered_sum para um bloco de n_linhas, como BasinTopology.level_plans
+    arestas, linhas_exatas, colunas, _, nos, _ = _exact_rows(linhas, np.array([0, n_linhas]))
+    return src, linhas, src[arestas], linhas_exatas, colunas, nos, _empty_rows(linhas, n_linhas)
+
+
+def _empty_rows(linhas, n_linhas):
+    # linhas sem afluente (ficam com -0.0 em ordered_sum)
+    return np.bincount(linhas, minlength=n_linhas) == 0
+
+
+def ordered_sum(plano, valores, forma, inteiros=None):
+
+    # soma dos afluentes de cada linha como o sum() do Python 3.12 da engine
+    # do networkx: 0.0 + x1 + x2 + ..., ints exatos enquanto só vierem ints e,
+    # a partir do primeiro float, compensação de Neumaier nos floats, somada
+    # no fim se for finita. Com até dois afluentes a compensação é o próprio
+    # erro de arredondamento da soma e não a muda, então a soma simples
+    # (bincount ou np.add.at, a partir de 0.0) basta; só as linhas com três
+    # ou mais somam pela ordem do routing.dat (_compensated_sum). Linhas
+    # sem afluente ficam com -0.0, neutro na soma com o valor local. valores
+    # e inteiros (que marca os ints da referência) são indexados pelos src do
+    # plano (BasinTopology.level_plans, sum_plan).
+    # Devolve a soma e, com inteiros, se ela é int na referência.
+    src, linhas, src_exatas, linhas_exatas, colunas, exatas, vazias = plano
+    if len(forma) == 1:
+        # (sem arestas, o bincount devolve ints)
+        soma = np.bincount(linhas, valores[src], forma[0]).astype(np.float64, copy=False)
+    else:
+        soma = np.zeros(forma)
+        np.add.at(soma, linhas, valores[src])
+    soma[vazias] = -0.0
+
+    inteira = None
+    if inteiros is not None:
+        # um afluente float basta para a soma ser float
+        if len(forma) == 1:
+            inteira = np.bincount(linhas, ~inteiros[src], forma[0]) == 0
+        else:
+            inteira = np.empty(forma, dtype=bool)
+            inteira.fill(True)
+            flutuantes = np.nonzero(~inteiros[src])
+            inteira[(linhas[flutuantes[0]],) + flutuantes[1:]] = False
+
+    if len(exatas):
+        soma[exatas] = _compensated_sum(
+            linhas_exatas, colunas, valores[src_exatas], len(exatas),
+            None if inteiros is None else inteiros[src_exatas]
+        )
+    return soma, inteira
+
+
+def _compensated_sum(linhas, colunas, valores, n_linhas, inteiros=None, chunk=1 << 15, poucos=128):
+
+    # com poucos termos, o próprio sum() sai mais barato que as matrizes
+    if valores.ndim == 1 and len(valores) <= poucos:
+        termos = valores.tolist()
+        if inteiros is not None:
+            termos = [int(v) if i else v for v, i in zip(termos, inteiros.tolist())]
+        grupos = [[] for _ in range(n_linhas)]
+        for linha, v in zip(linhas.tolist(), termos):
+            grupos[linha].append(v)
+        return np.array([float(sum(g)) for g in grupos])
+
+    # linhas em ordem crescente de afluentes, em blocos de linhas com até o
+    # dobro dos afluentes da primeira e ~chunk termos, o que limita o
+    # preenchimento e as matrizes temporárias de _compensated_block
+    afluentes = np.bincount(linhas, minlength=n_linhas)
+    por_termo = int(np.prod(valores.shape[1:]))
+    soma = None
+    r0 = e0 = 0
+    while r0 < n_linhas:
+        base = int(afluentes[r0])
+        r1 = min(
+            int(np.searchsorted(afluentes, 2 * base, side='right')),
+            r0 + max(1, chunk // (2 * base * por_termo))
+        )
+        e1 = e0 + int(afluentes[r0:r1].sum())
+        bloco = _compensated_block(
+            linhas[e0:e1] - r0, colunas[e0:e1], valores[e0:e1], r1 - r0, int(afluentes[r1 - 1]),
+            None if inteiros is None else inteiros[e0:e1]
+        )
+        if r0 == 0 and r1 == n_linhas:
+            return bloco
+        if soma is None:
+            soma = np.empty((n_linhas,) + valores.shape[1:])
+        soma[r0:r1] = bloco
+        r0, e0 = r1, e1
+    return soma
+
+
+def _compensated_block(linhas, colunas, valores, n_linhas, largura, inteiros=None):
+
+    # uma linha por nó, os afluentes nas colunas na ordem do routing.dat; o
+    # add.accumulate dá as somas parciais em sequência, como o laço do sum()
+    # (o 0.0 inicial só muda o sinal de uma soma -0.0, corrigido no fim)
+    forma = (n_linhas, largura) + valores.shape[1:]
+    termos = np.zeros(forma)
+    termos[linhas, colunas] = valores
+
+    with np.errstate(invalid='ignore', over='ignore'):
+        parciais = np.add.accumulate(termos, axis=1)
+        f, x, t = parciais[:, :-1], termos[:, 1:], parciais[:, 1:]
+        # erro exato de cada soma parcial (2Sum, no lugar, reusando termos):
+        # finito, é o mesmo termo de Neumaier do sum(); não finito, a
+        # compensação fica de fora nos dois
+        erro = t - f
+        x -= erro
+        erro = np.subtract(t, erro, out=erro)
+        erro = np.subtract(f, erro, out=erro)
+        erro += x
+        del termos, x
+        if inteiros is not None:
+            # só floats somados a uma soma que já é float têm compensação: os
+            # ints e o primeiro float depois deles entram sem ela
+            flutuante = np.zeros(forma, dtype=bool)
+            flutuante[linhas, colunas] = ~inteiros
+            ja_float = np.logical_or.accumulate(flutuante, axis=1)
+            erro[~(flutuante[:, 1:] & ja_float[:, :-1])] = 0.0
+            del flutuante, ja_float
+        compensacao = np.add.accumulate(erro, axis=1, out=erro)[:, -1]
+        soma = parciais[:, -1] + 0.0
+        return np.where((compensacao != 0) & np.isfinite(compensacao), soma + compensacao, soma)
+
+
+def upstream_sum(topology, nivel, valores, forma, inteiros=None):
+    # afluentes de cada nó do nível somados como na engine de referência
+    return ordered_sum(topology.level_plan(nivel), valores, forma, inteiros)
+
+
+def libm_power(base, expoente):
+
+    # pow da libm, o mesmo do ** do Python: o np.power tem laço vetorizado
+    # próprio, que difere no último bit em parte das entradas, o que basta
+    # para trocar uma ruptura a jusante. O laço de float64 do np.float_power
+    # chama o pow da libm. Negativos e NaN dão NaN, como no np.power.
+    with np.errstate(invalid='ignore'):
+        return np.float_power(base, expoente)
+
+
+def water_step(v_in, p_in, storage_capacity, spillway, params=DEFAULT_PARAMS):
+
+    rompeu = params.coef_fenda * p_in > spillway
+    v_out = np.where(rompeu, v_in + storage_capacity, v_in)
+
+    # nos rompidos p_out recebe v_out e, em seguida, o pico da ruptura
+    p_out = np.where(rompeu, v_out, params.coef_fenda * p_in)
+    r = rompeu if np.shape(rompeu) == p_out.shape else np.broadcast_to(rompeu, p_out.shape)
+    if r.any():
+        p_out[r] = params.coef_pico_ruptura * libm_power(p_out[r], params.exp_pico_ruptura)
+
+    return v_out, p_out, rompeu
+
+
+def sediment_step(s_in, rompeu, eroded_volume, density, efficiency):
+    return np.where(rompeu, s_in + eroded_volume * density, efficiency * s_in)
+
+
+def eroded_volume(rompeu, volume_total, dam_height, params=DEFAULT_PARAMS):
+    # volume_total já truncado para inteiro, como na coluna do resultado
+    with np.errstate(invalid='ignore'):
+        return np.round(
+            rompeu * params.m_erosao * (volume_total * params.pm_fenda * dam_height) ** params.n_erosao,
+            2
+        )
+
+
+def _integral(valores):
+    # valores editados para não inteiros deixam de contar como int
+    with np.errstate(invalid='ignore'):
+        return valores == np.trunc(valores)
+
+
+def integer_volumes(runoff_volume, storage_capacity, rompeu, integer_fields=(), topology=None):
+
+    # quais volume_out a engine do networkx guarda como int do Python: escoamento
+    # inteiro, capacidade inteira se rompeu e (com topology) todos os afluentes
+    # inteiros
+    rompeu = np.asarray(rompeu, dtype=bool)
+    if 'runoff_volume' not in integer_fields:
+        return np.zeros(rompeu.shape, dtype=bool)
+    runoff_volume, storage_capacity = _as_columns(rompeu.ndim, np.asarray(runoff_volume), np.asarray(storage_capacity))
+    capacidade = _integral(storage_capacity) & ('storage_capacity' in integer_fields)
+    inteiro = np.array(np.broadcast_to(_integral(runoff_volume) & (~rompeu | capacidade), rompeu.shape))
+    for nivel in range(topology.n_levels if topology is not None else 0):
+        src, dst = topology.level_edges(nivel)
+        np.logical_and.at(inteiro, dst, inteiro[src])
+    return inteiro
+
+
+def _as_columns(ndim, *arrays):
+    # parâmetros por nó (N,) viram (N, 1) para combinar com matrizes de cenários
+    return [
+        a.reshape(a.shape + (1,) * (ndim - a.ndim)) if a is not None else None
+        for a in arrays
+    ]
+
+
+def route_arrays(topology, runoff_volume, runoff_peak, storage_capacity, spillway,
+                 sed_local=None, dam_height=None, density=None, efficiency=None, params=None,
+                 integer_fields=(), progress=None):
+
+    # integer_fields: quais de INTEGER_FIELDS vêm de colunas inteiras do .dat;
+    # progress(nós propagados, total) é chamado ao fim de cada nível, e uma
+    # exceção levantada por ele interrompe a propagação
+    params = params or DEFAULT_PARAMS
+    com_sedimentos = sed_local is not None
+
+    ndim = max(np.ndim(a) for a in (runoff_volume, runoff_peak, storage_capacity, spillway))
+    runoff_volume, runoff_peak, storage_capacity, spillway, sed_local, dam_height, density, efficiency = _as_columns(
+        ndim, runoff_volume, runoff_peak, storage_capacity, spillway,
+        sed_local, dam_height, density, efficiency
+    )
+    forma_saida = np.broadcast_shapes(
+        runoff_volume.shape, runoff_peak.shape, storage_capacity.shape, spillway.shape
+    )
+
+    volume_in = np.empty(forma_saida, dtype=np.float64)
+    volume_out = np.empty_like(volume_in)
+    peak_in = np.empty_like(volume_in)
+    peak_out = np.empty_like(volume_in)
+    rompeu = np.empty(volume_in.shape, dtype=bool)
+
+    # volume_out que a referência guarda como int do Python
+    inteiros = 'runoff_volume' in integer_fields
+    if inteiros:
+        volume_inteiro = np.empty(volume_in.shape, dtype=bool)
+        runoff_inteiro = _integral(runoff_volume)
+        capacidade_inteira = _integral(storage_capacity) & ('storage_capacity' in integer_fields)
+
+    if com_sedimentos:
+        sed_in = np.empty_like(volume_in)
+        sed_out = np.empty_like(volume_in)
+        erodido = np.empty_like(volume_in)
+
+    for (_, a, b), plano in zip(topology.levels(), topology.level_plans()):
+
+        forma = (b - a,) + volume_in.shape[1:]
+        v_up, v_up_inteiro = ordered_sum(plano, volume_out, forma, volume_inteiro if inteiros else None)
+        p_up, _ = ordered_sum(plano, peak_out, forma)
+        v_in = runoff_volume[a:b] + v_up
+        p_in = runoff_peak[a:b] + p_up
+
+        v_out, p_out, r = water_step(v_in, p_in, storage_capacity[a:b], spillway[a:b], params)
+        if inteiros:
+            volume_inteiro[a:b] = runoff_inteiro[a:b] & v_up_inteiro & (~r | capacidade_inteira[a:b])
+
+        volume_in[a:b] = v_in
+        volume_out[a:b] = v_out
+        peak_in[a:b] = p_in
+        peak_out[a:b] = p_out
+        rompeu[a:b] = r
+
+        if com_sedimentos:
+            e = eroded_volume(r, np.trunc(v_out), dam_height[a:b], params)
+            s_in = sed_local[a:b] + ordered_sum(plano, sed_out, forma)[0]
+
+            sed_in[a:b] = s_in
+            sed_out[a:b] = sediment_step(s_in, r, e, density[a:b], efficiency[a:b])
+            erodido[a:b] = e
+
+        if progress is not None:
+            progress(int(b), topology.n_nodes)
+
+    saida = {
+        'volume_in': volume_in,
+        'volume_out': volume_out,
+        'peak_in': peak_in,
+        'peak_out': peak_out,
+        'rompeu': rompeu
+    }
+    if com_sedimentos:
+        saida.update(sed_in=sed_in, sed_out=sed_out, eroded_volume=erodido)
+
+    return saida
+
+
+def route_sediment_arrays(topology, sed_local, rompeu, eroded, density, efficiency):
+
+    sed_local, density, efficiency = _as_columns(np.ndim(rompeu), sed_local, density, efficiency)
+
+    sed_in = np.empty(np.shape(rompeu), dtype=np.float64)
+    sed_out = np.empty_like(sed_in)
+
+    for (_, a, b), plano in zip(topology.levels(), topology.level_plans()):
+
+        forma = (b - a,) + sed_in.shape[1:]
+        s_in = sed_local[a:b] + ordered_sum(plano, sed_out, forma)[0]
+
+        sed_in[a:b] = s_in
+        sed_out[a:b] = sediment_step(s_in, rompeu[a:b], eroded[a:b], density[a:b], efficiency[a:b])
+
+    return sed_in, sed_out
+
+
+class BasinModel:
+
+    # atributos de cada nó em vetores contíguos, na ordem das posições da
+    # topologia; o mapa id -> posição é o índice ordenado da própria topologia
+    WATER_FIELDS = ('runoff_volume', 'runoff_peak', 'storage_capacity', 'spillway')
+    SEDIMENT_FIELDS = ('sed_local', 'dam_height', 'density', 'efficiency')
+
+    def __init__(self, topology, arrays, row_ids=None, dtype=np.float64, integer_fields=()):
+        self.topology = topology
+        self.dtype = np.dtype(dtype)
+        # colunas inteiras no .dat de origem (INTEGER_FIELDS), para route_arrays
+        self.integer_fields = tuple(integer_fields)
+        self.arrays = {}
+        for nome in self.WATER_FIELDS + self.SEDIMENT_FIELDS:
+            if arrays.get(nome) is not None:
+                valores = np.ascontiguousarray(arrays[nome], dtype=self.dtype)
+                if valores.shape != (topology.n_nodes,):
+                    raise ValueError(f"Atributo {nome} com forma {valores.shape}; esperado ({topology.n_nodes},).")
+                self.arrays[nome] = valores
+        faltando = [nome for nome in self.WATER_FIELDS if nome not in self.arrays]
+        if faltando:
+            raise ValueError(f"Atributos obrigatórios ausentes: {faltando}")
+        # ordem das linhas do resultado (a do runoff.dat, por padrão a dos nós)
+        self.row_ids = np.asarray(row_ids) if row_ids is not None else topology.node_ids
+
+    @property
+    def n_nodes(self):
+        return self.topology.n_nodes
+
+    @property
+    def node_ids(self):
+        return self.topology.node_ids
+
+    @property
+    def has_sediment(self):
+        return all(nome in self.arrays for nome in self.SEDIMENT_FIELDS)
+
+    @property
+    def nbytes(self):
+        return sum(valores.nbytes for valores in self.arrays.values())
+
+    def index_of(self, ids, missing=-1):
+        return self.topology.index_of(ids, missing)
+
+    def __getitem__(self, nome):
+        return self.arrays[nome]
+
+    def _position(self, subasin_id):
+        p = int(self.index_of([subasin_id])[0])
+        if p < 0:
+            raise KeyError(f"Subbacia {subasin_id} não está na rede de drenagem.")
+        return p
+
+    def get(self, subasin_id, nome):
+        return self.arrays[nome][self._position(subasin_id)]
+
+    def set(self, subasin_id, nome, valor):
+        self.arrays[nome][self._position(subasin_id)] = valor
+
+    def inputs(self, sediment=True):
+        # argumentos nomeados de route_arrays
+        nomes = self.WATER_FIELDS + (self.SEDIMENT_FIELDS if sediment and self.has_sediment else ())
+        return {nome: self.arrays[nome] for nome in nomes}
+
+    def route(self, params=None, sediment=True, progress=None):
+        return route_arrays(
+            self.topology, **self.inputs(sediment), params=params,
+            integer_fields=self.integer_fields, progress=progress
+        )
@@ -0,0 +1,109 @@
+import numpy as np
+import pandas as pd
+
+from data_utils import map_node_values, water_input_arrays, detect_integer_fields
+from routing_engine import DEFAULT_PARAMS, compile_topology, route_arrays
+
+INPUT_FIELDS = ['runoff_volume', 'runoff_peak_discharge', 'water_storage_capacity', 'spillway_discharge']
+OUTPUT_FIELDS = ['volume_total', 'vazão_de_saida']
+
+
+def adjoint_arrays(topology, saida, seed_volume, seed_peak, params=None):
+
+    # passagem reversa pela ordem de propagação com a configuração de rupturas
+    # fixa. seed_volume/seed_peak (N, K) são dJ/dv_out e dJ/dp_out diretos de
+    # K funcionais; devolve as derivadas de cada funcional em relação às
+    # entradas de cada nó, também (N, K).
+    params = params or DEFAULT_PARAMS
+
+    adj_v = np.array(seed_volume, dtype=np.float64)
+    adj_p = np.array(seed_peak, dtype=np.float64)
+    rompeu = saida['rompeu'][:, None]
+
+    # dp_out/dv_out de um açude rompido: a * b * v_out^(b - 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dpico = params.coef_pico_ruptura * params.exp_pico_ruptura * (
+            saida['volume_out'] ** (params.exp_pico_ruptura - 1)
+        )
+    dpico = np.where(np.isfinite(dpico), dpico, 0.0)[:, None]
+
+    d_volume = np.zeros_like(adj_v)
+    d_peak = np.zeros_like(adj_v)
+    d_storage = np.zeros_like(adj_v)
+
+    for nivel in range(topology.n_levels - 1, -1, -1):
+        a, b = topology.level_bounds[nivel], topology.level_bounds[nivel + 1]
+        r = rompeu[a:b]
+
+        # rompido: v_out = v_in + S, p_out = f(v_out); senão v_out = v_in, p_out = c * p_in
+        via_volume = adj_v[a:b] + np.where(r, adj_p[a:b] * dpico[a:b], 0.0)
+        via_pico = np.where(r, 0.0, params.coef_fenda * adj_p[a:b])
+
+        d_volume[a:b] = via_volume
+        d_peak[a:b] = via_pico
+        d_storage[a:b] = np.where(r, via_volume, 0.0)
+
+        src, dst = topology.level_edges(nivel)
+        if len(src):
+            np.add.at(adj_v, src, d_volume[dst])
+            np.add.at(adj_p, src, d_peak[dst])
+
+    return {
+        'runoff_volume': d_volume,
+        'runoff_peak_discharge': d_peak,
+        'water_storage_capacity': d_storage,
+        # o vertedouro só entra no teste de ruptura: derivada nula fora do limiar
+        'spillway_discharge': np.zeros_like(d_volume)
+    }
+
+
+def outlet_sensitivities(df_reservoir, df_routing, df_runoff, outlet=None, topology=None, params=None):
+
+    # derivadas do volume_total e da vazão_de_saida no exutório em relação às
+    # entradas de cada nó. Sem outlet, soma todos os exutórios: numa rede em
+    # árvore cada nó só alcança o seu, então a coluna é a do próprio exutório.
+    params = params or DEFAULT_PARAMS
+    if topology is None:
+        topology = compile_topology(df_routing)
+    df_merged = df_reservoir.merge(df_runoff, on='subasin_id', how='left')
+    runoff_volume, runoff_peak, storage_capacity, spillway = water_input_arrays(topology, df_merged)
+    saida = route_arrays(
+        topology, runoff_volume, runoff_peak, storage_capacity, spillway, params=params,
+        integer_fields=detect_integer_fields(df_merged)
+    )
+
+    n = topology.n_nodes
+    if outlet is None:
+        exutorios = topology.outlets()
+    else:
+        exutorios = topology.index_of([outlet])
+        if (exutorios < 0).any():
+            raise KeyError(f"Subbacia {outlet} não está na rede de drenagem.")
+
+    seed_volume = np.zeros((n, 2))
+    seed_peak = np.zeros((n, 2))
+    seed_volume[exutorios, 0] = 1.0
+    seed_peak[exutorios, 1] = 1.0
+    derivadas = adjoint_arrays(topology, saida, seed_volume, seed_peak, params)
+
+    # exutório alcançado por cada nó (em confluências múltiplas, o da última aresta)
+    exutorio = np.arange(n)
+    for nivel in range(topology.n_levels - 1, -1, -1):
+        src, dst = topology.level_edges(nivel)
+        exutorio[src] = exutorio[dst]
+
+    ids = df_runoff["subasin_id"]
+    node_ids = topology.node_ids
+
+    colunas = {
+        "subasin_id": ids,
+        "exutorio": map_node_values(ids, node_ids, node_ids[exutorio]),
+        "rompeu": map_node_values(ids, node_ids, saida['rompeu']),
+        # > 0: folga até romper; < 0: quanto o pico passou do vertedouro
+        "margem_ruptura": map_node_values(ids, node_ids, spillway - params.coef_fenda * saida['peak_in'])
+    }
+    for k, resposta in enumerate(OUTPUT_FIELDS):
+        for entrada in INPUT_FIELDS:
+            colunas[f"d_{resposta}_d_{entrada}"] = map_node_values(ids, node_ids, derivadas[entrada][:, k])
+
+    return pd.DataFrame(colunas)
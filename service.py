@@ -0,0 +1,578 @@
+import argparse
+import json
+import logging
+import math
+import queue
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import Future
+from dataclasses import asdict, fields
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+
+from basinflow import INPUT_FILES, load_inputs, read_manifest, sediment_options
+from data_utils import build_basin_model, build_model_result
+from routing_engine import DEFAULT_PARAMS, RoutingParams, route_arrays
+
+logger = logging.getLogger('basinflow.service')
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+
+# janela em que consultas simultâneas da mesma bacia entram na mesma passada
+DEFAULT_BATCH_WINDOW = 0.002
+DEFAULT_MAX_BATCH = 64
+
+# espera máxima de uma consulta HTTP pela sua propagação (resposta 504)
+DEFAULT_ROUTE_TIMEOUT = 30.0
+
+# campo da consulta -> atributo do BasinModel
+RUNOFF_OVERRIDES = {'runoff_volume': 'runoff_volume', 'runoff_peak_discharge': 'runoff_peak'}
+SED_PARAM_OVERRIDES = {'sediment_density': 'density', 'sediment_retention_efficiency': 'efficiency'}
+
+
+class ServiceError(Exception):
+
+    # erro da consulta, devolvido ao cliente com o status HTTP
+    def __init__(self, mensagem, status=400):
+        super().__init__(mensagem)
+        self.status = status
+
+
+class _Query:
+
+    # consulta já validada: posições e valores dos ajustes sobre o modelo
+    def __init__(self, params, sediment, scale, overrides, fill, subasin_ids, integer_fields=()):
+        self.params = params
+        self.sediment = sediment
+        self.scale = scale
+        # atributo -> (posições, valores)
+        self.overrides = overrides
+        # atributo -> valor aplicado a todos os nós (modo manual)
+        self.fill = fill
+        self.subasin_ids = subasin_ids
+        # volume ajustado deixa de ser coluna inteira (ver route_arrays)
+        if scale != 1.0 or 'runoff_volume' in overrides:
+            integer_fields = tuple(nome for nome in integer_fields if nome != 'runoff_volume')
+        self.integer_fields = tuple(integer_fields)
+        self.future = Future()
+
+    @property
+    def key(self):
+        # só consultas com as mesmas constantes dividem a passada
+        return (self.params, self.sediment, self.integer_fields)
+
+
+def _routing_params(valores):
+
+    if not valores:
+        return DEFAULT_PARAMS
+    validos = {campo.name for campo in fields(RoutingParams)}
+    desconhecidos = sorted(set(valores) - validos)
+    if desconhecidos:
+        raise ServiceError(f"Parâmetros desconhecidos: {desconhecidos}")
+    try:
+        return RoutingParams(**{**asdict(DEFAULT_PARAMS), **{k: float(v) for k, v in valores.items()}})
+    except (TypeError, ValueError) as e:
+        raise ServiceError(f"Parâmetros inválidos: {e}")
+
+
+def _node_overrides(model, valores, campos, secao):
+
+    # {"<subasin_id>": {campo: valor}} -> atributo -> (posições, valores)
+    if not isinstance(valores, dict):
+        raise ServiceError(f"'{secao}' deve ser um objeto indexado por subasin_id.")
+    try:
+        ids = np.asarray([int(k) for k in valores], dtype=np.int64)
+    except ValueError:
+        raise ServiceError(f"Ids inválidos em '{secao}'.")
+    posicoes = model.index_of(ids)
+    if (posicoes < 0).any():
+        raise ServiceError(f"Subbacias fora da rede em '{secao}': {ids[posicoes < 0].tolist()}")
+
+    ajustes = {}
+    for campo, atributo in campos.items():
+        pos, vals = [], []
+        for p, linha in zip(posicoes, valores.values()):
+            if not isinstance(linha, dict):
+                raise ServiceError(f"'{secao}' deve mapear cada subasin_id para um objeto.")
+            if linha.get(campo) is not None:
+                pos.append(p)
+                vals.append(float(linha[campo]))
+        if pos:
+            ajustes[atributo] = (np.asarray(pos, dtype=np.int64), np.asarray(vals, dtype=model.dtype))
+
+    extras = {c for linha in valores.values() for c in linha} - set(campos)
+    if extras:
+        raise ServiceError(f"Campos desconhecidos em '{secao}': {sorted(extras)}")
+    return ajustes
+
+
+def parse_query(model, corpo):
+
+    # corpo JSON do POST /route:
+    #   runoff: {"<id>": {"runoff_volume": v, "runoff_peak_discharge": q}}
+    #   runoff_scale: fator sobre todo o escoamento do runoff.dat
+    #   sediment: false para só água, ou {"density": g/cm³, "efficiency": %}
+    #   sed_param: {"<id>": {"sediment_density": d, "sediment_retention_efficiency": e}}
+    #   subasin_ids: lista das subbacias devolvidas (padrão: todas)
+    #   params: constantes do RoutingParams
+    if not isinstance(corpo, dict):
+        raise ServiceError("A consulta deve ser um objeto JSON.")
+
+    params = _routing_params(corpo.get('params'))
+    sedimento = corpo.get('sediment', True)
+    quer_sedimento = sedimento is not False and sedimento is not None
+    overrides = {}
+    fill = {}
+
+    if corpo.get('runoff'):
+        overrides.update(_node_overrides(model, corpo['runoff'], RUNOFF_OVERRIDES, 'runoff'))
+    scale = float(corpo.get('runoff_scale', 1.0))
+
+    if quer_sedimento and model.has_sediment:
+        if isinstance(sedimento, dict):
+            if sedimento.get('density') is not None:
+                fill['density'] = float(sedimento['density'])
+            if sedimento.get('efficiency') is not None:
+                # eficiência em %, como no manifesto e na interface
+                fill['efficiency'] = float(sedimento['efficiency']) / 100
+        if corpo.get('sed_param'):
+            overrides.update(_node_overrides(model, corpo['sed_param'], SED_PARAM_OVERRIDES, 'sed_param'))
+    elif quer_sedimento and (isinstance(sedimento, dict) or corpo.get('sed_param')):
+        raise ServiceError("Bacia carregada sem sedyield; não há sedimentos para ajustar.")
+
+    subasin_ids = corpo.get('subasin_ids')
+    if subasin_ids is not None:
+        try:
+            subasin_ids = np.asarray(subasin_ids, dtype=np.int64)
+        except (TypeError, ValueError):
+            raise ServiceError("'subasin_ids' deve ser uma lista de inteiros.")
+        faltando = np.setdiff1d(subasin_ids, model.row_ids)
+        if len(faltando):
+            raise ServiceError(f"Subbacias sem resultado: {faltando.tolist()}")
+
+    return _Query(
+        params, quer_sedimento and model.has_sediment, scale, overrides, fill, subasin_ids, model.integer_fields
+    )
+
+
+def _records(df):
+    # NaN vira null: JSON estrito
+    return [
+        {k: (None if isinstance(v, float) and math.isnan(v) else v) for k, v in linha.items()}
+        for linha in df.to_dict(orient='records')
+    ]
+
+
+class HotBasin:
+
+    # bacia residente: BasinModel compilado uma vez e uma fila de consultas
+    # atendidas em lotes por uma única thread
+    def __init__(self, name, model, batch_window=DEFAULT_BATCH_WINDOW, max_batch=DEFAULT_MAX_BATCH, source=None):
+        self.name = name
+        self.model = model
+        self.source = source or {}
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.stats = {'queries': 0, 'batches': 0, 'passes': 0, 'largest_batch': 0, 'routing_s': 0.0}
+        self._linhas = pd.DataFrame({'subasin_id': model.row_ids})
+        self._fila = queue.Queue()
+        # depois do close nada mais entra na fila: o None é sempre o último item
+        self._lock = threading.Lock()
+        self._fechada = False
+        self._thread = threading.Thread(target=self._run, name=f'basin-{name}', daemon=True)
+        self._thread.start()
+
+    def info(self):
+        return {
+            'name': self.name,
+            'nodes': int(self.model.n_nodes),
+            'levels': int(self.model.topology.n_levels),
+            'sediment': self.model.has_sediment,
+            'resident_bytes': int(self.model.nbytes),
+            'stats': dict(self.stats)
+        }
+
+    def submit(self, corpo):
+        consulta = parse_query(self.model, corpo)
+        with self._lock:
+            if self._fechada:
+                raise ServiceError(f"Bacia {self.name} descarregada.", 404)
+            self._fila.put(consulta)
+        return consulta.future
+
+    def route(self, corpo, timeout=None):
+        return self.submit(corpo).result(timeout)
+
+    def close(self):
+        with self._lock:
+            if not self._fechada:
+                self._fechada = True
+                self._fila.put(None)
+        self._thread.join()
+
+    def _drain(self):
+        # consultas que ficaram na fila quando a bacia foi descarregada
+        while not self._fila.empty():
+            consulta = self._fila.get_nowait()
+            if consulta is not None:
+                consulta.future.set_exception(ServiceError(f"Bacia {self.name} descarregada.", 404))
+
+    def _run(self):
+
+        while True:
+            consulta = self._fila.get()
+            if consulta is None:
+                self._drain()
+                return
+            lote = [consulta]
+            prazo = time.monotonic() + self.batch_window
+            parar = False
+            while len(lote) < self.max_batch:
+                restante = prazo - time.monotonic()
+                if restante <= 0:
+                    break
+                try:
+                    consulta = self._fila.get(timeout=restante)
+                except queue.Empty:
+                    break
+                if consulta is None:
+                    parar = True
+                    break
+                lote.append(consulta)
+
+            self.stats['queries'] += len(lote)
+            self.stats['batches'] += 1
+            self.stats['largest_batch'] = max(self.stats['largest_batch'], len(lote))
+
+            grupos = {}
+            for consulta in lote:
+                grupos.setdefault(consulta.key, []).append(consulta)
+            for grupo in grupos.values():
+                try:
+                    self._route_group(grupo)
+                except Exception as e:
+                    logger.exception('Erro na propagação da bacia %s', self.name)
+                    for consulta in grupo:
+                        if not consulta.future.done():
+                            consulta.future.set_exception(e)
+
+            if parar:
+                self._drain()
+                return
+
+    def _scenario_inputs(self, grupo):
+
+        # uma coluna por consulta; atributos sem ajuste seguem como (N,) e
+        # são propagados por broadcast em route_arrays
+        entradas = self.model.inputs(grupo[0].sediment)
+        n_cenarios = len(grupo)
+
+        ajustados = set()
+        for consulta in grupo:
+            ajustados.update(consulta.overrides)
+            ajustados.update(consulta.fill)
+        # o escoamento é sempre matriz, para que route_arrays devolva (N, S)
+        ajustados.update(('runoff_volume', 'runoff_peak'))
+
+        for nome in ajustados:
+            base = entradas[nome]
+            matriz = np.repeat(base[:, None], n_cenarios, axis=1)
+            for s, consulta in enumerate(grupo):
+                if nome in consulta.fill:
+                    matriz[:, s] = consulta.fill[nome]
+                if nome in RUNOFF_OVERRIDES.values() and consulta.scale != 1.0:
+                    matriz[:, s] *= consulta.scale
+                if nome in consulta.overrides:
+                    posicoes, valores = consulta.overrides[nome]
+                    matriz[posicoes, s] = valores
+            entradas[nome] = matriz
+        return entradas
+
+    def _route_group(self, grupo):
+
+        inicio = time.perf_counter()
+        saida = route_arrays(
+            self.model.topology, **self._scenario_inputs(grupo),
+            params=grupo[0].params, integer_fields=grupo[0].integer_fields
+        )
+        self.stats['passes'] += 1
+        self.stats['routing_s'] += time.perf_counter() - inicio
+
+        node_ids = self.model.node_ids
+        for s, consulta in enumerate(grupo):
+            try:
+                coluna = {nome: valores[:, s] for nome, valores in saida.items()}
+                result = build_model_result(self._linhas, node_ids, coluna)
+                if consulta.subasin_ids is not None:
+                    result = result[result['subasin_id'].isin(consulta.subasin_ids)]
+                consulta.future.set_result({
+                    'basin': self.name,
+                    'failures': int(coluna['rompeu'].sum()),
+                    'batch_size': len(grupo),
+                    'results': _records(result)
+                })
+            except Exception as e:
+                consulta.future.set_exception(e)
+
+
+class RoutingService:
+
+    # bacias carregadas por nome; cada uma mantém topologia e vetores em memória
+    def __init__(self, batch_window=DEFAULT_BATCH_WINDOW, max_batch=DEFAULT_MAX_BATCH, use_cache=True):
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.use_cache = use_cache
+        self._basins = {}
+        self._lock = threading.Lock()
+
+    def load_basin(self, name, basin):
+
+        # basin: chaves do manifesto do basinflow (reservoir, routing, runoff,
+        # sedyield, sed_param, density, efficiency)
+        for chave in ('reservoir', 'routing', 'runoff'):
+            if not basin.get(chave):
+                raise ServiceError(f"Parâmetro obrigatório ausente: {chave}")
+        dataframes = load_inputs(basin, self.use_cache)
+        df_sedyield, radio_mode, df_sed_param, density, efficiency = sediment_options(basin, dataframes)
+        model = build_basin_model(
+            dataframes['reservoir.dat'],
+            dataframes['routing.dat'],
+            dataframes['runoff.dat'],
+            df_sedyield,
+            radio_mode,
+            df_sed_param,
+            density,
+            efficiency
+        )
+        fonte = {k: basin[k] for k in list(INPUT_FILES) + ['density', 'efficiency'] if basin.get(k) is not None}
+        return self.add_model(name, model, fonte)
+
+    def add_model(self, name, model, source=None):
+
+        quente = HotBasin(name, model, self.batch_window, self.max_batch, source)
+        with self._lock:
+            anterior = self._basins.get(name)
+            self._basins[name] = quente
+        if anterior is not None:
+            anterior.close()
+        logger.info('Bacia %s carregada: %d nós', name, model.n_nodes)
+        return quente.info()
+
+    def unload_basin(self, name):
+        with self._lock:
+            quente = self._basins.pop(name, None)
+        if quente is None:
+            raise ServiceError(f"Bacia desconhecida: {name}", 404)
+        quente.close()
+
+    def basin(self, name):
+        with self._lock:
+            quente = self._basins.get(name)
+        if quente is None:
+            raise ServiceError(f"Bacia desconhecida: {name}", 404)
+        return quente
+
+    def basins(self):
+        with self._lock:
+            return [quente.info() for quente in self._basins.values()]
+
+    def route(self, corpo, timeout=None):
+        if not isinstance(corpo, dict) or not corpo.get('basin'):
+            raise ServiceError("Informe 'basin' na consulta.")
+        return self.basin(corpo['basin']).route(corpo, timeout)
+
+    def close(self):
+        with self._lock:
+            basins, self._basins = list(self._basins.values()), {}
+        for quente in basins:
+            quente.close()
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    server_version = 'basinflow'
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, formato, *args):
+        logger.info('%s %s', self.address_string(), formato % args)
+
+    @property
+    def service(self):
+        return self.server.service
+
+    def _send(self, status, corpo):
+        dados = json.dumps(corpo, ensure_ascii=False, allow_nan=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(dados)))
+        self.end_headers()
+        self.wfile.write(dados)
+
+    def _body(self):
+        tamanho = int(self.headers.get('Content-Length') or 0)
+        if not tamanho:
+            return {}
+        try:
+            return json.loads(self.rfile.read(tamanho))
+        except ValueError as e:
+            raise ServiceError(f"JSON inválido: {e}")
+
+    def _dispatch(self, metodo):
+        try:
+            caminho = self.path.split('?', 1)[0].rstrip('/') or '/'
+            partes = caminho.strip('/').split('/')
+            if metodo == 'GET' and caminho == '/health':
+                self._send(200, {'status': 'ok', 'basins': len(self.service.basins())})
+            elif metodo == 'GET' and caminho == '/basins':
+                self._send(200, {'basins': self.service.basins()})
+            elif metodo == 'GET' and len(partes) == 2 and partes[0] == 'basins':
+                self._send(200, self.service.basin(partes[1]).info())
+            elif metodo == 'POST' and caminho == '/basins':
+                corpo = self._body()
+                if not corpo.get('name'):
+                    raise ServiceError("Informe 'name' da bacia.")
+                self._send(201, self.service.load_basin(corpo['name'], corpo))
+            elif metodo == 'DELETE' and len(partes) == 2 and partes[0] == 'basins':
+                self.service.unload_basin(partes[1])
+                self._send(200, {'status': 'unloaded', 'name': partes[1]})
+            elif metodo == 'POST' and caminho == '/route':
+                timeout = self.server.route_timeout
+                try:
+                    resposta = self.service.route(self._body(), timeout)
+                except TimeoutError:
+                    raise ServiceError(f"Consulta sem resposta em {timeout:g} s.", 504) from None
+                self._send(200, resposta)
+            else:
+                self._send(404, {'error': f"Rota desconhecida: {metodo} {caminho}"})
+        except ServiceError as e:
+            self._send(e.status, {'error': str(e)})
+        except (OSError, ValueError, KeyError) as e:
+            self._send(400, {'error': str(e)})
+        except Exception as e:
+            logger.exception('Erro em %s %s', metodo, self.path)
+            self._send(500, {'error': str(e)})
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_DELETE(self):
+        self._dispatch('DELETE')
+
+
+def make_server(service, host=DEFAULT_HOST, port=DEFAULT_PORT, route_timeout=DEFAULT_ROUTE_TIMEOUT):
+    # port=0 escolhe uma porta livre (server.server_address)
+    servidor = ThreadingHTTPServer((host, port), _Handler)
+    servidor.daemon_threads = True
+    servidor.service = service
+    servidor.route_timeout = route_timeout
+    return servidor
+
+
+class ServiceClient:
+
+    # cliente local só com a biblioteca padrão
+    def __init__(self, url=f'http://{DEFAULT_HOST}:{DEFAULT_PORT}', timeout=60):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    def _request(self, metodo, caminho, corpo=None):
+        dados = json.dumps(corpo).encode('utf-8') if corpo is not None else None
+        pedido = urllib.request.Request(
+            self.url + caminho, data=dados, method=metodo,
+            headers={'Content-Type': 'application/json'} if dados is not None else {}
+        )
+        try:
+            with urllib.request.urlopen(pedido, timeout=self.timeout) as resposta:
+                return json.loads(resposta.read())
+        except urllib.error.HTTPError as e:
+            try:
+                mensagem = json.loads(e.read()).get('error', str(e))
+            except ValueError:
+                mensagem = str(e)
+            raise ServiceError(mensagem, e.code) from None
+
+    def health(self):
+        return self._request('GET', '/health')
+
+    def basins(self):
+        return self._request('GET', '/basins')['basins']
+
+    def load_basin(self, name, **basin):
+        return self._request('POST', '/basins', {'name': name, **basin})
+
+    def unload_basin(self, name):
+        return self._request('DELETE', f'/basins/{name}')
+
+    def route(self, basin, runoff=None, runoff_scale=None, sediment=None, sed_param=None,
+              subasin_ids=None, params=None):
+        corpo = {'basin': basin}
+        for chave, valor in (('runoff', runoff), ('runoff_scale', runoff_scale), ('sediment', sediment),
+                             ('sed_param', sed_param), ('subasin_ids', subasin_ids), ('params', params)):
+            if valor is not None:
+                corpo[chave] = valor
+        return self._request('POST', '/route', corpo)
+
+    def route_frame(self, basin, **consulta):
+        return pd.DataFrame(self.route(basin, **consulta)['results'])
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(
+        prog='service',
+        description='Serviço local HTTP/JSON que mantém bacias carregadas e propaga consultas em lote.'
+    )
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--manifest', help='JSON ou CSV do basinflow com as bacias a carregar')
+    parser.add_argument('--batch-window-ms', dest='batch_window_ms', type=float,
+                        default=DEFAULT_BATCH_WINDOW * 1000,
+                        help='espera por consultas simultâneas antes de propagar')
+    parser.add_argument('--max-batch', dest='max_batch', type=int, default=DEFAULT_MAX_BATCH)
+    parser.add_argument('--route-timeout', dest='route_timeout', type=float, default=DEFAULT_ROUTE_TIMEOUT,
+                        help='segundos que uma consulta HTTP espera pela propagação (504 depois disso)')
+    parser.add_argument('--no-cache', dest='use_cache', action='store_false',
+                        help='não usar o cache binário dos .dat')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        stream=sys.stderr,
+        level=logging.INFO if args.verbose else logging.WARNING,
+        format='%(asctime)s - %(levelname)s: %(message)s'
+    )
+
+    service = RoutingService(args.batch_window_ms / 1000, args.max_batch, args.use_cache)
+    if args.manifest:
+        try:
+            for basin in read_manifest(args.manifest):
+                service.load_basin(basin['name'], basin)
+        except (OSError, ValueError, ServiceError) as e:
+            print(f"service: erro ao carregar bacias: {e}", file=sys.stderr)
+            return 2
+
+    servidor = make_server(service, args.host, args.port, args.route_timeout)
+    host, port = servidor.server_address[:2]
+    print(f"service: ouvindo em http://{host}:{port}", file=sys.stderr, flush=True)
+    try:
+        servidor.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        servidor.server_close()
+        service.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,150 @@
+import os
+import secrets
+import shutil
+import tempfile
+import weakref
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from routing_engine import BasinTopology
+
+TOPOLOGY_FIELDS = ('node_ids', 'level_bounds', 'edge_src', 'edge_dst', 'edge_bounds')
+
+
+def _attach_segment(nome):
+    # o dono do segmento é quem o remove; quem só anexa não deve registrá-lo
+    # no resource_tracker (Python >= 3.13)
+    try:
+        return shared_memory.SharedMemory(name=nome, track=False)
+    except TypeError:
+        return shared_memory.SharedMemory(name=nome)
+
+
+def _release(segmentos, diretorio, dono):
+    for segmento, vista in segmentos:
+        # o numpy não segura o export do buffer: SharedMemory.close() desfaria
+        # o mapeamento sob views ainda vivas. Views derivadas mantêm a view
+        # original viva (base), então o segmento só é fechado quando ela
+        # tiver sido coletada
+        if vista() is None:
+            segmento.close()
+        else:
+            weakref.finalize(vista(), segmento.close)
+        if dono:
+            try:
+                segmento.unlink()
+            except FileNotFoundError:
+                pass
+    segmentos.clear()
+    if dono and diretorio is not None:
+        shutil.rmtree(diretorio, ignore_errors=True)
+
+
+class SharedArrays:
+
+    # vetores numpy em segmentos nomeados de memória compartilhada (ou em
+    # arquivos .npy mapeados, com directory=), que outros processos anexam
+    # pelo spec() sem cópia nem pickle dos dados.
+    # Quem cria é o dono: close() remove os segmentos; processos que anexam
+    # com attach() só desfazem o mapeamento.
+    def __init__(self, directory=None, _spec=None):
+        self._arrays = {}
+        self._segmentos = []
+        self._prefixo = f'bf{secrets.token_hex(4)}'
+        self.owner = _spec is None
+
+        if directory is not None and self.owner:
+            # subdiretório próprio, removido inteiro no close()
+            directory = tempfile.mkdtemp(prefix=self._prefixo, dir=directory)
+        self.directory = directory
+        self._finalizer = weakref.finalize(self, _release, self._segmentos, self.directory, self.owner)
+
+        for nome, (onde, forma, dtype) in (_spec or {}).items():
+            if self.directory is not None:
+                self._arrays[nome] = np.load(onde, mmap_mode='r+')
+            else:
+                segmento = _attach_segment(onde)
+                self._arrays[nome] = np.ndarray(forma, dtype=dtype, buffer=segmento.buf)
+                self._segmentos.append((segmento, weakref.ref(self._arrays[nome])))
+        self._spec = dict(_spec or {})
+
+    @classmethod
+    def attach(cls, spec):
+        return cls(directory=spec['directory'], _spec=spec['arrays'])
+
+    def spec(self):
+        # descrição picklável (nomes, formas, dtypes) para os workers
+        return {'directory': self.directory, 'arrays': dict(self._spec)}
+
+    def empty(self, nome, shape, dtype=np.float64):
+
+        if not self.owner:
+            raise ValueError("Só o processo dono cria novos vetores compartilhados.")
+        if nome in self._arrays:
+            raise KeyError(f"Vetor compartilhado já existe: {nome}")
+        shape = tuple(int(n) for n in np.atleast_1d(shape)) if np.ndim(shape) else (int(shape),)
+        dtype = np.dtype(dtype)
+
+        if self.directory is not None:
+            onde = os.path.join(self.directory, f'{len(self._spec)}.npy')
+            valores = np.lib.format.open_memmap(onde, mode='w+', dtype=dtype, shape=shape)
+        else:
+            onde = f'{self._prefixo}_{len(self._spec)}'
+            tamanho = max(1, int(np.prod(shape)) * dtype.itemsize)
+            segmento = shared_memory.SharedMemory(name=onde, create=True, size=tamanho)
+            valores = np.ndarray(shape, dtype=dtype, buffer=segmento.buf)
+            self._segmentos.append((segmento, weakref.ref(valores)))
+
+        self._spec[nome] = (onde, shape, dtype.str)
+        self._arrays[nome] = valores
+        return valores
+
+    def put(self, nome, valores):
+        # a única cópia: do vetor do processo para o segmento compartilhado
+        valores = np.asarray(valores)
+        destino = self.empty(nome, valores.shape, valores.dtype)
+        destino[...] = valores
+        return destino
+
+    def __getitem__(self, nome):
+        return self._arrays[nome]
+
+    def __contains__(self, nome):
+        return nome in self._arrays
+
+    def __iter__(self):
+        return iter(self._arrays)
+
+    def get(self, nome, default=None):
+        return self._arrays.get(nome, default)
+
+    @property
+    def nbytes(self):
+        return sum(valores.nbytes for valores in self._arrays.values())
+
+    @property
+    def closed(self):
+        return not self._finalizer.alive
+
+    def close(self):
+        # solta as views, remove os nomes dos segmentos (dono) e fecha os
+        # mapeamentos; um vetor de empty()/put() ainda em uso segura o seu
+        # segmento até ser coletado
+        self._arrays.clear()
+        self._finalizer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def share_topology(buffers, topology, prefix='topology.'):
+    for campo in TOPOLOGY_FIELDS:
+        buffers.put(prefix + campo, getattr(topology, campo))
+
+
+def attach_topology(buffers, prefix='topology.'):
+    return BasinTopology(*(buffers[prefix + campo] for campo in TOPOLOGY_FIELDS))
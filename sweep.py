@@ -0,0 +1,148 @@
+import itertools
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import asdict, fields
+
+import numpy as np
+import pandas as pd
+
+from data_utils import routing_input_arrays, detect_integer_fields
+from parallel import pool_context
+from routing_engine import DEFAULT_PARAMS, RoutingParams, compile_topology, route_arrays
+
+PARAM_FIELDS = [f.name for f in fields(RoutingParams)]
+
+# estado de cada processo do pool, preenchido uma vez pelo initializer
+_worker = {}
+
+
+def parameter_grid(**valores):
+
+    # cada argumento é uma lista de valores para um campo de RoutingParams;
+    # os campos omitidos ficam com o valor padrão
+    for nome in valores:
+        if nome not in PARAM_FIELDS:
+            raise ValueError(f"Parâmetro desconhecido: {nome}")
+
+    nomes = list(valores)
+    return [
+        RoutingParams(**{**asdict(DEFAULT_PARAMS), **dict(zip(nomes, combinacao))})
+        for combinacao in itertools.product(*(valores[n] for n in nomes))
+    ]
+
+
+def latin_hypercube(n_samples, bounds, seed=None):
+
+    # bounds: {campo: (mínimo, máximo)}; um estrato por amostra em cada eixo
+    for nome in bounds:
+        if nome not in PARAM_FIELDS:
+            raise ValueError(f"Parâmetro desconhecido: {nome}")
+
+    rng = np.random.default_rng(seed)
+    amostras = {}
+    for nome, (minimo, maximo) in bounds.items():
+        u = (rng.permutation(n_samples) + rng.random(n_samples)) / n_samples
+        amostras[nome] = minimo + u * (maximo - minimo)
+
+    return [
+        RoutingParams(**{**asdict(DEFAULT_PARAMS), **{n: float(v[k]) for n, v in amostras.items()}})
+        for k in range(n_samples)
+    ]
+
+
+def _init_worker(topology, entradas, outlets):
+    _worker['topology'] = topology
+    _worker['entradas'] = entradas
+    _worker['outlets'] = outlets
+
+
+def _outlet_metrics(indice, params, saida, topology, outlets):
+
+    k = len(outlets)
+    metricas = {'param_set': np.full(k, indice, dtype=np.int64)}
+    for nome, valor in asdict(params).items():
+        metricas[nome] = np.full(k, valor)
+
+    metricas['subasin_id'] = topology.node_ids[outlets]
+    metricas['volume_total'] = np.trunc(saida['volume_out'][outlets])
+    metricas['vazão_de_saida'] = np.round(saida['peak_out'][outlets], 2)
+    metricas['rompeu'] = saida['rompeu'][outlets]
+    metricas['total_rupturas'] = np.full(k, int(saida['rompeu'].sum()))
+    if 'sed_out' in saida:
+        metricas['sedimento_efluente'] = np.round(saida['sed_out'][outlets], 2)
+
+    return pd.DataFrame(metricas)
+
+
+def _route_batch(lote):
+
+    topology = _worker['topology']
+    entradas = _worker['entradas']
+    outlets = _worker['outlets']
+
+    tabelas = []
+    for indice, params in lote:
+        saida = route_arrays(topology, **entradas, params=params)
+        tabelas.append(_outlet_metrics(indice, params, saida, topology, outlets))
+
+    return pd.concat(tabelas, ignore_index=True)
+
+
+def iter_sweep(
+    df_reservoir,
+    df_routing,
+    df_runoff,
+    param_sets,
+    df_sedyield=None,
+    radio_mode=1,
+    df_sed_param=None,
+    density_manual=None,
+    efficiency_manual=None,
+    outlets=None,
+    processes=None,
+    batch_size=None,
+    topology=None):
+
+    if topology is None:
+        topology = compile_topology(df_routing)
+
+    df_merged = df_reservoir.merge(df_runoff, on='subasin_id', how='left')
+    entradas = routing_input_arrays(
+        topology, df_merged, df_runoff, df_sedyield,
+        radio_mode, df_sed_param, density_manual, efficiency_manual
+    )
+    entradas['integer_fields'] = detect_integer_fields(df_merged)
+
+    if outlets is None:
+        posicoes = topology.outlets()
+    else:
+        posicoes = topology.index_of(outlets)
+        if (posicoes < 0).any():
+            raise ValueError("Exutório fora da rede de drenagem.")
+
+    tarefas = list(enumerate(param_sets))
+    processes = processes or os.cpu_count() or 1
+    batch_size = batch_size or max(1, math.ceil(len(tarefas) / (processes * 4)))
+    lotes = [tarefas[i:i + batch_size] for i in range(0, len(tarefas), batch_size)]
+
+    if processes == 1:
+        _init_worker(topology, entradas, posicoes)
+        for lote in lotes:
+            yield _route_batch(lote)
+        return
+
+    with ProcessPoolExecutor(
+        max_workers=processes,
+        mp_context=pool_context(),
+        initializer=_init_worker,
+        initargs=(topology, entradas, posicoes)
+    ) as pool:
+        futuros = [pool.submit(_route_batch, lote) for lote in lotes]
+        for futuro in as_completed(futuros):
+            yield futuro.result()
+
+
+def run_sweep(*args, **kwargs):
+    tabela = pd.concat(list(iter_sweep(*args, **kwargs)), ignore_index=True)
+    return tabela.sort_values(['param_set', 'subasin_id'], ignore_index=True)
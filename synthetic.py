@@ -0,0 +1,226 @@
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+from data_utils import FILE_SCHEMAS
+from result_writer import format_chunk
+from routing_engine import DEFAULT_PARAMS, water_step
+
+# as duas linhas de cabeçalho de cada arquivo, como nos .dat do WASA
+WASA_HEADERS = {
+    "reservoir.dat": (
+        "Specification of reservoir parameters",
+        "Subasin-ID, water_storage_capacity[m**3], dam_height [m], spillway_discharge[m**3/s]"
+    ),
+    "routing.dat": (
+        "Specification of routing order (flow directions)",
+        "No., Subasin-ID(upstream), Subasin-ID(downstream)"
+    ),
+    "runoff.dat": (
+        "Specification of reservoir parameters",
+        "Subasin-ID, runoff_volume[m**3],runoff_peak_discharge[m**3/s]"
+    ),
+    "sedyield.dat": (
+        "Specification of sediment yield",
+        "Subasin-ID, sed_enter_volume[t]"
+    ),
+    "sed_param.dat": (
+        "Specification of sediment parameters",
+        "Subasin-ID, sediment_density[g/cm**3], sediment_retention_efficiency[-]"
+    )
+}
+
+# folgas do vertedouro em relação a coef_fenda * pico de entrada; longe de 1
+# para que o arredondamento em 2 casas não mude quem rompe
+FOLGA_RUPTURA = (0.3, 0.9)
+FOLGA_SEGURA = (1.2, 3.0)
+
+
+def _level_sizes(n_nodes, n_outlets, branching, largura_max):
+
+    # os níveis crescem por branching a partir dos exutórios até largura_max;
+    # daí em diante a rede desce como um tronco de largura constante
+    tamanhos = []
+    total = 0
+    largura = float(n_outlets)
+    while branching > 1 and total < n_nodes and largura < largura_max:
+        w = min(int(largura), n_nodes - total)
+        tamanhos.append(w)
+        total += w
+        largura *= branching
+
+    resto = n_nodes - total
+    if resto > 0:
+        w = max(1, int(min(largura, largura_max)))
+        cheios, parcial = divmod(resto, w)
+        tamanhos = np.concatenate([
+            np.asarray(tamanhos, dtype=np.int64),
+            np.full(cheios, w, dtype=np.int64),
+            np.asarray([parcial] if parcial else [], dtype=np.int64)
+        ])
+    return np.asarray(tamanhos, dtype=np.int64)
+
+
+def _width_for_depth(n_nodes, n_outlets, branching, depth):
+
+    # menor largura máxima que faz a rede caber em depth níveis
+    if len(_level_sizes(n_nodes, n_outlets, branching, n_nodes)) > depth:
+        raise ValueError(
+            f"Não é possível distribuir {n_nodes} nós em {depth} níveis com "
+            f"{n_outlets} exutórios e branching {branching}."
+        )
+    baixo, alto = max(1, n_outlets), max(1, n_nodes)
+    while baixo < alto:
+        meio = (baixo + alto) // 2
+        if len(_level_sizes(n_nodes, n_outlets, branching, meio)) <= depth:
+            alto = meio
+        else:
+            baixo = meio + 1
+    return baixo
+
+
+def generate_basin(
+    n_nodes,
+    branching=2.0,
+    depth=None,
+    n_outlets=1,
+    failure_rate=0.1,
+    seed=None,
+    params=None):
+
+    # floresta sintética com os cinco arquivos de entrada (reservoir, routing,
+    # runoff, sedyield, sed_param), no mesmo layout do load_dat_file.
+    # branching: filhos por nó enquanto a rede alarga; depth: número máximo de
+    # níveis (cadeias profundas com branching=1 e muitos exutórios);
+    # failure_rate: fração de açudes que rompem na propagação com params
+    params = params or DEFAULT_PARAMS
+    if n_nodes < 1 or n_outlets < 1 or n_outlets > n_nodes:
+        raise ValueError("n_nodes e n_outlets devem satisfazer 1 <= n_outlets <= n_nodes.")
+    if branching < 1:
+        raise ValueError("branching deve ser >= 1.")
+    if not 0 <= failure_rate <= 1:
+        raise ValueError("failure_rate deve estar entre 0 e 1.")
+
+    rng = np.random.default_rng(seed)
+
+    largura_max = n_nodes if depth is None else _width_for_depth(n_nodes, n_outlets, branching, depth)
+    tamanhos = _level_sizes(n_nodes, n_outlets, branching, largura_max)
+    limites = np.concatenate([[0], np.cumsum(tamanhos)])
+    n_niveis = len(tamanhos)
+
+    # posição p fica no nível nivel[p]; o nó de jusante é sorteado no nível anterior
+    nivel = np.repeat(np.arange(n_niveis), tamanhos)
+    jusante = np.full(n_nodes, -1, dtype=np.int64)
+    internos = nivel > 0
+    inicio_anterior = limites[nivel[internos] - 1]
+    largura_anterior = tamanhos[nivel[internos] - 1]
+    jusante[internos] = inicio_anterior + (rng.random(internos.sum()) * largura_anterior).astype(np.int64)
+    if n_niveis > 1:
+        # todo exutório recebe ao menos um afluente, como nas redes do WASA
+        # (a engine networkx não aceita sub-bacias isoladas)
+        k = min(tamanhos[0], tamanhos[1])
+        jusante[limites[1]:limites[1] + k] = rng.permutation(tamanhos[0])[:k]
+
+    capacidade = np.maximum(np.round(rng.lognormal(np.log(1e4), 1.5, n_nodes)), 39).astype(np.int64)
+    altura = np.round(rng.uniform(2.0, 15.0, n_nodes), 2)
+    volume = np.round(rng.lognormal(np.log(2e4), 1.2, n_nodes)).astype(np.int64)
+    pico = np.round(np.maximum(rng.lognormal(np.log(5.0), 1.0, n_nodes), 1.0), 2)
+
+    # vertedouros escolhidos nível a nível, das nascentes aos exutórios, a
+    # partir do pico que de fato chega em cada açude
+    rompe = rng.random(n_nodes) < failure_rate
+    folga = np.where(rompe, rng.uniform(*FOLGA_RUPTURA, n_nodes), rng.uniform(*FOLGA_SEGURA, n_nodes))
+    vertedouro = np.empty(n_nodes)
+    v_in = volume.astype(np.float64)
+    p_in = pico.copy()
+    for k in range(n_niveis - 1, -1, -1):
+        a, b = limites[k], limites[k + 1]
+        vertedouro[a:b] = np.round(params.coef_fenda * p_in[a:b] * folga[a:b], 2)
+        v_out, p_out, _ = water_step(v_in[a:b], p_in[a:b], capacidade[a:b], vertedouro[a:b], params)
+        if k > 0:
+            c = limites[k - 1]
+            destino = jusante[a:b] - c
+            v_in[c:a] += np.bincount(destino, weights=v_out, minlength=a - c)
+            p_in[c:a] += np.bincount(destino, weights=p_out, minlength=a - c)
+
+    # ids embaralhados: a ordem dos arquivos não entrega a ordem topológica
+    ids = rng.permutation(n_nodes).astype(np.int64)
+    ordem = np.argsort(ids)
+    linhas = rng.permutation(n_nodes)
+
+    return {
+        "reservoir.dat": pd.DataFrame({
+            'subasin_id': ids[ordem],
+            'water_storage_capacity': capacidade[ordem],
+            'dam_height': altura[ordem],
+            'spillway_discharge': vertedouro[ordem]
+        }),
+        "routing.dat": pd.DataFrame({
+            'subasin_id': np.arange(1, n_nodes + 1),
+            'upstream': ids[linhas],
+            'downstream': np.where(jusante[linhas] >= 0, ids[jusante[linhas]], -999)
+        }),
+        "runoff.dat": pd.DataFrame({
+            'subasin_id': ids[ordem],
+            'runoff_volume': volume[ordem],
+            'runoff_peak_discharge': pico[ordem]
+        }),
+        "sedyield.dat": pd.DataFrame({
+            'subasin_id': ids[ordem],
+            'sed_enter_volume': np.round(rng.lognormal(np.log(50.0), 1.0, n_nodes), 2)
+        }),
+        "sed_param.dat": pd.DataFrame({
+            'subasin_id': ids[ordem],
+            'sediment_density': np.round(rng.uniform(1.2, 1.8, n_nodes), 2),
+            'sediment_retention_efficiency': np.round(rng.uniform(0.3, 0.9, n_nodes), 2)
+        })
+    }
+
+
+def write_wasa_basin(diretorio, dataframes, chunk_rows=500000):
+
+    # grava cada tabela como .dat do WASA (tabulação, decimal do schema,
+    # floats com vírgula entre aspas) e devolve os caminhos com as chaves do
+    # manifesto do basinflow
+    os.makedirs(diretorio, exist_ok=True)
+    caminhos = {}
+    for nome, df in dataframes.items():
+        decimal = FILE_SCHEMAS[nome]["decimal"]
+        titulo, colunas = WASA_HEADERS[nome]
+        tabs = '\t' * (len(FILE_SCHEMAS[nome]["names"]) - 1)
+        caminho = os.path.join(diretorio, nome)
+        with open(caminho, 'wb') as f:
+            f.write(f'{titulo}{tabs}\n"{colunas}"{tabs}\n'.encode('latin1'))
+            for i in range(0, len(df), chunk_rows):
+                f.write(format_chunk(df.iloc[i:i + chunk_rows], '\t', decimal, quote_floats=decimal != '.'))
+        caminhos[nome.split('.')[0]] = caminho
+    return caminhos
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(
+        prog='synthetic',
+        description='Gera uma bacia sintética nos arquivos .dat do WASA.'
+    )
+    parser.add_argument('output_dir')
+    parser.add_argument('--nodes', type=float, required=True, help='número de açudes (aceita 1e6)')
+    parser.add_argument('--branching', type=float, default=2.0)
+    parser.add_argument('--depth', type=int, help='número máximo de níveis')
+    parser.add_argument('--outlets', type=int, default=1)
+    parser.add_argument('--failure-rate', dest='failure_rate', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    dataframes = generate_basin(
+        int(args.nodes), args.branching, args.depth, args.outlets, args.failure_rate, args.seed
+    )
+    for chave, caminho in write_wasa_basin(args.output_dir, dataframes).items():
+        print(f'{chave}: {caminho}')
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
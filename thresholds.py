@@ -0,0 +1,218 @@
+import numpy as np
+import pandas as pd
+
+from data_utils import map_node_values, water_input_arrays
+from routing_engine import (
+    compile_topology, node_levels, partition_components, route_arrays, sort_topology, subtopology
+)
+
+
+def _rupture_matrix(topology, entradas, multiplicadores, max_columns, params):
+
+    # uma coluna por multiplicador, roteadas em lotes de até max_columns
+    runoff_volume, runoff_peak, storage_capacity, spillway = entradas
+    blocos = []
+    for i in range(0, len(multiplicadores), max_columns):
+        m = multiplicadores[i:i + max_columns]
+        saida = route_arrays(
+            topology,
+            runoff_volume[:, None] * m,
+            runoff_peak[:, None] * m,
+            storage_capacity,
+            spillway,
+            params=params
+        )
+        blocos.append(saida['rompeu'])
+    if not blocos:
+        return np.zeros((topology.n_nodes, 0), dtype=bool)
+    return np.concatenate(blocos, axis=1)
+
+
+def _cascade_origins(topology, rompeu, prioridade):
+
+    # para cada nó e coluna, a ruptura mais a montante (sem rupturas acima dela)
+    # que chega até ele; entre várias, vale a de maior prioridade
+    n, c = rompeu.shape
+    ordem = np.lexsort((-np.arange(n), prioridade))
+    nota = np.empty(n, dtype=np.int64)
+    nota[ordem] = np.arange(n)
+
+    melhor = np.full((n, c), -1, dtype=np.int64)
+    for nivel, a, b in topology.levels():
+        acima = np.full((b - a, c), -1, dtype=np.int64)
+        src, dst = topology.level_edges(nivel)
+        if len(src):
+            np.maximum.at(acima, dst - a, melhor[src])
+        propria = np.where(rompeu[a:b], nota[a:b, None], -1)
+        melhor[a:b] = np.where(acima >= 0, acima, propria)
+
+    return np.where(melhor >= 0, ordem[np.maximum(melhor, 0)], -1)
+
+
+def _closure_sizes(topology):
+
+    # nós a montante de cada nó, ele incluído; com bifurcações os ancestrais
+    # comuns contam mais de uma vez, o que só serve de limite superior
+    tamanho = np.ones(topology.n_nodes)
+    for nivel, a, b in topology.levels():
+        src, dst = topology.level_edges(nivel)
+        if len(src):
+            np.add.at(tamanho, dst, tamanho[src])
+    return tamanho
+
+
+def _upstream_copies(topology, alvos):
+
+    # pares (cópia, nó): uma cópia da bacia de contribuição de cada alvo,
+    # ordenados por cópia e posição
+    n = topology.n_nodes
+    pred = topology.edge_src[np.argsort(topology.edge_dst, kind='stable')]
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(topology.edge_dst, minlength=n))])
+
+    frente = np.arange(len(alvos)) * n + alvos
+    pares = [frente]
+    while len(frente):
+        copia, no = np.divmod(frente, n)
+        inicio = indptr[no]
+        qtd = indptr[no + 1] - inicio
+        total = int(qtd.sum())
+        if total == 0:
+            break
+        desloc = np.repeat(inicio - np.cumsum(qtd) + qtd, qtd) + np.arange(total)
+        # ancestrais comuns (bifurcações) entram uma vez por cópia
+        frente = np.unique(np.repeat(copia, qtd) * n + pred[desloc])
+        pares.append(frente)
+
+    return np.unique(np.concatenate(pares)), pred, indptr
+
+
+def _closure_network(topology, alvos):
+
+    # rede com uma cópia da bacia de contribuição de cada alvo. A ordem das
+    # afluências de cada nó é a da rede original, então cada alvo rompe na
+    # cópia exatamente como romperia roteando a bacia inteira
+    n = topology.n_nodes
+    pares, pred, indptr = _upstream_copies(topology, alvos)
+    copia, no = np.divmod(pares, n)
+
+    inicio = indptr[no]
+    qtd = indptr[no + 1] - inicio
+    desloc = np.repeat(inicio - np.cumsum(qtd) + qtd, qtd) + np.arange(int(qtd.sum()))
+    src = np.searchsorted(pares, np.repeat(copia, qtd) * n + pred[desloc])
+    dst = np.repeat(np.arange(len(pares)), qtd)
+
+    rede = sort_topology(np.arange(len(pares)), src, dst, node_levels(topology)[no])
+    linha_alvo = rede.index_of(np.searchsorted(pares, np.arange(len(alvos)) * n + alvos))
+    return rede, no[rede.node_ids], copia[rede.node_ids], linha_alvo
+
+
+def _route_copies(rede, entradas, linha_no, linha_copia, multiplicadores, params):
+
+    # cada cópia roteada com o multiplicador do seu alvo
+    runoff_volume, runoff_peak, storage_capacity, spillway = entradas
+    m = multiplicadores[linha_copia]
+    saida = route_arrays(
+        rede,
+        runoff_volume[linha_no] * m,
+        runoff_peak[linha_no] * m,
+        storage_capacity[linha_no],
+        spillway[linha_no],
+        params=params
+    )
+    return saida['rompeu']
+
+
+def _solve_thresholds(topology, entradas, bounds, grid_size, tol, max_columns, params):
+
+    n = topology.n_nodes
+    inferior, superior = bounds
+    grade = np.linspace(inferior, superior, max(grid_size, 2))
+    rompeu = _rupture_matrix(topology, entradas, grade, max_columns, params)
+
+    rompe_alguma = rompeu.any(axis=1)
+    primeira = np.argmax(rompeu, axis=1)
+    critico = np.full(n, np.nan)
+    critico[rompe_alguma & (primeira == 0)] = inferior
+    prioridade = np.full(n, -np.inf)
+    origem = np.full(n, -1, dtype=np.int64)
+
+    # açudes nível a nível, em lotes com até ~max_columns * n nós copiados
+    # (a memória de max_columns colunas da rede inteira). Tudo o que está a
+    # montante de um lote já foi resolvido antes dele, então a origem da
+    # cascata sai da mesma rede, roteada no multiplicador crítico
+    alvos = np.flatnonzero(rompe_alguma)
+    tamanho = _closure_sizes(topology)[alvos]
+    lote = ((np.cumsum(tamanho) - tamanho) // max(max_columns * n, 1)).astype(np.int64)
+    for k in np.unique(lote):
+        sel = alvos[lote == k]
+        rede, linha_no, linha_copia, linha_alvo = _closure_network(topology, sel)
+
+        pendente = primeira[sel] > 0
+        a = grade[np.maximum(primeira[sel] - 1, 0)]
+        b = grade[primeira[sel]]
+        while pendente.any():
+            meio = (a + b) / 2
+            r = _route_copies(rede, entradas, linha_no, linha_copia, meio, params)[linha_alvo]
+            b = np.where(pendente & r, meio, b)
+            a = np.where(pendente & ~r, meio, a)
+
+            convergiu = pendente & (b - a <= tol)
+            critico[sel[convergiu]] = b[convergiu]
+            pendente &= ~convergiu
+        prioridade[sel] = critico[sel]
+
+        r = _route_copies(rede, entradas, linha_no, linha_copia, critico[sel], params)
+        origens = _cascade_origins(rede, r[:, None], prioridade[linha_no])[linha_alvo, 0]
+        origem[sel] = np.where(origens >= 0, linha_no[np.maximum(origens, 0)], -1)
+
+    return critico, origem
+
+
+def critical_multipliers(
+    df_reservoir,
+    df_routing,
+    df_runoff,
+    bounds=(0.0, 10.0),
+    grid_size=64,
+    tol=1e-4,
+    max_columns=256,
+    part_size=1024,
+    topology=None,
+    params=None):
+
+    # menor multiplicador do escoamento (volume e pico de todas as subbacias)
+    # que faz cada açude romper. Uma varredura grossa comum a todos os nós acha
+    # o primeiro intervalo com ruptura; a bisseção refina cada açude roteando só
+    # a sua bacia de contribuição no seu ponto médio. Sub-bacias independentes são
+    # agrupadas em partes de ~part_size nós para que cada coluna não percorra
+    # a rede inteira.
+    if topology is None:
+        topology = compile_topology(df_routing)
+    df_merged = df_reservoir.merge(df_runoff, on='subasin_id', how='left')
+    entradas = water_input_arrays(topology, df_merged)
+
+    n = topology.n_nodes
+    critico = np.full(n, np.nan)
+    origem = np.full(n, -1, dtype=np.int64)
+
+    for positions in partition_components(topology, max(1, n // part_size)):
+        if not len(positions):
+            continue
+        parte = subtopology(topology, positions)
+        c, o = _solve_thresholds(
+            parte, [e[positions] for e in entradas], bounds, grid_size, tol, max_columns, params
+        )
+        critico[positions] = c
+        origem[positions] = np.where(o >= 0, positions[np.maximum(o, 0)], -1)
+
+    ids = df_runoff["subasin_id"]
+    node_ids = topology.node_ids
+    base = _rupture_matrix(topology, entradas, np.array([1.0]), max_columns, params)[:, 0]
+    origem_ids = np.where(origem >= 0, node_ids[np.maximum(origem, 0)], -1)
+
+    return pd.DataFrame({
+        "subasin_id": ids,
+        "multiplicador_critico": map_node_values(ids, node_ids, critico),
+        "rompe_atualmente": map_node_values(ids, node_ids, base),
+        "origem_cascata": map_node_values(ids, node_ids, origem_ids)
+    })
@@ -0,0 +1,183 @@
+import numpy as np
+import pandas as pd
+
+from data_utils import FILE_SCHEMAS, detect_integer_fields, iter_dat_chunks
+from result_writer import open_result_writer
+from routing_engine import DEFAULT_PARAMS, compile_topology, libm_power, node_array, upstream_sum
+
+
+class ReservoirState:
+
+    # estado que passa de um evento para o outro: volume armazenado em cada
+    # açude e se ele já rompeu. Começar cheio reproduz o evento único
+    # (ruptura libera toda a capacidade, açude intacto passa o afluente).
+
+    def __init__(self, storage_capacity, initial_storage=None):
+        capacidade = np.nan_to_num(np.asarray(storage_capacity, dtype=np.float64))
+        if initial_storage is None:
+            self.armazenado = capacidade.copy()
+        else:
+            self.armazenado = np.minimum(np.broadcast_to(initial_storage, capacidade.shape), capacidade).astype(np.float64)
+        self.rompido = np.zeros(len(capacidade), dtype=bool)
+
+
+def route_event(topology, runoff_volume, runoff_peak, storage_capacity, spillway, state, params=None):
+
+    # um evento com o estado atual; state é atualizado no lugar
+    params = params or DEFAULT_PARAMS
+    n = topology.n_nodes
+
+    volume_in = np.empty(n)
+    volume_out = np.empty(n)
+    peak_in = np.empty(n)
+    peak_out = np.empty(n)
+    rompeu = np.empty(n, dtype=bool)
+
+    for nivel, a, b in topology.levels():
+
+        v_in = runoff_volume[a:b] + upstream_sum(topology, nivel, volume_out, (b - a,))[0]
+        p_in = runoff_peak[a:b] + upstream_sum(topology, nivel, peak_out, (b - a,))[0]
+
+        ja_rompido = state.rompido[a:b]
+        armazenado = state.armazenado[a:b]
+
+        # açude intacto: enche o que falta antes de verter; rompe pelo mesmo
+        # critério do evento único e libera o que estava armazenado
+        rompe = ~ja_rompido & (params.coef_fenda * p_in > spillway[a:b])
+        retido = np.where(ja_rompido | rompe, 0.0, np.clip(storage_capacity[a:b] - armazenado, 0.0, v_in))
+        retido = np.nan_to_num(retido)
+
+        v_out = np.where(rompe, v_in + armazenado, v_in - retido)
+        with np.errstate(invalid='ignore'):
+            p_out = np.where(
+                rompe,
+                params.coef_pico_ruptura * libm_power(v_out, params.exp_pico_ruptura),
+                # rompido em evento anterior: sem barramento, o pico passa direto
+                np.where(ja_rompido, p_in, params.coef_fenda * p_in)
+            )
+
+        state.armazenado[a:b] = np.where(rompe | ja_rompido, 0.0, armazenado + retido)
+        state.rompido[a:b] = ja_rompido | rompe
+
+        volume_in[a:b] = v_in
+        volume_out[a:b] = v_out
+        peak_in[a:b] = p_in
+        peak_out[a:b] = p_out
+        rompeu[a:b] = rompe
+
+    return {
+        'volume_in': volume_in,
+        'volume_out': volume_out,
+        'peak_in': peak_in,
+        'peak_out': peak_out,
+        'rompeu': rompeu
+    }
+
+
+def iter_runoff_events(file_path, chunksize=100000):
+
+    # junta as linhas de cada evento lendo o arquivo em blocos; os eventos
+    # precisam estar contíguos (ordenados), como o WASA grava
+    schema = FILE_SCHEMAS["runoff_events.dat"]
+    pendente = []
+    atual = None
+    vistos = set()
+
+    for bloco in iter_dat_chunks(file_path, schema, chunksize):
+        eventos = bloco['event'].to_numpy()
+        quebras = np.flatnonzero(eventos[1:] != eventos[:-1]) + 1
+        for parte in np.split(np.arange(len(bloco)), quebras):
+            if not len(parte):
+                continue
+            evento = eventos[parte[0]]
+            if evento != atual:
+                if pendente:
+                    yield atual, pd.concat(pendente, ignore_index=True)
+                if evento in vistos:
+                    raise ValueError(f"Evento {evento} aparece em trechos separados de {file_path}.")
+                vistos.add(evento)
+                atual, pendente = evento, []
+            pendente.append(bloco.iloc[parte])
+
+    if pendente:
+        yield atual, pd.concat(pendente, ignore_index=True)
+
+
+def iter_event_routing(
+    df_reservoir,
+    df_routing,
+    events,
+    initial_storage=None,
+    drawdown=0.0,
+    topology=None,
+    params=None):
+
+    # events: iterável de (evento, df_runoff) ou caminho de um runoff em
+    # formato longo. Gera um DataFrame por evento, com o estado acumulado;
+    # subbacia sem linha no evento recebe escoamento zero.
+    if isinstance(events, str):
+        events = iter_runoff_events(events)
+    if topology is None:
+        topology = compile_topology(df_routing)
+
+    ids_reservatorio = df_reservoir['subasin_id']
+    storage_capacity = node_array(topology, ids_reservatorio, df_reservoir['water_storage_capacity'])
+    spillway = node_array(topology, ids_reservatorio, df_reservoir['spillway_discharge'])
+    state = ReservoirState(storage_capacity, initial_storage)
+
+    linhas = topology.index_of(ids_reservatorio.to_numpy())
+    faltando = linhas < 0
+    linhas = np.where(faltando, 0, linhas)
+
+    def por_linha(valores):
+        valores = valores[linhas]
+        if faltando.any():
+            valores = valores.astype(np.float64)
+            valores[faltando] = np.nan
+        return valores
+
+    def volume(valores, inteiro):
+        # como no evento único: escoamento inteiro no .dat dá volumes inteiros
+        # (açude fora da rede fica NaN, então a coluna segue float)
+        valores = np.trunc(por_linha(valores))
+        return valores.astype(np.int64) if inteiro and not faltando.any() else valores
+
+    for k, (evento, df_runoff) in enumerate(events):
+        if k:
+            # perdas entre eventos (evaporação, retiradas)
+            state.armazenado *= 1.0 - np.asarray(drawdown, dtype=np.float64)
+
+        ids = df_runoff['subasin_id']
+        inteiro = 'runoff_volume' in detect_integer_fields(df_reservoir, df_runoff['runoff_volume'])
+        saida = route_event(
+            topology,
+            node_array(topology, ids, df_runoff['runoff_volume'], fill=0.0),
+            node_array(topology, ids, df_runoff['runoff_peak_discharge'], fill=0.0),
+            storage_capacity,
+            spillway,
+            state,
+            params
+        )
+
+        yield pd.DataFrame({
+            "event": evento,
+            "subasin_id": ids_reservatorio.to_numpy(),
+            "volume_entrada": volume(saida['volume_in'], inteiro),
+            "volume_total": volume(saida['volume_out'], inteiro),
+            "vazão_de_entrada": np.round(por_linha(saida['peak_in']), 2),
+            "vazão_de_saida": np.round(por_linha(saida['peak_out']), 2),
+            "rompeu": por_linha(saida['rompeu']),
+            "rompido": por_linha(state.rompido),
+            "volume_armazenado": np.round(por_linha(state.armazenado), 2)
+        })
+
+
+def write_event_routing(output_path, df_reservoir, df_routing, events, format='dat', **kwargs):
+
+    # grava evento a evento numa thread; só o evento corrente fica em memória
+    eventos = 0
+    with open_result_writer(output_path, format) as escritor:
+        for tabela in iter_event_routing(df_reservoir, df_routing, events, **kwargs):
+            escritor.write(tabela)
+            eventos += 1
+    return eventos